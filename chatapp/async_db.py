@@ -0,0 +1,229 @@
+"""
+Async Postgres access for the consumer hot path.
+
+database_sync_to_async hands each query to the sync thread pool and waits for
+a thread and a connection there. Here the ORM still builds the query, but it
+is compiled to SQL by Django and run on a psycopg 3 AsyncConnectionPool bound
+to the running event loop, so the coroutine never leaves the loop. Rows come
+back as model instances, the way iterating the queryset would return them.
+
+Only available on PostgreSQL with psycopg_pool installed and ASYNC_DB
+enabled; callers check is_enabled() and fall back to database_sync_to_async.
+Writes made here do not send model signals.
+"""
+import asyncio
+import time
+import weakref
+from contextlib import asynccontextmanager
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models.query import get_related_populators
+from django.db.models.sql import InsertQuery
+from chatapp import metrics
+
+try:
+    import psycopg
+    from psycopg_pool import AsyncConnectionPool
+except ImportError:
+    psycopg = AsyncConnectionPool = None
+
+ASYNC_DB_ACQUIRE_SECONDS = metrics.Histogram(
+    'chat_async_db_acquire_seconds', "Time async queries wait for a pooled connection")
+ASYNC_DB_QUERY_SECONDS = metrics.Histogram(
+    'chat_async_db_query_seconds', "Time async queries hold a pooled connection")
+
+_pools = weakref.WeakKeyDictionary()
+
+
+def is_enabled():
+    return (
+        settings.ASYNC_DB['ENABLED']
+        and AsyncConnectionPool is not None
+        and connections[DEFAULT_DB_ALIAS].vendor == 'postgresql'
+    )
+
+
+async def get_pool():
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is not None:
+        return pool
+    for stale in [other for other in _pools if other.is_closed()]:
+        del _pools[stale]
+
+    # Same connection parameters, time zone handling and client-side binding
+    # as Django's own connections
+    kwargs = connections[DEFAULT_DB_ALIAS].get_connection_params()
+    kwargs.update(autocommit=True, cursor_factory=psycopg.AsyncClientCursor)
+    pool = AsyncConnectionPool(
+        kwargs=kwargs,
+        min_size=settings.ASYNC_DB['MIN_SIZE'],
+        max_size=settings.ASYNC_DB['MAX_SIZE'],
+        timeout=settings.ASYNC_DB['TIMEOUT'],
+        name='async',
+        open=False,
+    )
+    await pool.open()
+    if loop in _pools:
+        # Another task opened one while this one was connecting
+        await pool.close()
+    return _pools.setdefault(loop, pool)
+
+
+@asynccontextmanager
+async def connection():
+    pool = await get_pool()
+    start = time.perf_counter()
+    async with pool.connection() as conn:
+        acquired = time.perf_counter()
+        ASYNC_DB_ACQUIRE_SECONDS.observe(acquired - start)
+        try:
+            yield conn
+        finally:
+            ASYNC_DB_QUERY_SECONDS.observe(time.perf_counter() - acquired)
+
+
+@asynccontextmanager
+async def transaction():
+    async with connection() as conn:
+        async with conn.transaction():
+            yield conn
+
+
+async def _run(conn, sql, params):
+    if conn is not None:
+        return await (await conn.execute(sql, params)).fetchall()
+    async with connection() as conn:
+        return await (await conn.execute(sql, params)).fetchall()
+
+
+async def _execute(queryset, conn):
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    try:
+        sql, params = compiler.as_sql()
+    except EmptyResultSet:
+        return compiler, []
+    rows = await _run(conn, sql, params)
+    return compiler, list(compiler.results_iter([rows]))
+
+
+async def fetch_rows(queryset, conn=None):
+    """Rows of a queryset as tuples, values_list() ones included, with Django's converters applied."""
+    _, rows = await _execute(queryset, conn)
+    return rows
+
+
+async def fetch(queryset, conn=None):
+    """Model instances of a queryset, select_related() ones included."""
+    compiler, rows = await _execute(queryset, conn)
+    if not rows:
+        return []
+    db = queryset.db
+    select, klass_info, annotation_col_map = compiler.select, compiler.klass_info, compiler.annotation_col_map
+    model_cls = klass_info['model']
+    select_fields = klass_info['select_fields']
+    model_fields_start, model_fields_end = select_fields[0], select_fields[-1] + 1
+    init_list = [f[0].target.attname for f in select[model_fields_start:model_fields_end]]
+    related_populators = get_related_populators(klass_info, select, db)
+
+    objs = []
+    for row in rows:
+        obj = model_cls.from_db(db, init_list, row[model_fields_start:model_fields_end])
+        for populator in related_populators:
+            populator.populate(row, obj)
+        for attr_name, col_pos in (annotation_col_map or {}).items():
+            setattr(obj, attr_name, row[col_pos])
+        objs.append(obj)
+    return objs
+
+
+async def get(queryset, conn=None):
+    """The single instance matching a queryset, or None."""
+    objs = await fetch(queryset[:2], conn)
+    if len(objs) > 1:
+        raise queryset.model.MultipleObjectsReturned
+    return objs[0] if objs else None
+
+
+async def insert(obj, conn):
+    """INSERT a new model instance and set its primary key, like a first obj.save()."""
+    meta = obj._meta
+    fields = [f for f in meta.local_concrete_fields if not f.generated and f is not meta.auto_field]
+    query = InsertQuery(type(obj))
+    query.insert_values(fields, [obj])
+    compiler = query.get_compiler(using=DEFAULT_DB_ALIAS)
+    compiler.returning_fields = meta.db_returning_fields
+    [(sql, params)] = compiler.as_sql()
+    row = await (await conn.execute(sql, params)).fetchone()
+    for field, value in zip(meta.db_returning_fields, row):
+        setattr(obj, field.attname, value)
+    obj._state.adding = False
+    obj._state.db = DEFAULT_DB_ALIAS
+    return obj
+
+
+async def increment(conn, model, pk, field_name, amount=1):
+    """Add `amount` to a column of one row and return the new value, or None if there is no such row."""
+    meta = model._meta
+    column = meta.get_field(field_name).column
+    quote = connections[DEFAULT_DB_ALIAS].ops.quote_name
+    cursor = await conn.execute(
+        f'UPDATE {quote(meta.db_table)} SET {quote(column)} = {quote(column)} + %s '
+        f'WHERE {quote(meta.pk.column)} = %s RETURNING {quote(column)}',
+        (amount, pk),
+    )
+    row = await cursor.fetchone()
+    return row[0] if row else None
+
+
+def pool_stats():
+    """psycopg_pool statistics of Django's sync pool and of the async pools, summed per kind."""
+    stats = {}
+    sync_pool = connections[DEFAULT_DB_ALIAS].pool if connections[DEFAULT_DB_ALIAS].vendor == 'postgresql' else None
+    if sync_pool is not None:
+        stats['sync'] = sync_pool.get_stats()
+    for loop, pool in list(_pools.items()):
+        if loop.is_closed():
+            continue
+        totals = stats.setdefault('async', {})
+        for key, value in pool.get_stats().items():
+            totals[key] = totals.get(key, 0) + value
+    return stats
+
+
+# psycopg_pool statistic: (metric, type, help)
+POOL_METRICS = {
+    'pool_min': ('db_pool_min_connections', 'gauge', "Configured minimum pool size"),
+    'pool_max': ('db_pool_max_connections', 'gauge', "Configured maximum pool size"),
+    'pool_size': ('db_pool_connections', 'gauge', "Connections held by the pool, idle or in use"),
+    'pool_available': ('db_pool_idle_connections', 'gauge', "Idle connections in the pool"),
+    'requests_waiting': ('db_pool_requests_waiting', 'gauge', "Requests waiting for a connection"),
+    'requests_num': ('db_pool_requests_total', 'counter', "Connection requests"),
+    'requests_queued': ('db_pool_requests_queued_total', 'counter', "Connection requests that had to wait"),
+    'requests_errors': ('db_pool_requests_errors_total', 'counter', "Connection requests that failed or timed out"),
+    'connections_num': ('db_pool_connections_opened_total', 'counter', "Connections opened by the pool"),
+    'connections_lost': ('db_pool_connections_lost_total', 'counter', "Connections found broken"),
+}
+
+
+@metrics.registry.register_collector
+def collect_metrics():
+    stats = pool_stats()
+    if not stats:
+        return
+    for key, (name, kind, documentation) in POOL_METRICS.items():
+        yield f'# HELP {name} {documentation}'
+        yield f'# TYPE {name} {kind}'
+        for pool, values in stats.items():
+            yield metrics.format_sample(name, (('pool', pool),), values.get(key, 0))
+
+    yield '# HELP db_pool_wait_seconds_total Time connection requests spent waiting'
+    yield '# TYPE db_pool_wait_seconds_total counter'
+    for pool, values in stats.items():
+        yield metrics.format_sample('db_pool_wait_seconds_total', (('pool', pool),), values.get('requests_wait_ms', 0) / 1000)
+    yield '# HELP db_pool_utilization Share of the maximum pool size in use'
+    yield '# TYPE db_pool_utilization gauge'
+    for pool, values in stats.items():
+        in_use = values.get('pool_size', 0) - values.get('pool_available', 0)
+        yield metrics.format_sample('db_pool_utilization', (('pool', pool),), in_use / max(values.get('pool_max', 0), 1))
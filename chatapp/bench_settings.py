@@ -0,0 +1,64 @@
+"""
+Settings for `manage.py bench_chat`.
+
+By default the benchmarks run against SQLite and the in-memory channel layer,
+so they need nothing but the Python dependencies. Set BENCH_POSTGRES=1 to use
+the Postgres database from the regular settings (a throwaway test database is
+created on it) and BENCH_REDIS=1 to use Redis for the channel layer, caches,
+hot history, presence, token revocation and the lobby backlog (with the
+CHANNEL_LAYER_MODE and CHANNEL_LAYER_HOSTS channel layer). Without it nothing
+talks to Redis.
+
+    DJANGO_SETTINGS_MODULE=chatapp.bench_settings python manage.py bench_chat
+"""
+import os
+from chatapp.settings import *  # noqa: F401,F403
+from chatapp.settings import CHANNEL_LAYER_BACKENDS, CHANNEL_LAYER_HOSTS, CHANNEL_LAYER_MODE
+
+BENCH_POSTGRES = os.environ.get('BENCH_POSTGRES') == '1'
+BENCH_REDIS = os.environ.get('BENCH_REDIS') == '1'
+
+if not BENCH_POSTGRES:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+    }
+
+if BENCH_REDIS:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER_MODE],
+            'CONFIG': {
+                'hosts': CHANNEL_LAYER_HOSTS,
+                'capacity': 10000,
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                'capacity': 10000,
+            },
+        },
+    }
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+    CHAT_HOT_HISTORY_ENABLED = False
+    CHAT_PRESENCE_ENABLED = False
+    CONNECTION_CACHE = {**CONNECTION_CACHE, 'SHARED': False}
+    AUTH_TOKEN_REVOCATION_ENABLED = False
+    CHAT_LOBBY_BACKLOG = 0
+
+# Seeded users get unusable passwords; skip the deliberately slow hasher anyway.
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+# Fan-out runs send every message from a single client as fast as it can.
+CHAT_RATE_LIMIT_RATE = 1_000_000
+CHAT_RATE_LIMIT_BURST = 1_000_000
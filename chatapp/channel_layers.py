@@ -0,0 +1,89 @@
+"""
+Channel layers that spread groups and channels over several Redis nodes with
+a consistent hash ring.
+
+channels_redis already shards by host, but maps names to hosts with a fixed
+split of the CRC space, so adding a node moves most room groups (and cuts
+off their subscribers) at once. On a ring with virtual nodes a new node only
+takes over about 1/N of the names. With a single host both layers behave
+exactly like the stock ones.
+
+    CHANNEL_LAYERS = {'default': {
+        'BACKEND': 'chatapp.channel_layers.ShardedRedisPubSubChannelLayer',
+        'CONFIG': {'hosts': ['redis://redis-1:6379', 'redis://redis-2:6379']},
+    }}
+"""
+import asyncio
+import bisect
+import functools
+import hashlib
+from channels_redis.core import RedisChannelLayer
+from channels_redis.pubsub import RedisPubSubChannelLayer, RedisPubSubLoopLayer
+from channels_redis.utils import _wrap_close, decode_hosts
+
+
+def node_name(host):
+    """Stable identity of a decoded host entry, so ring positions survive reordering."""
+    if 'address' in host:
+        return str(host['address'])
+    return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}"
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=160):
+        points = []
+        for index, node in enumerate(nodes):
+            for replica in range(replicas):
+                points.append((self.hash(f'{node}#{replica}'), index))
+        points.sort()
+        self.keys = [key for key, _ in points]
+        self.indexes = [index for _, index in points]
+        self.size = len(nodes)
+
+    @staticmethod
+    def hash(value):
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+    @functools.lru_cache(maxsize=65536)
+    def get(self, name):
+        """Index of the node that owns `name`."""
+        if self.size == 1:
+            return 0
+        position = bisect.bisect(self.keys, self.hash(name)) % len(self.keys)
+        return self.indexes[position]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """The list-based channels_redis layer with groups and channels placed on a hash ring."""
+
+    def __init__(self, hosts=None, *args, replicas=160, **kwargs):
+        super().__init__(hosts, *args, **kwargs)
+        self.ring = HashRing([node_name(host) for host in self.hosts], replicas)
+
+    def consistent_hash(self, value):
+        return self.ring.get(value)
+
+
+class ShardedRedisPubSubLoopLayer(RedisPubSubLoopLayer):
+    def __init__(self, hosts=None, *args, replicas=160, **kwargs):
+        super().__init__(hosts, *args, **kwargs)
+        self.ring = HashRing([node_name(host) for host in decode_hosts(hosts)], replicas)
+
+    def _get_shard(self, channel_or_group_name):
+        return self._shards[self.ring.get(channel_or_group_name)]
+
+
+class ShardedRedisPubSubChannelLayer(RedisPubSubChannelLayer):
+    """The pub/sub channels_redis layer with groups and channels placed on a hash ring."""
+
+    def _get_layer(self):
+        loop = asyncio.get_running_loop()
+        try:
+            layer = self._layers[loop]
+        except KeyError:
+            layer = ShardedRedisPubSubLoopLayer(*self._args, **self._kwargs, channel_layer=self)
+            self._layers[loop] = layer
+            _wrap_close(self, loop)
+        return layer
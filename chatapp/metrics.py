@@ -0,0 +1,318 @@
+"""
+In-process metrics served in the Prometheus text format at /metrics, to
+scrapers with METRICS_TOKEN or from METRICS_ALLOWED_NETWORKS.
+
+Metrics are plain counters, gauges and fixed-bucket histograms guarded by a
+lock each, cheap enough to stay on in production. Every worker process keeps
+its own values; Prometheus scrapes and sums them per instance.
+"""
+import functools
+import hmac
+import ipaddress
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from channels.db import database_sync_to_async as channels_database_sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+
+
+def format_sample(name, labels, value):
+    return f'{name}{format_labels(labels)} {value}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self.new_child())
+        return child
+
+    def remove(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._children.pop(key, None)
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for key, child in list(self._children.items()):
+            yield from child.render(self.name, tuple(zip(self.labelnames, key)))
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, labels):
+        yield format_sample(name, labels, self.value)
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield format_sample(f'{name}_bucket', labels + (('le', bound),), cumulative)
+        cumulative += self.counts[-1]
+        yield format_sample(f'{name}_bucket', labels + (('le', '+Inf'),), cumulative)
+        yield format_sample(f'{name}_sum', labels, self.sum)
+        yield format_sample(f'{name}_count', labels, cumulative)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(f'{name}_total', documentation, labelnames)
+
+    def new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc_labels(self, **labels):
+        """Increment the child for `labels`; pair with dec_labels()."""
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._children.setdefault(key, self.new_child()).inc()
+
+    def dec_labels(self, **labels):
+        """
+        Decrement the child for `labels` and drop it at 0, so labels that come
+        and go (rooms, say) do not pile up as series stuck at 0.
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                return
+            child.dec()
+            if child.value <= 0:
+                del self._children[key]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def register_collector(self, collector):
+        """`collector` is a callable yielding exposition lines, called on every scrape."""
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+CHAT_STAGE_SECONDS = Histogram(
+    'chat_stage_seconds', "Time spent in each stage of the chat consumers", ['stage'])
+CHAT_ACTIVE_CONNECTIONS = Gauge(
+    'chat_active_connections', "Open chat sockets per room", ['room'])
+CHAT_MESSAGES_RECEIVED = Counter(
+    'chat_messages_received', "Chat messages received from clients")
+CHAT_MESSAGES_SENT = Counter(
+    'chat_messages_sent', "Chat messages written to client sockets")
+CHANNEL_LAYER_SECONDS = Histogram(
+    'chat_channel_layer_seconds', "Channel layer call latency", ['operation'])
+DB_CALLS_IN_FLIGHT = Gauge(
+    'chat_db_calls_in_flight', "Database calls submitted to the sync thread pool and not finished yet")
+DB_CALL_WAIT_SECONDS = Histogram(
+    'chat_db_call_wait_seconds', "Time database calls wait for a sync thread")
+DB_CALL_SECONDS = Histogram(
+    'chat_db_call_seconds', "Time database calls run on a sync thread")
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_seconds', "HTTP request latency", ['method', 'route'])
+HTTP_DB_QUERIES = Histogram(
+    'http_db_queries', "Database queries per HTTP request", ['method', 'route'], buckets=COUNT_BUCKETS)
+
+
+def timed(stage):
+    """Record the duration of an async consumer method as a chat stage."""
+    histogram = CHAT_STAGE_SECONDS.labels(stage=stage)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def database_sync_to_async(func):
+    """
+    Drop-in for channels' database_sync_to_async that also records how long
+    the call waited for a thread, how long it ran and how many calls are
+    queued or running, i.e. the saturation of the sync thread pool.
+    """
+    def run(submitted_at, *args, **kwargs):
+        started_at = time.perf_counter()
+        DB_CALL_WAIT_SECONDS.observe(started_at - submitted_at)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_CALL_SECONDS.observe(time.perf_counter() - started_at)
+
+    run_in_thread = channels_database_sync_to_async(run)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        DB_CALLS_IN_FLIGHT.inc()
+        try:
+            return await run_in_thread(time.perf_counter(), *args, **kwargs)
+        finally:
+            DB_CALLS_IN_FLIGHT.dec()
+    return wrapper
+
+
+class QueryCountMiddleware:
+    """Record latency and the number of database queries of every HTTP request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = [0]
+
+        def count(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(count):
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        labels = {'method': request.method, 'route': match.route if match else 'unmatched'}
+        HTTP_REQUEST_SECONDS.labels(**labels).observe(time.perf_counter() - start)
+        HTTP_DB_QUERIES.labels(**labels).observe(queries[0])
+        return response
+
+
+def scrape_allowed(request):
+    """Scrapes come with METRICS_TOKEN as a bearer token, or from METRICS_ALLOWED_NETWORKS."""
+    if settings.METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if hmac.compare_digest(authorization.encode(), f'Bearer {settings.METRICS_TOKEN}'.encode()):
+            return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network) for network in settings.METRICS_ALLOWED_NETWORKS)
+
+
+def metrics_view(request):
+    if not scrape_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,25 @@
+import asyncio
+import weakref
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_sync_client = None
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    """Synchronous client, for views, signals and management commands."""
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = redis.Redis.from_url(settings.REDIS_URL)
+    return _sync_client
+
+
+def get_async_redis():
+    """asyncio client for consumers; connections are bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = redis.asyncio.Redis.from_url(settings.REDIS_URL)
+    return client
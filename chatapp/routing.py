@@ -1,9 +1,11 @@
 from django.urls import re_path
 from chatrooms.consumers.ChatRoomConsumer import ChatConsumer
+from chatrooms.consumers.MultiplexConsumer import MultiplexConsumer
 from chatrooms.consumers.RoomConsumer import RoomConsumer
 
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_id>\w+)/$', ChatConsumer.as_asgi()),
     re_path(r'ws/rooms/$', RoomConsumer.as_asgi()),
+    re_path(r'ws/multiplex/$', MultiplexConsumer.as_asgi()),
 ]
\ No newline at end of file
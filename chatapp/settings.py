@@ -24,6 +24,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     # Third-party apps
     'rest_framework',
@@ -38,6 +39,7 @@ INSTALLED_APPS = [
 CORS_ALLOW_ALL_ORIGINS = True
 
 MIDDLEWARE = [
+    'chatapp.metrics.QueryCountMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -49,6 +51,13 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# /metrics answers requests from these networks, and requests with
+# "Authorization: Bearer <METRICS_TOKEN>" from anywhere when a token is set.
+METRICS_ALLOWED_NETWORKS = os.environ.get(
+    'METRICS_ALLOWED_NETWORKS', '127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16'
+).split(',')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 ROOT_URLCONF = 'chatapp.urls'
 
 TEMPLATES = [
@@ -73,20 +82,177 @@ ASGI_APPLICATION = 'chatapp.asgi.application'
 
 REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
 
+# Application data kept in Redis (caches, hot history) lives in its own
+# database, apart from the channel layer.
+REDIS_URL = os.environ.get('REDIS_URL', f'redis://{REDIS_HOST}:6379/1')
+
+# Channel layer: 'core' is the list-based channels_redis layer, 'pubsub' the
+# lower-latency pub/sub one (no buffering for busy or absent consumers). With
+# several CHANNEL_LAYER_HOSTS groups and channels are spread over them with a
+# consistent hash ring.
+CHANNEL_LAYER_MODE = os.environ.get('CHANNEL_LAYER_MODE', 'core')
+CHANNEL_LAYER_HOSTS = [
+    f'redis://{host}' for host in os.environ.get('CHANNEL_LAYER_HOSTS', f'{REDIS_HOST}:6379').split(',')
+]
+CHANNEL_LAYER_BACKENDS = {
+    'core': 'chatapp.channel_layers.ShardedRedisChannelLayer',
+    'pubsub': 'chatapp.channel_layers.ShardedRedisPubSubChannelLayer',
+}
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER_MODE],
         'CONFIG': {
-            'hosts': [(REDIS_HOST, 6379)],
+            'hosts': CHANNEL_LAYER_HOSTS,
         },
     },
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    },
+}
+
+# Users, rooms and room memberships looked up when a chat socket connects.
+# The local tier is per process; with SHARED, a Redis tier sits behind it and
+# changes reach the local tier of every process through Redis pub/sub. The
+# local TTL bounds how stale an entry can get while Redis is unreachable.
+CONNECTION_CACHE = {
+    'LOCAL_TTL': 5,
+    'LOCAL_MAXSIZE': 10000,
+    'SHARED': True,
+    'SHARED_TTL': 300,
+}
+
+# Room listing: page size and how long a cached page may be served. Cached
+# pages are also invalidated by room and membership changes.
+ROOM_LIST_PAGE_SIZE = 50
+ROOM_LIST_CACHE_TTL = 300
+
+# Username search: page sizes, and the longest query whose first page is
+# cached (short prefixes are the most common and the most expensive).
+USER_SEARCH_PAGE_SIZE = 20
+USER_SEARCH_MAX_PAGE_SIZE = 100
+USER_SEARCH_CACHE_PREFIX_LENGTH = 3
+USER_SEARCH_CACHE_TTL = 300
+
+# Chat history pagination
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+# History and resume queries first look at the last CHAT_HISTORY_HOT_DAYS
+# only, so on partitioned storage they touch just the newest partitions, and
+# query all of history when that does not fill the page. None disables this.
+CHAT_HISTORY_HOT_DAYS = 31
+
+# Read pointers reported over chat sockets are written at most this often (seconds)
+CHAT_READ_POINTER_FLUSH_INTERVAL = 2
+
+# Lobby events kept in Redis for sockets resuming from an event id; with 0
+# events are not numbered or kept, and sockets cannot resume
+CHAT_LOBBY_BACKLOG = 1000
+
+# chat.msgpack-deflate.v1 sockets get frames of CHAT_DEFLATE_MIN_BYTES or more
+# (as MessagePack) deflated at CHAT_DEFLATE_LEVEL
+CHAT_DEFLATE_MIN_BYTES = 1024
+CHAT_DEFLATE_LEVEL = 6
+
+# Message search
+CHAT_SEARCH_PAGE_SIZE = 20
+CHAT_SEARCH_MAX_PAGE_SIZE = 100
+CHAT_SEARCH_SNIPPET_FRAGMENTS = 2
+CHAT_SEARCH_SNIPPET_WORDS = 15
+
+# Message storage lifecycle, run by `manage.py maintain_chat_storage`.
+# Messages older than the retention of their room type (in days) are deleted;
+# None keeps them. On PostgreSQL, monthly ChatMessage partitions are created
+# CHAT_PARTITION_PREMAKE_MONTHS ahead, and with CHAT_ARCHIVE_AFTER_MONTHS set
+# partitions older than that are written to CHAT_ARCHIVE_DIR and dropped.
+CHAT_MESSAGE_RETENTION_DAYS = {
+    'public': None,
+    'private': None,
+    'one-to-one': None,
+}
+CHAT_RETENTION_BATCH_SIZE = 5000
+CHAT_PARTITION_PREMAKE_MONTHS = 3
+CHAT_ARCHIVE_AFTER_MONTHS = None
+CHAT_ARCHIVE_DIR = os.environ.get('CHAT_ARCHIVE_DIR', os.path.join(BASE_DIR, 'archive'))
+CHAT_ARCHIVE_BATCH_SIZE = 2000
+
+# Room history exports (chatrooms.export) fetch and write this many messages at
+# a time; imports insert this many per COPY (or bulk_create) and commit
+CHAT_EXPORT_CHUNK_SIZE = 2000
+CHAT_IMPORT_BATCH_SIZE = 5000
+
+# Chat message persistence: 'sync' saves every message before it is broadcast.
+# 'write_behind' only reserves the message's seq, broadcasts it at once (with
+# an "id" of null) and queues it; queued messages are inserted in batches of
+# up to CHAT_PERSIST_BATCH_SIZE, at least every CHAT_PERSIST_FLUSH_INTERVAL
+# seconds. Senders get an error while CHAT_PERSIST_MAX_PENDING messages are
+# waiting, e.g. when the database is down. Messages still queued when a worker
+# dies are lost, and a client resuming while other workers still hold
+# messages of the room can miss them.
+CHAT_PERSISTENCE_MODE = os.environ.get('CHAT_PERSISTENCE_MODE', 'sync')
+CHAT_PERSIST_BATCH_SIZE = 200
+CHAT_PERSIST_FLUSH_INTERVAL = 0.05
+CHAT_PERSIST_MAX_PENDING = 10000
+
+# Outbound flow control per chat socket. When more than CHAT_OUTBOUND_QUEUE_SIZE
+# frames are waiting for a client, 'drop_oldest' drops the oldest one and
+# 'coalesce' does too, but also sends waiting frames to batch-protocol clients
+# as a single frame. 'disconnect' instead closes the socket once the oldest
+# waiting frame is older than CHAT_OUTBOUND_MAX_LAG seconds or the queue is full.
+# Connections lagging by CHAT_LAG_REPORT_THRESHOLD seconds or more show up in
+# the chat_connection_lag_seconds metric. Under any policy a socket is closed
+# when the server takes more than CHAT_OUTBOUND_SEND_TIMEOUT seconds to accept
+# one frame. Servers that wait for the client to drain its socket (uvicorn)
+# make that the client's pace; Daphne accepts frames at once, so under Daphne
+# this only catches a lagging event loop (see chatrooms.flow_control).
+CHAT_OUTBOUND_POLICY = os.environ.get('CHAT_OUTBOUND_POLICY', 'drop_oldest')
+CHAT_OUTBOUND_QUEUE_SIZE = 256
+CHAT_OUTBOUND_MAX_LAG = 10
+CHAT_OUTBOUND_SEND_TIMEOUT = 30
+CHAT_LAG_REPORT_THRESHOLD = 1
+
+# Inbound chat messages per user and worker: sustained rate per second and burst
+CHAT_RATE_LIMIT_RATE = 5
+CHAT_RATE_LIMIT_BURST = 20
+
+# Clients reconnecting with the last seq they saw get the messages they missed,
+# unless that is more than this many; then they are told to reload history.
+CHAT_RESUME_MAX_GAP = 500
+
+# Presence (who is online, kept in Redis) and typing indicators. Changes are
+# broadcast to rooms in batches every CHAT_PRESENCE_TICK seconds; each worker
+# refreshes its users every CHAT_PRESENCE_HEARTBEAT seconds and users of a
+# worker that stopped doing so go offline after CHAT_PRESENCE_TTL.
+CHAT_PRESENCE_ENABLED = True
+CHAT_PRESENCE_TICK = 0.25
+CHAT_PRESENCE_HEARTBEAT = 10
+CHAT_PRESENCE_TTL = 30
+CHAT_PRESENCE_SNAPSHOT_LIMIT = 1000
+CHAT_TYPING_TIMEOUT = 6
+
+# Rooms a single ws/multiplex/ socket may subscribe to at once
+CHAT_MULTIPLEX_MAX_ROOMS = 100
+
+# Redis ring buffer of the latest serialized messages of each room, used to
+# serve history on connect without querying Postgres. Sizes are per room type;
+# a size below CHAT_HISTORY_PAGE_SIZE disables the buffer for that type.
+CHAT_HOT_HISTORY_ENABLED = True
+CHAT_HOT_HISTORY_SIZES = {
+    'public': 200,
+    'private': 50,
+    'one-to-one': 50,
+}
+CHAT_HOT_HISTORY_TTL = 60 * 60 * 24
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'users.authentication.ClaimsJWTAuthentication',
     )
 }
 
@@ -100,9 +266,28 @@ DATABASES = {
         'PASSWORD': os.environ.get('DB_PASSWORD', 'postgres'),
         'HOST': os.environ.get('DB_HOST', 'db'),
         'PORT': os.environ.get('DB_PORT', '5432'),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # psycopg 3 connection pool shared by the threads of a process
+            'pool': {
+                'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', 2)),
+                'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', 20)),
+                'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+            },
+        },
     }
 }
 
+# Consumers run their hot-path queries (users, rooms, history, new messages)
+# on a separate asyncio pool per event loop instead of the sync thread pool;
+# see chatapp.async_db. Only used with PostgreSQL.
+ASYNC_DB = {
+    'ENABLED': os.environ.get('ASYNC_DB_ENABLED', '1') == '1',
+    'MIN_SIZE': int(os.environ.get('ASYNC_DB_MIN_SIZE', 2)),
+    'MAX_SIZE': int(os.environ.get('ASYNC_DB_MAX_SIZE', 10)),
+    'TIMEOUT': float(os.environ.get('ASYNC_DB_TIMEOUT', 5)),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -125,8 +310,20 @@ AUTH_PASSWORD_VALIDATORS = [
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
+    'TOKEN_OBTAIN_SERIALIZER': 'users.authentication.ChatTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'users.authentication.ChatTokenRefreshSerializer',
+}
+
+# Verified access tokens are cached per process for up to TTL seconds, which
+# is also how long a revoked token can still be accepted by other workers.
+AUTH_TOKEN_CACHE = {
+    'MAXSIZE': 10000,
+    'TTL': 60,
 }
 
+# Logout, deactivation and password changes revoke tokens through Redis
+AUTH_TOKEN_REVOCATION_ENABLED = True
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
 
@@ -142,6 +339,13 @@ USE_TZ = True
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
+# Avatar thumbnails (users.avatars), served at
+# /api/users/avatars/<avatar_version>-<size>.webp
+AVATAR_THUMBNAIL_SIZES = (32, 64, 128)
+AVATAR_THUMBNAIL_WORKERS = 2
+AVATAR_WEBP_QUALITY = 80
+AVATAR_CACHE_MAX_AGE = 365 * 24 * 3600
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
 
@@ -0,0 +1,46 @@
+import os
+import runpy
+from unittest import mock
+from django.test import SimpleTestCase
+from django.utils.module_loading import import_string
+from chatapp import channel_layers
+
+SETTINGS_FILE = os.path.join(os.path.dirname(__file__), 'settings.py')
+
+
+def load_settings(**environ):
+    """The settings module as it would be loaded with `environ` set."""
+    with mock.patch.dict(os.environ, environ):
+        return runpy.run_path(SETTINGS_FILE)
+
+
+class ChannelLayerSettingsTests(SimpleTestCase):
+    def layer(self, **environ):
+        config = load_settings(**environ)['CHANNEL_LAYERS']['default']
+        return import_string(config['BACKEND'])(**config['CONFIG'])
+
+    def test_core_mode_is_the_default(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop('CHANNEL_LAYER_MODE', None)
+            settings = load_settings()
+        self.assertEqual(
+            settings['CHANNEL_LAYERS']['default']['BACKEND'], 'chatapp.channel_layers.ShardedRedisChannelLayer')
+
+    def test_each_mode_resolves_to_its_layer(self):
+        hosts = 'redis-1:6379,redis-2:6380'
+        layer = self.layer(CHANNEL_LAYER_MODE='core', CHANNEL_LAYER_HOSTS=hosts)
+        self.assertIsInstance(layer, channel_layers.ShardedRedisChannelLayer)
+        self.assertEqual(layer.ring.size, 2)
+        layer = self.layer(CHANNEL_LAYER_MODE='pubsub', CHANNEL_LAYER_HOSTS=hosts)
+        self.assertIsInstance(layer, channel_layers.ShardedRedisPubSubChannelLayer)
+        settings = load_settings(CHANNEL_LAYER_MODE='pubsub', CHANNEL_LAYER_HOSTS=hosts)
+        self.assertEqual(
+            settings['CHANNEL_LAYERS']['default']['CONFIG'],
+            {'hosts': ['redis://redis-1:6379', 'redis://redis-2:6380']},
+        )
+
+    def test_hosts_default_to_the_redis_host(self):
+        with mock.patch.dict(os.environ, REDIS_HOST='cache'):
+            os.environ.pop('CHANNEL_LAYER_HOSTS', None)
+            settings = load_settings()
+        self.assertEqual(settings['CHANNEL_LAYERS']['default']['CONFIG'], {'hosts': ['redis://cache:6379']})
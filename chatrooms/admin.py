@@ -1,4 +1,6 @@
 from django.contrib import admin
+from django.db import transaction
+from . import hot_history
 from .models import ChatRoom, ChatMessage
 
 
@@ -8,5 +10,19 @@ class ChatRoomAdmin(admin.ModelAdmin):
     filter_horizontal = ('participants',)
 
 
+class ChatMessageAdmin(admin.ModelAdmin):
+    # Hot history buffers would keep serving deleted messages. Not a
+    # post_delete receiver, which would stop room deletes from removing
+    # their messages in one query.
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        transaction.on_commit(lambda: hot_history.invalidate([obj.room_id]))
+
+    def delete_queryset(self, request, queryset):
+        room_ids = set(queryset.values_list('room_id', flat=True))
+        super().delete_queryset(request, queryset)
+        transaction.on_commit(lambda: hot_history.invalidate(room_ids))
+
+
 admin.site.register(ChatRoom, ChatRoomAdmin)
-admin.site.register(ChatMessage)
+admin.site.register(ChatMessage, ChatMessageAdmin)
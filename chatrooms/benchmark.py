@@ -0,0 +1,261 @@
+"""
+Load scenarios for the chat WebSocket consumers, used by `manage.py bench_chat`.
+
+Scenarios drive the real ASGI application from chatapp.asgi with simulated
+clients (Channels' WebsocketCommunicator), so every connect goes through
+routing, authentication, the connection cache, history loading and the
+channel layer exactly as in production.
+"""
+import asyncio
+import json
+import statistics
+import time
+import tracemalloc
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from chatrooms import protocol
+from chatrooms.models import ChatMessage, ChatRoom
+from users.authentication import tokens_for_user
+
+User = get_user_model()
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize_ms(seconds):
+    values = [value * 1000 for value in seconds]
+    if not values:
+        return {}
+    return {
+        'count': len(values),
+        'mean_ms': round(statistics.fmean(values), 3),
+        'p50_ms': round(percentile(values, 50), 3),
+        'p99_ms': round(percentile(values, 99), 3),
+        'max_ms': round(max(values), 3),
+    }
+
+
+class BenchEnvironment:
+    """Users, tokens and rooms seeded once and shared by all scenarios."""
+
+    def __init__(self, users, history):
+        self.history = history
+        self.users = self.seed_users(users)
+        self.tokens = [str(tokens_for_user(user).access_token) for user in self.users]
+
+    @staticmethod
+    def seed_users(count):
+        existing = User.objects.filter(username__startswith='bench-').count()
+        User.objects.bulk_create([
+            User(username=f'bench-{index}', email=f'bench-{index}@example.com', password='!')
+            for index in range(existing, count)
+        ], batch_size=1000)
+        return list(User.objects.filter(username__startswith='bench-').order_by('id')[:count])
+
+    def create_room(self, title):
+        room = ChatRoom.objects.create(title=title, owner=self.users[0], room_type='public')
+        ChatMessage.objects.bulk_create([
+            ChatMessage(room=room, user=self.users[index % len(self.users)], content=f'history message {index}',
+                        seq=index + 1)
+            for index in range(self.history)
+        ], batch_size=1000)
+        ChatRoom.objects.filter(id=room.id).update(last_seq=self.history)
+        return room
+
+
+class BenchClient:
+    def __init__(self, application, path, token, subprotocol=protocol.BATCHED_HISTORY):
+        self.communicator = WebsocketCommunicator(application, path, subprotocols=[subprotocol, token])
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        if not connected:
+            raise RuntimeError("Benchmark client was refused")
+
+    async def receive(self, timeout):
+        return await self.communicator.receive_from(timeout=timeout)
+
+    async def send(self, data):
+        await self.communicator.send_to(text_data=json.dumps(data))
+
+    async def drain(self, quiet):
+        """Receive frames until none arrives for `quiet` seconds; returns them."""
+        frames = []
+        while not await self.communicator.receive_nothing(timeout=quiet):
+            frames.append(await self.communicator.receive_from())
+        return frames
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+async def connect_clients(application, env, room, size, timeout):
+    """
+    Connect `size` clients concurrently and wait for each one's history frame.
+    Returns the clients and the connect/history timings.
+    """
+    clients = [BenchClient(application, f'/ws/chat/{room.id}/', token) for token in env.tokens[:size]]
+    connect_times, history_times = [], []
+
+    async def connect(client):
+        start = time.perf_counter()
+        await client.connect(timeout)
+        connected = time.perf_counter()
+        await client.receive(timeout)
+        connect_times.append(connected - start)
+        history_times.append(time.perf_counter() - connected)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in clients))
+    elapsed = time.perf_counter() - start
+    return clients, {
+        'connects_per_sec': round(size / elapsed, 1),
+        'connect_latency': summarize_ms(connect_times),
+        'history_load_latency': summarize_ms(history_times),
+    }
+
+
+async def close_clients(clients):
+    await asyncio.gather(*(client.close() for client in clients))
+
+
+@scenario('connect')
+async def connect_scenario(application, env, size, options):
+    room = await database_sync_to_async(env.create_room)(f'bench connect {size}')
+    clients, metrics = await connect_clients(application, env, room, size, options['timeout'])
+    await close_clients(clients)
+    return metrics
+
+
+@scenario('fanout')
+async def fanout_scenario(application, env, size, options):
+    """
+    One client sends `messages` chat messages into a room of `size` clients;
+    every client (the sender included) must receive every message.
+    """
+    room = await database_sync_to_async(env.create_room)(f'bench fanout {size}')
+    clients, _ = await connect_clients(application, env, room, size, options['timeout'])
+    messages = options['messages']
+    latencies = []
+
+    async def drain(client):
+        received = 0
+        while received < messages:
+            frame = json.loads(await client.receive(options['timeout']))
+            if frame.get('type') == 'presence':
+                continue
+            sent_at = float(frame['message'].split(' ', 1)[1])
+            latencies.append(time.perf_counter() - sent_at)
+            received += 1
+
+    receivers = [asyncio.create_task(drain(client)) for client in clients]
+    start = time.perf_counter()
+    for index in range(messages):
+        await clients[0].send({'message': f'{index} {time.perf_counter()}'})
+    await asyncio.gather(*receivers)
+    elapsed = time.perf_counter() - start
+    await close_clients(clients)
+
+    return {
+        'messages_sent_per_sec': round(messages / elapsed, 1),
+        'deliveries_per_sec': round(messages * size / elapsed, 1),
+        'delivery_latency': summarize_ms(latencies),
+    }
+
+
+@scenario('typing')
+async def typing_scenario(application, env, size, options):
+    """
+    Every client of a room of `size` sends `messages` typing signals and then
+    stops typing. Delivered one by one, each client would receive every other
+    client's signals; reports the coalesced frames they actually received.
+    """
+    room = await database_sync_to_async(env.create_room)(f'bench typing {size}')
+    clients, _ = await connect_clients(application, env, room, size, options['timeout'])
+    quiet = settings.CHAT_PRESENCE_TICK * 4
+    # Presence snapshots and the joins of everyone else
+    await asyncio.gather(*(client.drain(quiet) for client in clients))
+
+    start = time.perf_counter()
+    for _ in range(options['messages']):
+        await asyncio.gather(*(client.send({'action': 'typing'}) for client in clients))
+    await asyncio.gather(*(client.send({'action': 'stop_typing'}) for client in clients))
+    received = await asyncio.gather(*(client.drain(quiet) for client in clients))
+    elapsed = time.perf_counter() - start - quiet
+    await close_clients(clients)
+
+    frames = [len(frames) for frames in received]
+    return {
+        'typing_signals': size * options['messages'],
+        'uncoalesced_frames_per_client': size * options['messages'],
+        'frames_per_client': round(statistics.fmean(frames), 1),
+        'max_frames_per_client': max(frames),
+        'elapsed_ms': round(elapsed * 1000, 3),
+    }
+
+
+@scenario('multiplex')
+async def multiplex_scenario(application, env, size, options):
+    """
+    One user following `size` rooms, first with a socket per room and then
+    with a single multiplexed socket subscribed to all of them. Reports the
+    time until every room's history arrived and the memory allocated (server
+    and simulated clients together) while the connections are open.
+    """
+    rooms = [
+        await database_sync_to_async(env.create_room)(f'bench multiplex {size} {index}')
+        for index in range(size)
+    ]
+    token, timeout = env.tokens[0], options['timeout']
+
+    async def per_room():
+        clients = [BenchClient(application, f'/ws/chat/{room.id}/', token) for room in rooms]
+
+        async def connect(client):
+            await client.connect(timeout)
+            await client.receive(timeout)
+
+        await asyncio.gather(*(connect(client) for client in clients))
+        return clients
+
+    async def multiplexed():
+        client = BenchClient(application, '/ws/multiplex/', token)
+        await client.connect(timeout)
+        for room in rooms:
+            await client.send({'action': 'subscribe', 'room': room.id})
+        for _ in rooms:
+            await client.receive(timeout)
+        return [client]
+
+    results = {}
+    for name, open_connections in (('per_room', per_room), ('multiplexed', multiplexed)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        clients = await open_connections()
+        elapsed = time.perf_counter() - start
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        await close_clients(clients)
+        results[name] = {
+            'sockets': len(clients),
+            'history_loaded_ms': round(elapsed * 1000, 3),
+            'memory_kb': round(memory / 1024, 1),
+        }
+    return results
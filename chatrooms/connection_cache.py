@@ -0,0 +1,313 @@
+"""
+Cache of the records ChatConsumer needs to accept a connection: users, rooms
+and the participant ids of each room.
+
+Lookups go through an in-process TTL/LRU tier first, then a shared tier in
+Redis, then Postgres (on the event loop when chatapp.async_db is enabled, in
+a database thread otherwise). Model signals (see chatrooms.signals)
+invalidate an entry in the shared tier and publish the invalidation, and
+every process serving sockets drops the entry from its local tier when it
+hears it. The short local TTL only bounds staleness while Redis is down.
+Values loaded while their key was being invalidated are not cached (see
+ConnectionCache).
+"""
+import asyncio
+import logging
+import pickle
+import threading
+from django.conf import settings
+from redis.exceptions import RedisError
+from chatapp import async_db, metrics
+from chatapp.metrics import database_sync_to_async
+from chatapp.redis_client import get_async_redis, get_redis
+from django.contrib.auth import get_user_model
+from chatapp.cache import MISSING, TTLCache
+from chatrooms.models import ChatRoom
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'conn:invalidate'
+
+
+class ConnectionCache:
+    """
+    A loader may read a row just before a change to it commits, and finish
+    after the change has been invalidated. So that it cannot put the old
+    value back, every key has a generation in Redis that invalidate() bumps,
+    and a value is stored in the shared tier with the generation read before
+    loading it; entries of an older generation are misses. The local tier
+    does the same with an epoch per cache.
+    """
+
+    def __init__(self, name, loader, aloader=None):
+        self.name = name
+        self.loader = loader
+        self.aloader = aloader
+        self.local = TTLCache(settings.CONNECTION_CACHE['LOCAL_MAXSIZE'], settings.CONNECTION_CACHE['LOCAL_TTL'])
+        self.epoch = 0
+        self._epoch_lock = threading.Lock()
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    @property
+    def shared_enabled(self):
+        return settings.CONNECTION_CACHE['SHARED']
+
+    def shared_key(self, key):
+        return f'conn:{self.name}:{key}'
+
+    def generation_key(self, key):
+        return f'conn:{self.name}:{key}:gen'
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not MISSING:
+            return value
+        return self._load(key)
+
+    async def aget(self, key):
+        value = self.local.get(key)
+        if value is not MISSING:
+            return value
+        listener.ensure_started()
+        if self.aloader is None or not async_db.is_enabled():
+            return await database_sync_to_async(self._load)(key)
+
+        epoch = self.epoch
+        generation = MISSING
+        if self.shared_enabled:
+            try:
+                entry, generation = await get_async_redis().mget(self.shared_key(key), self.generation_key(key))
+            except RedisError as e:
+                logger.warning(f"Shared {self.name} cache unavailable: {e}")
+            else:
+                value = self._shared_hit(key, entry, generation, epoch)
+                if value is not MISSING:
+                    return value
+        # A primary key lookup on a pooled async connection, without the thread hop
+        value = await self.aloader(key)
+        self._set_local(key, value, epoch)
+        if generation is not MISSING:
+            try:
+                await get_async_redis().set(
+                    self.shared_key(key), self._dumps(value, generation), ex=settings.CONNECTION_CACHE['SHARED_TTL'])
+            except RedisError as e:
+                logger.warning(f"Shared {self.name} cache unavailable: {e}")
+        return value
+
+    def _load(self, key):
+        epoch = self.epoch
+        generation = MISSING
+        if self.shared_enabled:
+            try:
+                entry, generation = get_redis().mget(self.shared_key(key), self.generation_key(key))
+            except RedisError as e:
+                logger.warning(f"Shared {self.name} cache unavailable: {e}")
+            else:
+                value = self._shared_hit(key, entry, generation, epoch)
+                if value is not MISSING:
+                    return value
+
+        value = self.loader(key)
+        self._set_local(key, value, epoch)
+        if generation is not MISSING:
+            try:
+                get_redis().set(
+                    self.shared_key(key), self._dumps(value, generation), ex=settings.CONNECTION_CACHE['SHARED_TTL'])
+            except RedisError as e:
+                logger.warning(f"Shared {self.name} cache unavailable: {e}")
+        return value
+
+    @staticmethod
+    def _dumps(value, generation):
+        # The value is wrapped so that a cached None ("does not exist") can be
+        # told apart from a miss
+        return pickle.dumps((generation, value))
+
+    def _shared_hit(self, key, entry, generation, epoch):
+        """The value of a shared tier entry, or MISSING when there is none of the current generation."""
+        if entry is not None:
+            entry_generation, value = pickle.loads(entry)
+            if entry_generation == generation:
+                self.shared_hits += 1
+                self._set_local(key, value, epoch)
+                return value
+        self.shared_misses += 1
+        return MISSING
+
+    def _set_local(self, key, value, epoch):
+        # Unless an invalidation came in while the value was being loaded
+        with self._epoch_lock:
+            if self.epoch == epoch:
+                self.local.set(key, value)
+
+    def forget_local(self, key=MISSING):
+        """Drop a key, or every key, from the local tier."""
+        with self._epoch_lock:
+            self.epoch += 1
+            if key is MISSING:
+                self.local.clear()
+            else:
+                self.local.delete(key)
+
+    def invalidate(self, key):
+        self.forget_local(key)
+        if not self.shared_enabled:
+            return
+        generation_key = self.generation_key(key)
+        try:
+            with get_redis().pipeline(transaction=False) as pipe:
+                pipe.incr(generation_key)
+                # Outlives the entries a loader could still store under the
+                # old generation
+                pipe.expire(generation_key, 2 * settings.CONNECTION_CACHE['SHARED_TTL'])
+                pipe.delete(self.shared_key(key))
+                pipe.publish(INVALIDATION_CHANNEL, f'{self.name}:{key}')
+                pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Shared {self.name} cache unavailable: {e}")
+
+    def stats(self):
+        return {
+            'local': self.local.stats(),
+            'shared': {'hits': self.shared_hits, 'misses': self.shared_misses},
+        }
+
+
+class InvalidationListener:
+    """
+    Drops local entries invalidated by other processes. Runs on the event
+    loop of the process's sockets, started by their first cache miss.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._task = None
+
+    def ensure_started(self):
+        if not settings.CONNECTION_CACHE['SHARED']:
+            return
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                async with get_async_redis().pubsub() as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    # Invalidations published before now were missed
+                    for cache in CACHES:
+                        cache.forget_local()
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self.handle(message['data'].decode())
+            except RedisError as e:
+                logger.warning(f"Connection cache invalidations unavailable: {e}")
+                await asyncio.sleep(settings.CONNECTION_CACHE['LOCAL_TTL'])
+
+    @staticmethod
+    def handle(data):
+        name, _, key = data.partition(':')
+        for cache in CACHES:
+            if cache.name == name:
+                cache.forget_local(int(key))
+
+
+listener = InvalidationListener()
+
+
+def load_user(user_id):
+    User = get_user_model()
+    try:
+        return User.objects.get(id=user_id)
+    except User.DoesNotExist:
+        return None
+
+
+def load_room(room_id):
+    try:
+        return ChatRoom.objects.get(id=room_id)
+    except (ChatRoom.DoesNotExist, ValueError):
+        return None
+
+
+def load_participant_ids(room_id):
+    return frozenset(ChatRoom.participants.through.objects.filter(chatroom_id=room_id).values_list('customuser_id', flat=True))
+
+
+async def aload_user(user_id):
+    return await async_db.get(get_user_model().objects.filter(id=user_id))
+
+
+async def aload_room(room_id):
+    return await async_db.get(ChatRoom.objects.filter(id=room_id))
+
+
+async def aload_participant_ids(room_id):
+    rows = await async_db.fetch_rows(
+        ChatRoom.participants.through.objects.filter(chatroom_id=room_id).values_list('customuser_id'))
+    return frozenset(user_id for user_id, in rows)
+
+
+users = ConnectionCache('user', load_user, aload_user)
+rooms = ConnectionCache('room', load_room, aload_room)
+memberships = ConnectionCache('members', load_participant_ids, aload_participant_ids)
+CACHES = (users, rooms, memberships)
+
+
+async def aget_user(user_id):
+    return await users.aget(int(user_id))
+
+
+async def aget_room(room_id):
+    try:
+        room_id = int(room_id)
+    except (TypeError, ValueError):
+        return None
+    return await rooms.aget(room_id)
+
+
+async def ais_participant(user, room):
+    return user.id in await memberships.aget(room.id)
+
+
+async def acan_join(user, room):
+    # Same rule as ChatRoom.is_accessible_by, answered from the caches
+    if room.room_type == 'public':
+        return True
+    if room.room_type in ('private', 'one-to-one'):
+        return await ais_participant(user, room)
+    return False
+
+
+def invalidate_user(user_id):
+    users.invalidate(user_id)
+
+
+def invalidate_room(room_id):
+    rooms.invalidate(room_id)
+    memberships.invalidate(room_id)
+
+
+def invalidate_membership(room_id):
+    memberships.invalidate(room_id)
+
+
+def stats():
+    return {cache.name: cache.stats() for cache in CACHES}
+
+
+@metrics.registry.register_collector
+def collect_metrics():
+    yield '# HELP chat_connection_cache_lookups_total Connection cache lookups by cache, tier and result'
+    yield '# TYPE chat_connection_cache_lookups_total counter'
+    for cache in CACHES:
+        for tier, hits, misses in (
+            ('local', cache.local.hits, cache.local.misses),
+            ('shared', cache.shared_hits, cache.shared_misses),
+        ):
+            for result, value in (('hit', hits), ('miss', misses)):
+                labels = (('cache', cache.name), ('tier', tier), ('result', result))
+                yield metrics.format_sample('chat_connection_cache_lookups_total', labels, value)
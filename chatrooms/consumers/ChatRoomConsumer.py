@@ -1,172 +1,221 @@
-import jwt
 import json
 import logging
-from datetime import datetime
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
-from django.conf import settings
-from urllib.parse import urljoin
-from chatrooms.models import ChatMessage, ChatRoom
+from chatapp import metrics
+from chatapp.metrics import timed
+from chatrooms import connection_cache, messaging, protocol
+from chatrooms.presence import get_presence_tracker
+from chatrooms.read_pointers import get_read_pointer_buffer
+from chatrooms.consumers.auth import TokenAuthMixin
+from chatrooms.consumers.framing import FramingMixin
+from chatrooms.flow_control import Outbox, allow_message
+from chatrooms.history import parse_cursor, parse_seq
+from chatrooms.persistence import QueueFull
 
 logger = logging.getLogger(__name__)
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(TokenAuthMixin, FramingMixin, AsyncWebsocketConsumer):
+    @timed('connect')
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_id = f'chat_{self.room_id}'
         self.user = None
+        self.joined = False
+        self.present = False
+        self.outbox = None
+        self.negotiate_framing()
 
         if await self.authenticate():
-            await self.join_room()
-            await self.send_chat_history()
+            if await self.join_room():
+                last_seq = self.get_last_seq()
+                if last_seq is None:
+                    await self.send_chat_history()
+                else:
+                    await self.send_missed_messages(last_seq)
+                await self.join_presence()
         else:
             await self.close()
 
-    async def authenticate(self):
-        token = self.get_token_from_subprotocol()
-        if not token:
-            logger.warning("No token provided")
-            return False
-
-        try:
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'])
-            self.user = await self.get_user(payload['user_id'])
-            return bool(self.user)
-        except jwt.ExpiredSignatureError:
-            logger.warning("Expired token")
-        except jwt.InvalidTokenError:
-            logger.warning("Invalid token")
-        except Exception as e:
-            logger.error(f"Unexpected error during authentication: {str(e)}")
-        return False
-
-    def get_token_from_subprotocol(self):
-        subprotocols = self.scope['subprotocols']
-        return subprotocols[1] if len(subprotocols) >= 2 else None
-
+    @timed('join_room')
     async def join_room(self):
         self.room = await self.get_room(self.room_id)
         if not self.room:
             logger.warning(f"Room with id {self.room_id} does not exist")
             await self.close()
-            return
+            return False
 
         if self.user:
             if self.room.room_type == 'public':
-                await self.channel_layer.group_add(self.room_group_id, self.channel_name)
-                await self.accept(subprotocol=self.scope['subprotocols'][0])
+                await self.add_to_room_group()
                 logger.info(f"User {self.user.username} joined room {self.room_id}")
+                return True
             elif self.room.room_type == 'private':
                 if await self.is_room_participant(self.user, self.room):
-                    await self.channel_layer.group_add(self.room_group_id, self.channel_name)
-                    await self.accept(subprotocol=self.scope['subprotocols'][0])
+                    await self.add_to_room_group()
                     logger.info(f"User {self.user.username} joined private room {self.room_id}")
+                    return True
                 else:
                     logger.warning(f"User {self.user.username} not allowed in private room {self.room_id}")
                     await self.close()
+                    return False
             elif self.room.room_type == 'one-to-one':
                 if await self.is_room_participant(self.user, self.room):
-                    await self.channel_layer.group_add(self.room_group_id, self.channel_name)
-                    await self.accept(subprotocol=self.scope['subprotocols'][0])
+                    await self.add_to_room_group()
                     logger.info(f"User {self.user.username} joined one-to-one room {self.room_id}")
+                    return True
                 else:
                     logger.warning(f"User {self.user.username} not allowed in one-to-one room {self.room_id}")
                     await self.close()
+                    return False
             else:
                 logger.warning(f"Room type {self.room.room_type} is not recognized")
                 await self.close()
+                return False
         else:
             logger.warning(f"User {self.user.username} not allowed in room {self.room_id}")
             await self.close()
+            return False
+
+    async def add_to_room_group(self):
+        self.room_group_id = messaging.room_group(self.room.id)
+        with metrics.CHANNEL_LAYER_SECONDS.labels(operation='group_add').time():
+            await self.channel_layer.group_add(self.room_group_id, self.channel_name)
+        await self.accept(subprotocol=self.scope['subprotocols'][0])
+        self.outbox = Outbox(self, self.room.id, coalesce_frames=self.batched_history)
+        self.joined = True
+        metrics.CHAT_ACTIVE_CONNECTIONS.inc_labels(room=self.room.id)
+
+    async def join_presence(self):
+        snapshot = await get_presence_tracker().join(self.room.id, self.user.username)
+        self.present = True
+        if snapshot:
+            self.outbox.put(snapshot)
+
+    def get_last_seq(self):
+        # ws/chat/<room_id>/?last_seq=<seq of the last message the client has>
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return parse_seq(query.get('last_seq', [None])[0])
+        except ValueError as e:
+            logger.warning(str(e))
+            return None
 
+    @timed('resume')
+    async def send_missed_messages(self, last_seq):
+        frames = await messaging.get_messages_since(self.room, last_seq)
+        if frames is None:
+            await self.send_data({'type': 'resync', 'detail': 'Too many missed messages, reload history'})
+        elif frames and self.batched_history:
+            await self.send_frame(protocol.encode_frame_batch(frames))
+        else:
+            for frame in frames:
+                await self.send_frame(frame)
+        logger.info(f"Resumed room {self.room_id} after seq {last_seq}")
+
+    @timed('send_chat_history')
     async def send_chat_history(self):
-        messages = await self.get_chat_messages(self.room_id)
-        for message in messages:
-            await self.send(text_data=json.dumps(message))
-        logger.info(f"Sent {len(messages)} messages from chat history")
+        if self.batched_history:
+            await self.send_history_batch()
+            return
 
-    async def disconnect(self, close_code):
-        if hasattr(self, 'room_group_id'):
-            await self.channel_layer.group_discard(self.room_group_id, self.channel_name)
-        logger.info(f"User disconnected from room {self.room_id}")
+        frames = await messaging.get_hot_history(self.room)
+        if frames is None:
+            messages, _ = await messaging.get_chat_messages(self.room.id)
+            frames = [json.dumps(message) for message in messages]
+        for frame in frames:
+            await self.send_frame(frame)
+        logger.info(f"Sent {len(frames)} messages from chat history")
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data['message']
-        await self.save_and_broadcast_message(message)
-
-    async def save_and_broadcast_message(self, message):
-        profile_image = self.build_absolute_uri(self.user.profile_image.url) if self.user.profile_image else None
-        timestamp = datetime.now().isoformat()
-
-        await self.save_message(self.room_id, self.user, message)
-        await self.channel_layer.group_send(
-            self.room_group_id,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'username': self.user.username,
-                'profile_image': profile_image,
-                'timestamp': timestamp
-            }
-        )
+    async def send_history_batch(self):
+        messages, next_cursor = await messaging.get_latest_history(self.room)
+        await self.send_data(protocol.history_batch(messages, next_cursor))
+        logger.info(f"Sent {len(messages)} messages from chat history in one frame")
 
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
+    async def send_older_history(self, before, limit=None):
+        try:
+            cursor = parse_cursor(before)
+        except ValueError as e:
+            logger.warning(str(e))
+            await self.send_data({'type': 'error', 'detail': str(e)})
+            return
 
-    def build_absolute_uri(self, relative_url):
-        return urljoin(f"http://127.0.0.1:8001{settings.MEDIA_URL}", relative_url)
+        messages, next_cursor = await messaging.get_chat_messages(self.room.id, cursor, limit)
+        if self.batched_history:
+            await self.send_data(protocol.history_batch(messages, next_cursor))
+            return
+        await self.send_data({
+            'type': 'history',
+            'messages': messages,
+            'next_cursor': next_cursor,
+        })
 
-    @database_sync_to_async
-    def get_user(self, user_id):
-        User = get_user_model()
+    async def mark_read(self, seq):
         try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return None
+            seq = parse_seq(seq)
+        except ValueError as e:
+            await self.send_data({'type': 'error', 'detail': str(e)})
+            return
+        if seq is not None:
+            get_read_pointer_buffer().mark(self.user.id, self.room.id, seq)
 
-    @database_sync_to_async
-    def get_room(self, room_id):
+    async def disconnect(self, close_code):
+        if hasattr(self, 'room_group_id'):
+            await self.channel_layer.group_discard(self.room_group_id, self.channel_name)
+        if getattr(self, 'joined', False):
+            metrics.CHAT_ACTIVE_CONNECTIONS.dec_labels(room=self.room.id)
+            self.outbox.close()
+        if getattr(self, 'present', False):
+            await get_presence_tracker().leave(self.room.id, self.user.username)
+        logger.info(f"User disconnected from room {self.room_id}")
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            return ChatRoom.objects.get(id=room_id)
-        except ChatRoom.DoesNotExist:
-            return None
+            data = self.decode_frame(text_data, bytes_data)
+        except ValueError as e:
+            await self.send_data({'type': 'error', 'detail': str(e)})
+            return
+        action = data.get('action')
+        if action == 'load_history':
+            await self.send_older_history(data.get('before'), data.get('limit'))
+            return
+        if action == 'typing':
+            get_presence_tracker().keystroke(self.room.id, self.user.username)
+            return
+        if action == 'stop_typing':
+            get_presence_tracker().stop_typing(self.room.id, self.user.username)
+            return
+        if action == 'read':
+            await self.mark_read(data.get('seq'))
+            return
+        if action not in (None, 'send'):
+            await self.send_data({'type': 'error', 'detail': f"Unknown action: {action!r}"})
+            return
+        try:
+            message = messaging.parse_message(data.get('message'))
+        except ValueError as e:
+            await self.send_data({'type': 'error', 'detail': str(e)})
+            return
+        metrics.CHAT_MESSAGES_RECEIVED.inc()
+        if not allow_message(self.user.id):
+            await self.send_data({'type': 'error', 'detail': 'Rate limit exceeded'})
+            return
+        get_presence_tracker().stop_typing(self.room.id, self.user.username)
+        try:
+            await messaging.publish_message(self.channel_layer, self.room, self.user, message)
+        except QueueFull as e:
+            await self.send_data({'type': 'error', 'detail': str(e)})
 
-    @database_sync_to_async
-    def is_room_participant(self, user, room):
-        return room.participants.filter(id=user.id).exists()
-
-    @database_sync_to_async
-    def get_chat_messages(self, room_id):
-        messages = ChatMessage.objects.filter(room__id=room_id).order_by('timestamp')[:50]
-        return [
-            {
-                'message': msg.content,
-                'username': msg.user.username,
-                'profile_image_url': self.build_absolute_uri(
-                    msg.user.profile_image.url) if msg.user.profile_image else None,
-                'timestamp': msg.timestamp.isoformat()
-            }
-            for msg in messages
-        ]
-
-    @database_sync_to_async
-    def save_message(self, room_id, user, content):
-        ChatMessage.objects.create(room_id=room_id, user=user, content=content)
+    async def get_room(self, room_id):
+        return await connection_cache.aget_room(room_id)
+
+    async def is_room_participant(self, user, room):
+        return await connection_cache.ais_participant(user, room)
 
     # Receive a message from the room group
     async def chat_message(self, event):
-        message = event['message']
-        username = event['username']
-        profile_image = event['profile_image']
-        timestamp = event['timestamp']
-
-        # Send the message to the WebSocket
-        await self.send(text_data=json.dumps({
-            'message': message,
-            'username': username,
-            'profile_image_url': profile_image,
-            'timestamp': timestamp,
-        }))
+        metrics.CHAT_MESSAGES_SENT.inc()
+        self.outbox.put(messaging.event_frame(event), event.get('sent_at'))
+
+    async def presence_update(self, event):
+        self.outbox.put(event['text'])
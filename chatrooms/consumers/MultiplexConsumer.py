@@ -0,0 +1,241 @@
+import logging
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from chatapp import metrics
+from chatapp.metrics import timed
+from chatrooms import connection_cache, lobby, messaging, protocol
+from chatrooms.consumers.auth import TokenAuthMixin
+from chatrooms.consumers.framing import FramingMixin
+from chatrooms.flow_control import Outbox, allow_message
+from chatrooms.history import parse_cursor, parse_seq
+from chatrooms.persistence import QueueFull
+from chatrooms.presence import get_presence_tracker
+from chatrooms.read_pointers import get_read_pointer_buffer
+
+logger = logging.getLogger(__name__)
+
+
+class MultiplexConsumer(TokenAuthMixin, FramingMixin, AsyncWebsocketConsumer):
+    """
+    A single authenticated socket carrying any number of rooms and the lobby
+    feed. Clients send:
+
+        {"action": "subscribe", "room": <id>, "last_seq": <seq, optional>}
+        {"action": "unsubscribe", "room": <id>}
+        {"action": "send", "room": <id>, "message": "..."}
+        {"action": "load_history", "room": <id>, "before": <cursor>}
+        {"action": "typing", "room": <id>} / {"action": "stop_typing", "room": <id>}
+        {"action": "read", "room": <id>, "seq": <seq of the latest message shown>}
+        {"action": "subscribe_lobby", "after": <event id, optional>} / {"action": "unsubscribe_lobby"}
+
+    Subscribing replies with the room's latest history, or with just the
+    messages after `last_seq` when given. Every room frame, history and chat
+    messages alike, carries a "room" key. Lobby frames are those of
+    RoomConsumer.
+    """
+
+    @timed('connect')
+    async def connect(self):
+        self.user = None
+        self.rooms = {}
+        self.lobby = False
+        self.lobby_replayed = set()
+        self.outbox = None
+        self.negotiate_framing()
+
+        if not await self.authenticate():
+            await self.close()
+            return
+        await self.accept(subprotocol=self.scope['subprotocols'][0])
+        self.outbox = Outbox(self, 'multiplex', coalesce_frames=self.batched_history)
+        logger.info(f"User {self.user.username} opened a multiplexed connection")
+
+    async def disconnect(self, close_code):
+        for room_id in list(self.rooms):
+            await self.leave(room_id)
+        if self.lobby:
+            await self.leave_lobby()
+        if self.outbox:
+            self.outbox.close()
+        logger.info("User closed a multiplexed connection")
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.decode_frame(text_data, bytes_data)
+        except ValueError as e:
+            await self.send_error(None, str(e))
+            return
+        action = data.get('action')
+
+        if action == 'subscribe_lobby':
+            try:
+                after = parse_seq(data.get('after'))
+            except ValueError as e:
+                await self.send_error(None, str(e))
+                return
+            if not self.lobby:
+                await self.join_lobby(after)
+            return
+        if action == 'unsubscribe_lobby':
+            if self.lobby:
+                await self.leave_lobby()
+            return
+
+        try:
+            room_id = int(data.get('room'))
+        except (TypeError, ValueError):
+            await self.send_error(None, f"Invalid room: {data.get('room')!r}")
+            return
+
+        if action == 'subscribe':
+            try:
+                last_seq = parse_seq(data.get('last_seq'))
+            except ValueError as e:
+                await self.send_error(room_id, str(e))
+                return
+            await self.subscribe(room_id, last_seq)
+        elif action == 'unsubscribe':
+            if room_id in self.rooms:
+                await self.leave(room_id)
+            await self.send_data({'type': 'unsubscribed', 'room': room_id})
+        elif room_id not in self.rooms:
+            await self.send_error(room_id, "Not subscribed to this room")
+        elif action == 'send':
+            await self.send_message(room_id, data.get('message'))
+        elif action == 'load_history':
+            await self.send_older_history(room_id, data.get('before'), data.get('limit'))
+        elif action == 'typing':
+            get_presence_tracker().keystroke(room_id, self.user.username)
+        elif action == 'stop_typing':
+            get_presence_tracker().stop_typing(room_id, self.user.username)
+        elif action == 'read':
+            await self.mark_read(room_id, data.get('seq'))
+        else:
+            await self.send_error(room_id, f"Unknown action: {action!r}")
+
+    @timed('join_room')
+    async def subscribe(self, room_id, last_seq=None):
+        if room_id in self.rooms:
+            return
+        if len(self.rooms) >= settings.CHAT_MULTIPLEX_MAX_ROOMS:
+            await self.send_error(room_id, "Too many subscriptions")
+            return
+
+        room = await connection_cache.aget_room(room_id)
+        if not room or not await connection_cache.acan_join(self.user, room):
+            logger.warning(f"User {self.user.username} not allowed in room {room_id}")
+            await self.send_error(room_id, "Room not found")
+            return
+
+        with metrics.CHANNEL_LAYER_SECONDS.labels(operation='group_add').time():
+            await self.channel_layer.group_add(messaging.room_group(room_id), self.channel_name)
+        self.rooms[room_id] = room
+        metrics.CHAT_ACTIVE_CONNECTIONS.inc_labels(room=room_id)
+        logger.info(f"User {self.user.username} subscribed to room {room_id}")
+
+        if last_seq is not None:
+            await self.send_missed_messages(room, last_seq)
+        else:
+            messages, next_cursor = await messaging.get_latest_history(room)
+            await self.send_history(room_id, messages, next_cursor)
+
+        snapshot = await get_presence_tracker().join(room_id, self.user.username)
+        if snapshot:
+            self.outbox.put(messaging.tag_frame(room_id, snapshot))
+
+    async def send_missed_messages(self, room, last_seq):
+        frames = await messaging.get_messages_since(room, last_seq)
+        if frames is None:
+            await self.send_data({
+                'type': 'resync', 'room': room.id, 'detail': 'Too many missed messages, reload history',
+            })
+        elif frames and self.batched_history:
+            await self.send_frame(messaging.tag_frame(room.id, protocol.encode_frame_batch(frames)))
+        else:
+            for frame in frames:
+                await self.send_frame(messaging.tag_frame(room.id, frame))
+
+    async def join_lobby(self, after):
+        for group in lobby.groups_for(self.user):
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.lobby = True
+        frames, self.lobby_replayed = await lobby.join_frames(self.user, after)
+        for frame in frames:
+            await self.send_frame(frame)
+
+    async def leave_lobby(self):
+        for group in lobby.groups_for(self.user):
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.lobby = False
+
+    async def leave(self, room_id):
+        await self.channel_layer.group_discard(messaging.room_group(room_id), self.channel_name)
+        del self.rooms[room_id]
+        metrics.CHAT_ACTIVE_CONNECTIONS.dec_labels(room=room_id)
+        await get_presence_tracker().leave(room_id, self.user.username)
+
+    async def send_message(self, room_id, message):
+        try:
+            message = messaging.parse_message(message)
+        except ValueError as e:
+            await self.send_error(room_id, str(e))
+            return
+        metrics.CHAT_MESSAGES_RECEIVED.inc()
+        if not allow_message(self.user.id):
+            await self.send_error(room_id, "Rate limit exceeded")
+            return
+        get_presence_tracker().stop_typing(room_id, self.user.username)
+        try:
+            await messaging.publish_message(self.channel_layer, self.rooms[room_id], self.user, message)
+        except QueueFull as e:
+            await self.send_error(room_id, str(e))
+
+    async def mark_read(self, room_id, seq):
+        try:
+            seq = parse_seq(seq)
+        except ValueError as e:
+            await self.send_error(room_id, str(e))
+            return
+        if seq is not None:
+            get_read_pointer_buffer().mark(self.user.id, room_id, seq)
+
+    async def send_older_history(self, room_id, before, limit=None):
+        try:
+            cursor = parse_cursor(before)
+        except ValueError as e:
+            logger.warning(str(e))
+            await self.send_error(room_id, str(e))
+            return
+        messages, next_cursor = await messaging.get_chat_messages(room_id, cursor, limit)
+        await self.send_history(room_id, messages, next_cursor)
+
+    async def send_history(self, room_id, messages, next_cursor):
+        if self.batched_history:
+            await self.send_data({'room': room_id, **protocol.history_batch(messages, next_cursor)})
+        else:
+            await self.send_data({'room': room_id, 'type': 'history', 'messages': messages, 'next_cursor': next_cursor})
+
+    async def send_error(self, room_id, detail):
+        await self.send_data({'type': 'error', 'room': room_id, 'detail': detail})
+
+    async def chat_message(self, event):
+        room_id = event.get('room')
+        if room_id is None and len(self.rooms) == 1:
+            # Events from workers that predate room-tagged events name no
+            # room; with several rooms subscribed there is no telling which
+            room_id = next(iter(self.rooms))
+        # Events already in flight when the room was unsubscribed
+        if room_id not in self.rooms:
+            return
+        metrics.CHAT_MESSAGES_SENT.inc()
+        self.outbox.put(messaging.tag_frame(room_id, messaging.event_frame(event)), event.get('sent_at'))
+
+    async def presence_update(self, event):
+        if event.get('room') in self.rooms:
+            self.outbox.put(messaging.tag_frame(event['room'], event['text']))
+
+    async def lobby_event(self, event):
+        # In flight after unsubscribing, or already sent when catching up
+        if not self.lobby or event['event'] in self.lobby_replayed:
+            return
+        self.outbox.put(event['text'])
@@ -1,38 +1,50 @@
-import json
 import logging
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
+from chatrooms import lobby
+from chatrooms.consumers.auth import TokenAuthMixin
+from chatrooms.consumers.framing import FramingMixin
+from chatrooms.history import parse_seq
 
 logger = logging.getLogger(__name__)
 
 
-class RoomConsumer(AsyncWebsocketConsumer):
+class RoomConsumer(TokenAuthMixin, FramingMixin, AsyncWebsocketConsumer):
+    """
+    The lobby feed of an authenticated user: room_created, room_updated and
+    room_deleted for the rooms they can see. On connect it sends the events
+    missed since `?after=<event id>`, or "resync" when they are no longer
+    kept, then a lobby_cursor frame with the id to resume after.
+    """
+
     async def connect(self):
-        # Join the 'rooms' group
-        await self.channel_layer.group_add(
-            "rooms",
-            self.channel_name
-        )
-        await self.accept()
+        self.user = None
+        self.replayed = set()
+        self.negotiate_framing()
+        if not await self.authenticate():
+            await self.close()
+            return
+        try:
+            after = parse_seq(parse_qs(self.scope.get('query_string', b'').decode()).get('after', [None])[0])
+        except ValueError as e:
+            logger.warning(str(e))
+            await self.close()
+            return
+
+        for group in lobby.groups_for(self.user):
+            await self.channel_layer.group_add(group, self.channel_name)
+        await self.accept(subprotocol=self.scope['subprotocols'][0])
+        frames, self.replayed = await lobby.join_frames(self.user, after)
+        for frame in frames:
+            await self.send_frame(frame)
 
     async def disconnect(self, close_code):
-        # Leave the 'rooms' group
-        await self.channel_layer.group_discard(
-            "rooms",
-            self.channel_name
-        )
-
-    async def room_created(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            "type": "room_created",
-            "message": event["message"]
-        }))
-
-    async def room_deleted(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            "type": "room_deleted",
-            "room_id": event["room_id"]
-        }))
-
-
+        if self.user:
+            for group in lobby.groups_for(self.user):
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def lobby_event(self, event):
+        # Already sent when catching up
+        if event['event'] in self.replayed:
+            return
+        await self.send_frame(event['text'])
@@ -0,0 +1,40 @@
+import logging
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from chatapp.metrics import timed
+from chatrooms import connection_cache
+from users.authentication import aget_validated_token, user_from_claims
+
+logger = logging.getLogger(__name__)
+
+
+class TokenAuthMixin:
+    """Authenticate a socket with the access token sent as its second subprotocol."""
+
+    @timed('authenticate')
+    async def authenticate(self):
+        token = self.get_token_from_subprotocol()
+        if not token:
+            logger.warning("No token provided")
+            return False
+
+        try:
+            validated_token = await aget_validated_token(token)
+            self.user = await self.get_user(validated_token)
+            return bool(self.user)
+        except InvalidToken as e:
+            logger.warning(f"Invalid token: {e.detail['detail']}")
+        except Exception as e:
+            logger.error(f"Unexpected error during authentication: {str(e)}")
+        return False
+
+    def get_token_from_subprotocol(self):
+        subprotocols = self.scope['subprotocols']
+        return subprotocols[1] if len(subprotocols) >= 2 else None
+
+    async def get_user(self, validated_token):
+        # Tokens issued before claims were added still need the lookup
+        user = user_from_claims(validated_token)
+        if user is None:
+            user = await connection_cache.aget_user(validated_token[api_settings.USER_ID_CLAIM])
+        return user
@@ -0,0 +1,28 @@
+from chatrooms import protocol
+
+
+class FramingMixin:
+    """Send and read frames in the encoding picked with the first subprotocol."""
+
+    def negotiate_framing(self):
+        framing = protocol.negotiate(self.scope['subprotocols'])
+        self.codec = protocol.codec_for(framing)
+        self.batched_history = framing in protocol.BATCHED_FRAMINGS
+
+    async def send_frame(self, text):
+        """Send a frame given as JSON text."""
+        if self.codec.binary:
+            await self.send(bytes_data=self.codec.encode(text))
+        else:
+            await self.send(text_data=text)
+
+    async def send_data(self, data):
+        """Send a frame given as a dict, encoded straight to the negotiated encoding."""
+        if self.codec.binary:
+            await self.send(bytes_data=self.codec.encode_data(data))
+        else:
+            await self.send(text_data=self.codec.encode_data(data))
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        """The frame as a dict; raises ValueError for malformed frames."""
+        return self.codec.decode(text_data, bytes_data)
@@ -0,0 +1,229 @@
+"""
+Full exports of room history, and imports of them into another environment.
+
+An export is NDJSON in the format of the partition archives (see
+chatrooms.storage): one message per line with ARCHIVE_COLUMNS, in seq order,
+optionally gzipped. Rows are read through a server-side cursor and written
+out CHAT_EXPORT_CHUNK_SIZE at a time, so memory stays flat however long the
+room's history is. An interrupted export resumes with after_seq set to the
+seq of the last complete line.
+
+Imports take exports and archives alike. Users are matched by username and
+messages get new ids; seqs and timestamps are kept. Messages at or below the
+room's last_seq are skipped, so an interrupted import can simply be rerun.
+"""
+import gzip
+import io
+import json
+import logging
+import sys
+import zlib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from chatrooms import connection_cache, hot_history
+from chatrooms.models import ChatMessage, ChatRoom
+from chatrooms.storage import ARCHIVE_COLUMNS, archive_record
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def parse_time(value):
+    if value in (None, ''):
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"Invalid time: {value!r}")
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+def parse_after_seq(value):
+    if value in (None, ''):
+        return None
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid after_seq: {value!r}")
+    if seq < 0:
+        raise ValueError(f"Invalid after_seq: {value!r}")
+    return seq
+
+
+def export_queryset(room_id, since=None, until=None, after_seq=None):
+    messages = ChatMessage.objects.filter(room_id=room_id)
+    if since is not None:
+        messages = messages.filter(timestamp__gte=since)
+    if until is not None:
+        messages = messages.filter(timestamp__lt=until)
+    if after_seq is not None:
+        messages = messages.filter(seq__gt=after_seq)
+    return messages.order_by('seq').values_list('id', 'room_id', 'user_id', 'user__username', 'seq', 'content', 'timestamp')
+
+
+def export_chunks(room_id, since=None, until=None, after_seq=None, chunk_size=None):
+    """Yield the export of a room as bytes, one chunk per `chunk_size` messages."""
+    chunk_size = chunk_size or settings.CHAT_EXPORT_CHUNK_SIZE
+    rows = export_queryset(room_id, since, until, after_seq)
+    # In a transaction the server-side cursor needs no WITH HOLD, which would
+    # have PostgreSQL materialize the whole result first
+    with transaction.atomic():
+        lines = []
+        for row in rows.iterator(chunk_size=chunk_size):
+            lines.append(archive_record(row))
+            if len(lines) >= chunk_size:
+                yield ''.join(lines).encode()
+                lines = []
+        if lines:
+            yield ''.join(lines).encode()
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def aiter_chunks(chunks):
+    """
+    Drive a generator of export chunks from the event loop. Every step runs
+    in the request's thread, which holds the generator's cursor.
+    """
+    step = sync_to_async(next, thread_sensitive=True)
+    try:
+        while (chunk := await step(chunks, None)) is not None:
+            yield chunk
+    finally:
+        # Ends the transaction when the client goes away midway
+        await sync_to_async(chunks.close, thread_sensitive=True)()
+
+
+def open_export(path):
+    """Open an export or archive for reading as text, gzipped or not; '-' is stdin."""
+    raw = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    if raw.peek(2)[:2] == GZIP_MAGIC:
+        return gzip.open(raw, 'rt', encoding='utf-8')
+    return io.TextIOWrapper(raw, encoding='utf-8')
+
+
+def read_records(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError(f"Line {number} is not JSON")
+        missing = [column for column in ARCHIVE_COLUMNS if column != 'id' and column not in record]
+        if missing:
+            raise ValueError(f"Line {number} lacks {', '.join(missing)}")
+        yield record
+
+
+class Importer:
+    """
+    Insert records of an export in batches: with COPY on PostgreSQL,
+    bulk_create elsewhere. Each batch commits with the last_seq of its rooms.
+    """
+
+    def __init__(self, room_id=None, create_users=False, batch_size=None):
+        self.room_id = room_id
+        self.create_users = create_users
+        self.batch_size = batch_size or settings.CHAT_IMPORT_BATCH_SIZE
+        self.user_ids = {}
+        self.last_seqs = {}
+        self.imported = 0
+        self.skipped = 0
+
+    def run(self, records):
+        batch = []
+        try:
+            for record in records:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    self.insert(batch)
+                    batch = []
+            if batch:
+                self.insert(batch)
+        finally:
+            self.invalidate()
+        return self.imported, self.skipped
+
+    def insert(self, records):
+        rows = []
+        for record in records:
+            room_id = self.room_id or record['room_id']
+            if record['seq'] <= self.last_seq(room_id):
+                self.skipped += 1
+                continue
+            timestamp = parse_time(record['timestamp'])
+            rows.append((room_id, record['username'], record['content'], timestamp, record['seq']))
+        if not rows:
+            return
+        self.resolve_users({username for _, username, _, _, _ in rows})
+        rows = [(room_id, self.user_ids[username], content, timestamp, seq)
+                for room_id, username, content, timestamp, seq in rows]
+
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                self.copy(rows)
+            else:
+                ChatMessage.objects.bulk_create([
+                    ChatMessage(room_id=room_id, user_id=user_id, content=content, timestamp=timestamp, seq=seq)
+                    for room_id, user_id, content, timestamp, seq in rows
+                ])
+            top = {}
+            for room_id, _, _, _, seq in rows:
+                top[room_id] = max(seq, top.get(room_id, 0))
+            for room_id, seq in top.items():
+                ChatRoom.objects.filter(id=room_id, last_seq__lt=seq).update(last_seq=seq)
+                self.last_seqs[room_id] = max(seq, self.last_seqs[room_id])
+        self.imported += len(rows)
+        logger.info(f"Imported {self.imported} messages ({self.skipped} already present)")
+
+    def copy(self, rows):
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            with cursor.copy(
+                f'COPY {quote(ChatMessage._meta.db_table)} (room_id, user_id, content, "timestamp", seq) FROM STDIN'
+            ) as copy:
+                for row in rows:
+                    copy.write_row(row)
+
+    def last_seq(self, room_id):
+        if room_id not in self.last_seqs:
+            last_seq = ChatRoom.objects.filter(id=room_id).values_list('last_seq', flat=True).first()
+            if last_seq is None:
+                raise ValueError(f"Room {room_id} does not exist")
+            self.last_seqs[room_id] = last_seq
+        return self.last_seqs[room_id]
+
+    def resolve_users(self, usernames):
+        missing = usernames - self.user_ids.keys()
+        if not missing:
+            return
+        self.user_ids.update(User.objects.filter(username__in=missing).values_list('username', 'id'))
+        missing -= self.user_ids.keys()
+        if missing and not self.create_users:
+            raise ValueError(f"Users do not exist: {', '.join(sorted(missing))}")
+        for username in sorted(missing):
+            user = User(username=username, is_active=False)
+            user.set_unusable_password()
+            user.save()
+            self.user_ids[username] = user.id
+
+    def invalidate(self):
+        # Hot history buffers do not have the imported messages; the next
+        # reader loads them again
+        for room_id in self.last_seqs:
+            connection_cache.invalidate_room(room_id)
+        hot_history.invalidate(list(self.last_seqs))
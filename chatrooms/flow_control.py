@@ -0,0 +1,171 @@
+"""
+Flow control for chat sockets: a bounded outbound queue per connection, so a
+socket that cannot keep up cannot grow the worker's memory or hold up the
+rest of its room, and a token bucket per user for inbound messages.
+
+The outbound queue times every send to the ASGI server. Whether that is the
+client's pace depends on the server: uvicorn (with the websockets protocol)
+waits for the socket to drain once its write buffer is full, so a slow
+reader blocks our send, the queue behind it fills and drops, and a send that
+blocks for CHAT_OUTBOUND_SEND_TIMEOUT closes the socket. Daphne's send()
+returns as soon as the frame is queued on the Twisted transport, whose write
+buffer is neither bounded nor visible through ASGI, so under Daphne only a
+lagging event loop (CPU-bound work, a burst bigger than the loop can write)
+shows up here and a client on a slow link grows Daphne's buffer unnoticed.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from django.conf import settings
+from chatapp import metrics
+from chatapp.cache import MISSING, TTLCache
+from chatrooms import protocol
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+
+# "Try Again Later": the client may reconnect and reload history
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+CHAT_OUTBOUND_DROPPED = metrics.Counter(
+    'chat_outbound_dropped', "Frames dropped from full outbound queues")
+CHAT_SLOW_CONSUMER_DISCONNECTS = metrics.Counter(
+    'chat_slow_consumer_disconnects', "Sockets closed for lagging behind their room")
+CHAT_OUTBOUND_SEND_SECONDS = metrics.Histogram(
+    'chat_outbound_send_seconds', "Time the ASGI server took to accept a frame for a chat socket")
+CHAT_CONNECTION_LAG_SECONDS = metrics.Gauge(
+    'chat_connection_lag_seconds', "Delivery lag of connections currently lagging behind their room",
+    ['room', 'user', 'channel'])
+CHAT_RATE_LIMITED = metrics.Counter(
+    'chat_rate_limited', "Inbound chat messages rejected by the per-user rate limit")
+
+
+class Outbox:
+    """
+    Frames waiting to be written to one socket, oldest first, each with the
+    time it was broadcast. A single writer task drains the queue; what happens
+    when it falls behind depends on the configured policy.
+    """
+
+    def __init__(self, consumer, room_id, policy=None, maxsize=None, max_lag=None, send_timeout=None,
+                 coalesce_frames=False):
+        self.consumer = consumer
+        self.room_id = room_id
+        self.policy = policy or settings.CHAT_OUTBOUND_POLICY
+        self.maxsize = maxsize or settings.CHAT_OUTBOUND_QUEUE_SIZE
+        self.max_lag = max_lag or settings.CHAT_OUTBOUND_MAX_LAG
+        self.send_timeout = send_timeout or settings.CHAT_OUTBOUND_SEND_TIMEOUT
+        # Only clients of the batch protocol understand coalesced frames
+        self.coalesce_frames = self.policy == COALESCE and coalesce_frames
+        self.frames = deque()
+        self.closed = False
+        self.lagging = False
+        self._wakeup = asyncio.Event()
+        self._writer = asyncio.get_running_loop().create_task(self._run())
+
+    def put(self, text, sent_at=None):
+        if self.closed:
+            return
+        if len(self.frames) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                self._disconnect()
+                return
+            self.frames.popleft()
+            CHAT_OUTBOUND_DROPPED.inc()
+        self.frames.append((sent_at or time.time(), text))
+        self._wakeup.set()
+
+    async def _run(self):
+        while not self.closed:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.frames and not self.closed:
+                lag = time.time() - self.frames[0][0]
+                self._report_lag(lag)
+                if self.policy == DISCONNECT and lag > self.max_lag:
+                    self._disconnect()
+                    return
+                if self.coalesce_frames and len(self.frames) > 1:
+                    texts = [text for _, text in self.frames]
+                    self.frames.clear()
+                    text = protocol.encode_frame_batch(texts)
+                else:
+                    _, text = self.frames.popleft()
+                if not await self._send(text):
+                    return
+            self._report_lag(0)
+
+    async def _send(self, text):
+        """
+        Hand one frame to the server. Frames put meanwhile wait, and are
+        dropped once the queue is full, for as long as the server blocks us.
+        """
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.consumer.send_frame(text), self.send_timeout)
+        except asyncio.TimeoutError:
+            self._disconnect()
+            return False
+        finally:
+            CHAT_OUTBOUND_SEND_SECONDS.observe(time.perf_counter() - started)
+        return True
+
+    def _report_lag(self, lag):
+        labels = {'room': self.room_id, 'user': self.consumer.user.id, 'channel': self.consumer.channel_name}
+        if lag >= settings.CHAT_LAG_REPORT_THRESHOLD:
+            CHAT_CONNECTION_LAG_SECONDS.labels(**labels).set(round(lag, 3))
+            self.lagging = True
+        elif self.lagging:
+            CHAT_CONNECTION_LAG_SECONDS.remove(**labels)
+            self.lagging = False
+
+    def _disconnect(self):
+        logger.warning(
+            f"Closing slow connection of user {self.consumer.user.username} in room {self.room_id} "
+            f"({len(self.frames)} frames waiting)"
+        )
+        CHAT_SLOW_CONSUMER_DISCONNECTS.inc()
+        self.close()
+        asyncio.get_running_loop().create_task(self.consumer.close(code=SLOW_CONSUMER_CLOSE_CODE))
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self._report_lag(0)
+        self._writer.cancel()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def consume(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# Shared by all sockets of a user on this worker
+_buckets = TTLCache(maxsize=100000, ttl=600)
+
+
+def allow_message(user_id):
+    bucket = _buckets.get(user_id)
+    if bucket is MISSING:
+        bucket = TokenBucket(settings.CHAT_RATE_LIMIT_RATE, settings.CHAT_RATE_LIMIT_BURST)
+        _buckets.set(user_id, bucket)
+    if bucket.consume():
+        return True
+    CHAT_RATE_LIMITED.inc()
+    return False
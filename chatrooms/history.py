@@ -0,0 +1,141 @@
+import datetime
+from django.conf import settings
+from django.db.models import Q, Subquery
+from django.utils import timezone
+from chatrooms.models import ChatMessage
+
+
+def serialize_message(msg):
+    return {
+        'id': msg.id,
+        'seq': msg.seq,
+        'message': msg.content,
+        'username': msg.user.username,
+        # Clients load /api/users/avatars/<avatar_version>-<size>.webp
+        'avatar_version': msg.user.avatar_version or None,
+        'timestamp': msg.timestamp.isoformat(),
+    }
+
+
+def clamp_page_size(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return settings.CHAT_HISTORY_PAGE_SIZE
+    return max(1, min(limit, settings.CHAT_HISTORY_MAX_PAGE_SIZE))
+
+
+def get_history_page(room_id, before=None, limit=None):
+    """
+    Return up to `limit` messages of a room older than the message with id
+    `before` (or the latest ones when no cursor is given), oldest first,
+    together with the cursor for the next older page.
+    """
+    return fetch_history(room_id, before=before, limit=clamp_page_size(limit))
+
+
+def hot_window_start():
+    """
+    Lower timestamp bound of the first attempt at history queries, or None.
+    Bounding "timestamp" lets PostgreSQL prune the older partitions; the
+    callers query without it when the window does not hold the whole answer.
+    """
+    if settings.CHAT_HISTORY_HOT_DAYS is None:
+        return None
+    return timezone.now() - datetime.timedelta(days=settings.CHAT_HISTORY_HOT_DAYS)
+
+
+def fetch_history(room_id, before=None, limit=50):
+    since = hot_window_start()
+    if since is not None:
+        messages = list(history_queryset(room_id, before, limit, since))
+        if covers_history(messages, limit):
+            return history_page(messages, limit)
+    return history_page(history_queryset(room_id, before, limit), limit)
+
+
+def history_queryset(room_id, before, limit, since=None):
+    # Walks the (room, timestamp, id) index backwards from the cursor, so the
+    # cost depends on the page size and not on the size of the room.
+    messages = (
+        ChatMessage.objects
+        .filter(room_id=room_id)
+        .select_related('user')
+        .only('id', 'seq', 'content', 'timestamp', 'user__username', 'user__avatar_version')
+    )
+    if since is not None:
+        messages = messages.filter(timestamp__gte=since)
+    if before is not None:
+        anchor = Subquery(ChatMessage.objects.filter(room_id=room_id, id=before).values('timestamp')[:1])
+        messages = messages.filter(
+            Q(timestamp__lt=anchor) | Q(timestamp=anchor, id__lt=before)
+        )
+    # One extra row tells whether there is an older page
+    return messages.order_by('-timestamp', '-id')[:limit + 1]
+
+
+def covers_history(messages, limit):
+    """Whether rows of a hot window history_queryset() are the same the unbounded one would return."""
+    # Every row outside the window is older than the ones in it
+    return len(messages) > limit
+
+
+def history_page(messages, limit):
+    """Serialized page, oldest first, and next cursor from the rows of history_queryset()."""
+    page = list(messages)
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = page[-1].id
+    page.reverse()
+    return [serialize_message(msg) for msg in page], next_cursor
+
+
+def fetch_messages_after(room_id, after_seq, limit):
+    """Up to `limit` messages of a room with a seq above `after_seq`, oldest first."""
+    since = hot_window_start()
+    if since is not None:
+        messages = list(messages_after_queryset(room_id, after_seq, limit, since))
+        if covers_seqs(messages, after_seq):
+            return [serialize_message(msg) for msg in messages]
+    return [serialize_message(msg) for msg in messages_after_queryset(room_id, after_seq, limit)]
+
+
+def messages_after_queryset(room_id, after_seq, limit, since=None):
+    messages = ChatMessage.objects.filter(room_id=room_id, seq__gt=after_seq)
+    if since is not None:
+        messages = messages.filter(timestamp__gte=since)
+    return (
+        messages
+        .select_related('user')
+        .only('id', 'seq', 'content', 'timestamp', 'user__username', 'user__avatar_version')
+        .order_by('seq')[:limit]
+    )
+
+
+def covers_seqs(messages, after_seq):
+    """Whether rows of a hot window messages_after_queryset() are the same the unbounded one would return."""
+    # Seqs have no gaps, so rows that continue right after `after_seq` are
+    # all there is up to the last of them
+    return bool(messages) and all(msg.seq == after_seq + i for i, msg in enumerate(messages, 1))
+
+
+def parse_cursor(value):
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid history cursor: {value!r}")
+
+
+def parse_seq(value):
+    if value in (None, ''):
+        return None
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid sequence number: {value!r}")
+    if seq < 0:
+        raise ValueError(f"Invalid sequence number: {value!r}")
+    return seq
@@ -0,0 +1,120 @@
+"""
+Hot history: the latest encoded messages of a room in Redis, so sockets
+connect and resume without a database query.
+
+Each room has a sorted set of frames scored by seq. Concurrent senders can
+append out of seq order, but readers still get frames in seq order, and a
+reader that sees a gap in the seqs goes to the database. The buffer is
+"warm" once it has been loaded from the database; only then is it trusted
+to hold the room's latest messages.
+"""
+import json
+import logging
+from collections import defaultdict
+from django.conf import settings
+from redis.exceptions import RedisError
+from chatapp.redis_client import get_async_redis, get_redis
+from chatrooms.history import fetch_history, serialize_message
+
+logger = logging.getLogger(__name__)
+
+
+# v2: sorted sets; the v1 keys were lists
+def history_key(room_id):
+    return f'chat:history:v2:{room_id}'
+
+
+def warm_key(room_id):
+    return f'chat:history:v2:{room_id}:warm'
+
+
+def buffer_size(room_type):
+    if not settings.CHAT_HOT_HISTORY_ENABLED:
+        return 0
+    size = settings.CHAT_HOT_HISTORY_SIZES.get(room_type, 0)
+    return size if size >= settings.CHAT_HISTORY_PAGE_SIZE else 0
+
+
+async def read_latest(room, count):
+    """
+    Return the latest `count` serialized messages of a room, oldest first, or
+    None when the buffer is cold.
+    """
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.exists(warm_key(room.id))
+        pipe.zrange(history_key(room.id), -count, -1)
+        is_warm, frames = await pipe.execute()
+    if not is_warm:
+        return None
+    return [frame.decode() for frame in frames]
+
+
+async def append(room, frames):
+    """Add frames to the buffer of a room; `frames` maps each encoded frame to its seq."""
+    size = buffer_size(room.room_type)
+    if not size or not frames:
+        return
+    key = history_key(room.id)
+    try:
+        async with get_async_redis().pipeline(transaction=True) as pipe:
+            pipe.zadd(key, frames)
+            pipe.zremrangebyrank(key, 0, -size - 1)
+            pipe.expire(key, settings.CHAT_HOT_HISTORY_TTL)
+            await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Hot history append failed for room {room.id}: {e}")
+        # The buffer may now be missing a message; make the next reader go to Postgres.
+        try:
+            await get_async_redis().delete(warm_key(room.id))
+        except RedisError:
+            pass
+
+
+async def append_messages(messages):
+    """Append persisted ChatMessage instances, grouped by room and kept in order."""
+    by_room = defaultdict(dict)
+    rooms = {}
+    for message in messages:
+        if message.pk is None:
+            continue
+        rooms[message.room_id] = message.room
+        by_room[message.room_id][json.dumps(serialize_message(message))] = message.seq
+    for room_id, frames in by_room.items():
+        await append(rooms[room_id], frames)
+
+
+def warm(room):
+    """
+    Load the latest messages of a room from Postgres into its buffer and mark
+    it warm. Returns the buffered frames, oldest first.
+
+    Frames appended while Postgres was being read stay in the buffer: the
+    loaded ones are added next to them rather than replacing them.
+    """
+    size = buffer_size(room.room_type)
+    if not size:
+        return []
+    messages, _ = fetch_history(room.id, limit=size)
+    key = history_key(room.id)
+    with get_redis().pipeline(transaction=True) as pipe:
+        if messages:
+            pipe.zadd(key, {json.dumps(message): message['seq'] for message in messages})
+            pipe.zremrangebyrank(key, 0, -size - 1)
+            pipe.expire(key, settings.CHAT_HOT_HISTORY_TTL)
+        pipe.set(warm_key(room.id), 1, ex=settings.CHAT_HOT_HISTORY_TTL)
+        pipe.zrange(key, 0, -1)
+        frames = pipe.execute()[-1]
+    return [frame.decode() for frame in frames]
+
+
+def invalidate(room_ids):
+    """Forget the buffers of rooms whose stored messages changed underneath them."""
+    if not settings.CHAT_HOT_HISTORY_ENABLED:
+        return
+    keys = [key for room_id in room_ids for key in (history_key(room_id), warm_key(room_id))]
+    if not keys:
+        return
+    try:
+        get_redis().delete(*keys)
+    except RedisError as e:
+        logger.warning(f"Could not reset the hot history of {len(room_ids)} rooms: {e}")
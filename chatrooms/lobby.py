@@ -0,0 +1,196 @@
+"""
+Lobby feed: room changes pushed to the sockets of the users who can see the
+room.
+
+Events about public rooms go to the LOBBY_PUBLIC_GROUP that every lobby
+socket joins; events about private and one-to-one rooms go only to the
+per-user groups of their owner and participants. Frames are compact diffs:
+
+    {"type": "room_created" | "room_updated", "event": <id>,
+     "room": {"id": ..., "title": ..., "room_type": ..., "participant_count": ...}}
+    {"type": "room_deleted", "event": <id>, "room": {"id": ...}}
+
+Public rooms have no participants, and their frames no participant_count.
+
+A user who joins a room gets room_created and one who leaves it gets
+room_deleted. Every event gets an increasing id, and the last
+CHAT_LOBBY_BACKLOG events are kept in Redis with their audience. A socket
+can then resume after the last event it saw, and gets "resync" when the
+backlog no longer reaches back that far.
+"""
+import asyncio
+import json
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from redis.exceptions import RedisError
+from chatapp import metrics
+from chatapp.redis_client import get_async_redis, get_redis
+from chatrooms.models import ChatRoom
+
+logger = logging.getLogger(__name__)
+
+LOBBY_PUBLIC_GROUP = 'lobby_public'
+EVENT_SEQ_KEY = 'lobby:events:seq'
+BACKLOG_KEY = 'lobby:events'
+
+CHAT_LOBBY_EVENTS = metrics.Counter(
+    'chat_lobby_events', "Lobby events published, by kind", ('kind',))
+CHAT_LOBBY_DELIVERIES = metrics.Counter(
+    'chat_lobby_group_sends', "Channel layer group sends made for lobby events")
+
+
+def user_group(user_id):
+    return f'lobby_user_{user_id}'
+
+
+def groups_for(user):
+    return [LOBBY_PUBLIC_GROUP, user_group(user.id)]
+
+
+def audience(room_id, owner_id):
+    """Ids of the users who see a non-public room: its owner and participants."""
+    participants = ChatRoom.participants.through.objects.filter(chatroom_id=room_id)
+    return set(participants.values_list('customuser_id', flat=True)) | {owner_id}
+
+
+def room_diff(room_id):
+    room = (
+        ChatRoom.objects.filter(id=room_id)
+        .annotate(participant_count=Count('participants'))
+        .values('id', 'title', 'room_type', 'participant_count', 'owner_id')
+        .first()
+    )
+    if room is not None and room['room_type'] == 'public':
+        # Public rooms have no participant rows
+        del room['participant_count']
+    return room
+
+
+def publish_on_commit(kind, room_id, user_ids=None):
+    """
+    Once the current transaction commits, publish a lobby event carrying the
+    room as it is then: to `user_ids` when given, otherwise to everyone who
+    can see the room. Nothing is sent if the room is gone by then.
+    """
+    def send():
+        room = room_diff(room_id)
+        if room is None:
+            return
+        owner_id = room.pop('owner_id')
+        if user_ids is not None:
+            publish(kind, room, user_ids)
+        elif room['room_type'] == 'public':
+            publish(kind, room)
+        else:
+            publish(kind, room, audience(room_id, owner_id))
+
+    transaction.on_commit(send)
+
+
+def publish(kind, room, user_ids=None):
+    """
+    Send a lobby event about `room` (a dict from room_diff()) to the public
+    group, or to the groups of `user_ids` when given. Called after commit.
+    """
+    if user_ids is not None and not user_ids:
+        return
+    entry_audience = 'public' if user_ids is None else sorted(user_ids)
+    event_id = None
+    if settings.CHAT_LOBBY_BACKLOG:
+        try:
+            event_id = get_redis().incr(EVENT_SEQ_KEY)
+        except RedisError as e:
+            logger.warning(f"Lobby event backlog unavailable: {e}")
+    frame = json.dumps({'type': kind, 'event': event_id, 'room': room})
+    if event_id is not None:
+        try:
+            with get_redis().pipeline(transaction=False) as pipe:
+                pipe.zadd(BACKLOG_KEY, {json.dumps({'audience': entry_audience, 'frame': frame}): event_id})
+                pipe.zremrangebyrank(BACKLOG_KEY, 0, -settings.CHAT_LOBBY_BACKLOG - 1)
+                pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Lobby event backlog unavailable: {e}")
+
+    groups = [LOBBY_PUBLIC_GROUP] if user_ids is None else [user_group(user_id) for user_id in entry_audience]
+    CHAT_LOBBY_EVENTS.labels(kind=kind).inc()
+    CHAT_LOBBY_DELIVERIES.inc(len(groups))
+    try:
+        async_to_sync(_send)(groups, {'type': 'lobby_event', 'event': event_id, 'text': frame})
+    except (RedisError, OSError) as e:
+        # Runs after commit: the change stands, and lobby sockets catch up
+        # from the backlog or a reload
+        logger.warning(f"Could not send lobby event {kind} for room {room['id']}: {e}")
+
+
+async def _send(groups, event):
+    channel_layer = get_channel_layer()
+    await asyncio.gather(*(channel_layer.group_send(group, event) for group in groups))
+
+
+async def events_since(user, after):
+    """
+    The events `user` can see with an id above `after`, as (id, frame)
+    pairs, and the cursor to resume after: the id of the newest event in
+    the backlog. Events are None when the backlog does not reach back to
+    `after`, or both are None when the backlog is unavailable.
+
+    The cursor is not taken from EVENT_SEQ_KEY: publish() takes an id before
+    adding the event to the backlog and sending it, and an id handed out
+    but not in the backlog yet belongs to an event the socket is still to
+    receive.
+    """
+    if not settings.CHAT_LOBBY_BACKLOG:
+        return None, None
+    try:
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            pipe.get(EVENT_SEQ_KEY)
+            pipe.zrange(BACKLOG_KEY, 0, 0, withscores=True)
+            pipe.zrange(BACKLOG_KEY, -1, -1, withscores=True)
+            pipe.zrangebyscore(BACKLOG_KEY, f'({after}' if after is not None else '+inf', '+inf', withscores=True)
+            latest, oldest, newest, entries = await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Lobby event backlog unavailable: {e}")
+        return None, None
+    latest = int(latest or 0)
+    cursor = int(newest[0][1]) if newest else 0
+    if after is None:
+        return [], cursor
+    oldest_id = int(oldest[0][1]) if oldest else latest + 1
+    if after > latest or after < oldest_id - 1:
+        return None, cursor
+
+    events = []
+    for entry, event_id in entries:
+        entry = json.loads(entry)
+        if entry['audience'] == 'public' or user.id in entry['audience']:
+            events.append((int(event_id), entry['frame']))
+    return events, max(cursor, after)
+
+
+async def join_frames(user, after):
+    """
+    Frames to send a socket joining the lobby: the events it missed since
+    `after`, or a resync, then its cursor. Also returns the ids of the events
+    replayed, which the socket skips when their broadcast reaches it too.
+    """
+    events, cursor = await events_since(user, after)
+    if events is None:
+        frames = [resync_frame()] if after is not None else []
+        events = []
+    else:
+        frames = [frame for _, frame in events]
+    if cursor is not None:
+        frames.append(cursor_frame(cursor))
+    return frames, {event_id for event_id, _ in events}
+
+
+def cursor_frame(event_id):
+    return json.dumps({'type': 'lobby_cursor', 'event': event_id})
+
+
+def resync_frame():
+    return json.dumps({'type': 'resync', 'detail': 'Missed too many lobby events, reload the room list'})
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import platform
+from datetime import datetime, timezone
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from chatrooms.benchmark import SCENARIOS, BenchEnvironment
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the chat WebSocket consumers through the ASGI application. "
+        "Run with DJANGO_SETTINGS_MODULE=chatapp.bench_settings; results are "
+        "created in a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f"Comma-separated scenarios to run ({', '.join(SCENARIOS)})")
+        parser.add_argument('--sizes', default='1,10,100', help="Comma-separated room sizes (connected clients)")
+        parser.add_argument('--messages', type=int, default=100, help="Messages sent per fan-out run")
+        parser.add_argument('--history', type=int, default=200, help="Messages of history seeded in each room")
+        parser.add_argument('--timeout', type=float, default=30, help="Seconds to wait for any single frame")
+        parser.add_argument('--output', default='bench_results.json', help="Where to write the JSON results")
+
+    def handle(self, *args, **options):
+        scenarios = options['scenarios'].split(',')
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = self.run(scenarios, sizes, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'meta': {
+                'started_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'database': connection.vendor,
+                'channel_layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+                'channel_layer_hosts': len(settings.CHANNEL_LAYERS['default'].get('CONFIG', {}).get('hosts', [])),
+                'persistence_mode': settings.CHAT_PERSISTENCE_MODE,
+                'messages': options['messages'],
+                'history': options['history'],
+            },
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def run(self, scenarios, sizes, options):
+        from chatapp.asgi import application
+
+        env = BenchEnvironment(max(sizes), options['history'])
+        results = []
+        for name in scenarios:
+            for size in sizes:
+                metrics = asyncio.run(SCENARIOS[name](application, env, size, options))
+                results.append({'scenario': name, 'room_size': size, **metrics})
+                self.stdout.write(f"{name:>10} size={size:<6} {json.dumps(metrics)}")
+        return results
@@ -0,0 +1,61 @@
+import asyncio
+import json
+import time
+from django.core.management.base import BaseCommand
+from chatrooms.consumers.ChatRoomConsumer import ChatConsumer
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the CPU spent delivering one group message to every subscriber of a room, "
+        "with per-subscriber encoding versus a frame encoded once by the sender"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000,5000',
+                            help="Comma-separated room sizes (number of subscribers)")
+        parser.add_argument('--messages', type=int, default=200, help="Messages delivered per room size")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        self.stdout.write(f"{'subscribers':>12} {'per-subscriber us/msg':>22} {'encode-once us/msg':>19} {'saved':>7}")
+        for size in sizes:
+            legacy, encoded = asyncio.run(self.measure(size, options['messages']))
+            saved = 1 - encoded / legacy if legacy else 0
+            self.stdout.write(f"{size:>12} {legacy:>22.1f} {encoded:>19.1f} {saved:>7.0%}")
+
+    async def measure(self, size, messages):
+        consumers = [self.make_consumer() for _ in range(size)]
+        payload = {
+            'message': 'x' * 120,
+            'username': 'benchmark-user',
+            'profile_image_url': 'http://127.0.0.1:8001/media/profile_images/benchmark.png',
+            'timestamp': '2024-10-01T12:00:00.000000',
+        }
+        legacy_event = dict(payload, type='chat_message', profile_image=payload['profile_image_url'])
+        del legacy_event['profile_image_url']
+
+        async def deliver(make_event):
+            start = time.process_time()
+            for _ in range(messages):
+                event = make_event()
+                for consumer in consumers:
+                    await consumer.chat_message(event)
+            return (time.process_time() - start) / messages * 1e6
+
+        legacy = await deliver(lambda: legacy_event)
+        encoded = await deliver(lambda: {'type': 'chat_message', 'text': json.dumps(payload)})
+        return legacy, encoded
+
+    @staticmethod
+    def make_consumer():
+        consumer = ChatConsumer()
+        consumer.outbox = NullOutbox()
+        return consumer
+
+
+class NullOutbox:
+    """Discards frames, so only the cost of producing them is measured."""
+
+    def put(self, text, sent_at=None):
+        pass
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from chatrooms.benchmark import summarize_ms
+
+# mode: (channel layer mode, shard over all hosts)
+MODES = {
+    'core': ('core', False),
+    'pubsub': ('pubsub', False),
+    'core-sharded': ('core', True),
+    'pubsub-sharded': ('pubsub', True),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare group fan-out latency and throughput of the channel layer modes against "
+        "live Redis: 'core' on the first of CHANNEL_LAYER_HOSTS is the default setup, the "
+        "'-sharded' modes spread room groups over all of them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', default=','.join(MODES), help=f"Comma-separated modes ({', '.join(MODES)})")
+        parser.add_argument('--hosts', default=','.join(settings.CHANNEL_LAYER_HOSTS),
+                            help="Comma-separated Redis URLs (default: CHANNEL_LAYER_HOSTS)")
+        parser.add_argument('--rooms', type=int, default=50, help="Room groups")
+        parser.add_argument('--room-size', type=int, default=20, help="Subscribed channels per room")
+        parser.add_argument('--messages', type=int, default=500, help="group_send calls, spread over the rooms")
+        parser.add_argument('--timeout', type=float, default=30, help="Seconds to wait for all deliveries")
+        parser.add_argument('--output', default=None, help="Also write the results as JSON")
+
+    def handle(self, *args, **options):
+        modes = options['modes'].split(',')
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise CommandError(f"Unknown modes: {', '.join(sorted(unknown))}")
+        hosts = options['hosts'].split(',')
+
+        results = []
+        for mode in modes:
+            layer_mode, sharded = MODES[mode]
+            mode_hosts = hosts if sharded else hosts[:1]
+            layer = import_string(settings.CHANNEL_LAYER_BACKENDS[layer_mode])(
+                hosts=mode_hosts, capacity=options['messages'] + 10,
+            )
+            metrics = asyncio.run(self.measure(layer, options))
+            results.append({'mode': mode, 'hosts': len(mode_hosts), **metrics})
+            self.stdout.write(f"{mode:>15} hosts={len(mode_hosts):<3} {json.dumps(metrics)}")
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'options': {key: options[key] for key in ('rooms', 'room_size', 'messages')},
+                           'results': results}, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    async def measure(self, layer, options):
+        rooms, room_size, messages = options['rooms'], options['room_size'], options['messages']
+        groups = [f'chat_bench{index}' for index in range(rooms)]
+        members = {group: [await layer.new_channel() for _ in range(room_size)] for group in groups}
+        for group, channels in members.items():
+            for channel in channels:
+                await layer.group_add(group, channel)
+
+        # Messages go to the rooms round-robin
+        expected = {group: len(range(index, messages, rooms)) for index, group in enumerate(groups)}
+        latencies = []
+
+        async def receive_all(channel, count):
+            for _ in range(count):
+                message = await layer.receive(channel)
+                latencies.append(time.perf_counter() - message['sent_at'])
+
+        receivers = [
+            asyncio.create_task(receive_all(channel, expected[group]))
+            for group, channels in members.items() for channel in channels
+        ]
+        # Let pub/sub subscriptions settle before the clock starts
+        await asyncio.sleep(0.5)
+
+        start = time.perf_counter()
+        for index in range(messages):
+            await layer.group_send(groups[index % rooms], {'type': 'chat.message', 'sent_at': time.perf_counter()})
+        sent = time.perf_counter() - start
+        try:
+            await asyncio.wait_for(asyncio.gather(*receivers), options['timeout'])
+        finally:
+            elapsed = time.perf_counter() - start
+            for task in receivers:
+                task.cancel()
+            for group, channels in members.items():
+                for channel in channels:
+                    await layer.group_discard(group, channel)
+            await layer.flush()
+
+        return {
+            'group_sends_per_sec': round(messages / sent, 1),
+            'deliveries_per_sec': round(len(latencies) / elapsed, 1),
+            'delivery_latency': summarize_ms(latencies),
+        }
@@ -0,0 +1,79 @@
+import json
+import random
+import time
+from django.core.management.base import BaseCommand
+from chatrooms import protocol
+
+WORDS = (
+    'the a to and of in is it you that for on with this was are have be at but not what so can just '
+    'like do get if we they meeting tomorrow deploy release fixed thanks lol ok sure review branch '
+    'coffee lunch later monday bug ticket merge build failing works again yes no maybe'
+).split()
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the size on the wire and the CPU spent encoding chat frames as JSON text, "
+        "MessagePack (chat.msgpack.v1) and MessagePack with deflate (chat.msgpack-deflate.v1)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--history', type=int, default=50, help="Messages in a history page")
+        parser.add_argument('--repeat', type=int, default=2000, help="Encodings timed per frame and framing")
+
+    def handle(self, *args, **options):
+        messages = self.make_messages(options['history'])
+        frames = [
+            ('chat message', messages[0], True),
+            ('lobby event', {'type': 'room_updated', 'event': 1234, 'room': {
+                'id': 42, 'title': 'release planning', 'room_type': 'private', 'participant_count': 12}}, True),
+            ('batch of 20', json.loads(protocol.encode_frame_batch([json.dumps(m) for m in messages[:20]])), False),
+            (f'history of {len(messages)}', protocol.history_batch(messages, '2024-10-01T12:00:00+00:00:1'), False),
+        ]
+        framings = [
+            ('json', protocol.JsonCodec()),
+            (protocol.MSGPACK, protocol.MsgpackCodec()),
+            (protocol.MSGPACK_DEFLATE, protocol.MsgpackCodec(deflate=True)),
+        ]
+
+        self.stdout.write(f"{'frame':<16} {'framing':<24} {'bytes':>8} {'vs json':>8} {'encode us':>10}")
+        for name, data, broadcast in frames:
+            json_size = None
+            for framing, codec in framings:
+                encode = self.encoder(codec, data, broadcast)
+                size = len(self.wire_bytes(encode()))
+                json_size = json_size or size
+                start = time.process_time()
+                for _ in range(options['repeat']):
+                    encode()
+                cpu = (time.process_time() - start) / options['repeat'] * 1e6
+                self.stdout.write(f"{name:<16} {framing:<24} {size:>8} {size / json_size:>8.0%} {cpu:>10.1f}")
+
+    @staticmethod
+    def encoder(codec, data, broadcast):
+        if not broadcast or not codec.binary:
+            return lambda: codec.encode_data(data)
+        # Broadcast frames are JSON text encoded once by the sender, converted
+        # per worker; skip the cache so each round pays for the conversion
+        return lambda: codec.frame(protocol.pack_json.__wrapped__(json.dumps(data)))
+
+    @staticmethod
+    def wire_bytes(frame):
+        return frame.encode() if isinstance(frame, str) else frame
+
+    @staticmethod
+    def make_messages(count):
+        rng = random.Random(0)
+        users = [(f'user-{index}', f'{rng.getrandbits(64):016x}') for index in range(8)]
+        messages = []
+        for index in range(count):
+            username, avatar_version = rng.choice(users)
+            messages.append({
+                'id': 100000 + index,
+                'seq': 5000 + index,
+                'message': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 30))),
+                'username': username,
+                'avatar_version': avatar_version,
+                'timestamp': f'2024-10-01T12:{index // 60 % 60:02d}:{index % 60:02d}.{rng.randrange(10 ** 6):06d}+00:00',
+            })
+        return messages
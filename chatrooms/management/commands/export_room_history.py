@@ -0,0 +1,45 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from chatrooms import export
+from chatrooms.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the messages of a room as NDJSON (optionally gzipped), in seq order, "
+        "reading them through a server-side cursor"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_id', type=int)
+        parser.add_argument('--output', '-o', default='-', help="File to write to; '-' for stdout (default)")
+        parser.add_argument('--gzip', action='store_true', help="Compress the output")
+        parser.add_argument('--since', help="Only messages at or after this ISO 8601 time")
+        parser.add_argument('--until', help="Only messages before this ISO 8601 time")
+        parser.add_argument('--after-seq', help="Only messages after this seq, to resume an interrupted export")
+        parser.add_argument('--chunk-size', type=int, default=None, help="Messages fetched and written at a time")
+
+    def handle(self, *args, **options):
+        room_id = options['room_id']
+        if not ChatRoom.objects.filter(id=room_id).exists():
+            raise CommandError(f"Room {room_id} does not exist")
+        try:
+            since = export.parse_time(options['since'])
+            until = export.parse_time(options['until'])
+            after_seq = export.parse_after_seq(options['after_seq'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        chunks = export.export_chunks(room_id, since, until, after_seq, options['chunk_size'])
+        if options['gzip']:
+            chunks = export.gzip_chunks(chunks)
+        out = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        written = 0
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+                written += len(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        self.stderr.write(f"Exported room {room_id}: {written} bytes")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from chatrooms import export
+
+
+class Command(BaseCommand):
+    help = (
+        "Load messages from a room export or partition archive (NDJSON, gzipped or not). "
+        "Messages at or below the room's last_seq are skipped, so the import can be rerun."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Export or archive file; '-' for stdin")
+        parser.add_argument('--room', type=int, default=None,
+                            help="Room to load all messages into, instead of their room_id")
+        parser.add_argument('--create-users', action='store_true',
+                            help="Create missing authors as inactive users instead of failing")
+        parser.add_argument('--batch-size', type=int, default=None, help="Messages inserted per batch")
+
+    def handle(self, *args, **options):
+        importer = export.Importer(options['room'], options['create_users'], options['batch_size'])
+        try:
+            with export.open_export(options['path']) as lines:
+                imported, skipped = importer.run(export.read_records(lines))
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Imported {imported} messages, skipped {skipped} already present"))
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chatrooms import storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Create upcoming ChatMessage partitions, delete messages past their retention "
+        "and archive old partitions. Meant to run daily."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--premake', type=int, default=settings.CHAT_PARTITION_PREMAKE_MONTHS,
+                            help="Months of partitions to keep created ahead of the current one")
+        parser.add_argument('--archive-after', type=int, default=settings.CHAT_ARCHIVE_AFTER_MONTHS,
+                            help="Archive and drop partitions that ended this many months ago. Off by default.")
+        parser.add_argument('--archive-dir', default=settings.CHAT_ARCHIVE_DIR,
+                            help="Directory the archived partitions are written to")
+        parser.add_argument('--keep-detached', action='store_true',
+                            help="Detach archived partitions but do not drop them")
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_RETENTION_BATCH_SIZE,
+                            help="Messages deleted per statement when applying retention")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be done")
+
+    def handle(self, *args, **options):
+        partitioned = storage.is_partitioned()
+        dry_run = options['dry_run']
+        would = "would be " if dry_run else ""
+
+        if partitioned:
+            if dry_run:
+                existing = set(storage.list_partitions())
+                upcoming = (storage.add_months(storage.current_month(), offset) for offset in range(options['premake'] + 1))
+                created = [month for month in upcoming if month not in existing]
+            else:
+                created = storage.ensure_partitions(options['premake'])
+            for month in created:
+                self.stdout.write(f"Partition {storage.partition_name(month)} {would}created")
+        else:
+            self.stdout.write("Messages are not partitioned, skipping partitions and archiving")
+
+        if dry_run:
+            deleted = {room_type: expired.count() for room_type, expired, _ in storage.expired_messages()}
+        else:
+            deleted = storage.apply_retention(options['batch_size'])
+        for room_type, count in deleted.items():
+            self.stdout.write(f"{count} expired {room_type} messages {would}deleted")
+
+        if partitioned and options['archive_after'] is not None:
+            for month in storage.archivable_months(options['archive_after']):
+                if dry_run:
+                    self.stdout.write(f"Partition {storage.partition_name(month)} would be archived")
+                    continue
+                path, rows = storage.archive_partition(
+                    month, options['archive_dir'], drop=not options['keep_detached'])
+                self.stdout.write(f"Archived {rows} messages of {storage.partition_name(month)} to {path}")
+        self.stdout.write(self.style.SUCCESS("Done"))
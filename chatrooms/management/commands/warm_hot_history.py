@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from chatrooms import hot_history
+from chatrooms.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = "Load the latest messages of chat rooms into the Redis hot history buffers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', type=int, action='append', dest='room_ids',
+                            help="Room id to warm; may be repeated. Defaults to all rooms.")
+        parser.add_argument('--room-type', choices=[choice for choice, _ in ChatRoom.ROOM_TYPE_CHOICES],
+                            help="Only warm rooms of this type")
+
+    def handle(self, *args, **options):
+        rooms = ChatRoom.objects.all()
+        if options['room_ids']:
+            rooms = rooms.filter(id__in=options['room_ids'])
+        if options['room_type']:
+            rooms = rooms.filter(room_type=options['room_type'])
+
+        warmed = 0
+        for room in rooms.iterator():
+            if not hot_history.buffer_size(room.room_type):
+                continue
+            frames = hot_history.warm(room)
+            warmed += 1
+            self.stdout.write(f"Room {room.id} ({room.room_type}): {len(frames)} messages")
+        self.stdout.write(self.style.SUCCESS(f"Warmed {warmed} rooms"))
@@ -0,0 +1,198 @@
+"""
+Loading, persisting and broadcasting chat messages, shared by the per-room
+chat socket and the multiplexed socket.
+"""
+import json
+import logging
+import time
+from django.conf import settings
+from redis.exceptions import RedisError
+from chatapp import async_db, metrics
+from chatapp.metrics import database_sync_to_async, timed
+from chatrooms import hot_history
+from chatrooms.history import (
+    clamp_page_size, covers_history, covers_seqs, fetch_messages_after, get_history_page, history_page,
+    history_queryset, hot_window_start, messages_after_queryset, serialize_message,
+)
+from chatrooms.models import ChatMessage, ChatRoom
+from chatrooms.persistence import get_write_behind_queue, is_write_behind, reserve_seq
+
+logger = logging.getLogger(__name__)
+
+
+def room_group(room_id):
+    return f'chat_{room_id}'
+
+
+def tag_frame(room_id, text):
+    """Add the room id to an encoded JSON object frame without decoding it."""
+    return f'{{"room": {room_id}, ' + text[1:]
+
+
+def event_frame(event):
+    """The frame of a chat_message event."""
+    if 'text' in event:
+        return event['text']
+    # Events from workers that predate pre-encoded frames
+    return json.dumps({
+        'message': event['message'],
+        'username': event['username'],
+        'profile_image_url': event['profile_image'],
+        'timestamp': event['timestamp'],
+    })
+
+
+async def get_chat_messages(room_id, before=None, limit=None):
+    if async_db.is_enabled():
+        limit = clamp_page_size(limit)
+        since = hot_window_start()
+        if since is not None:
+            messages = await async_db.fetch(history_queryset(room_id, before, limit, since))
+            if covers_history(messages, limit):
+                return history_page(messages, limit)
+        return history_page(await async_db.fetch(history_queryset(room_id, before, limit)), limit)
+    return await database_sync_to_async(get_history_page)(room_id, before=before, limit=limit)
+
+
+@timed('save_message')
+async def save_message(room_id, user, content):
+    if not async_db.is_enabled():
+        return await database_sync_to_async(ChatMessage.objects.create)(room_id=room_id, user=user, content=content)
+    message = ChatMessage(room_id=room_id, user=user, content=content)
+    # As in ChatMessage.save(), the seq is allocated in the inserting transaction
+    async with async_db.transaction() as conn:
+        message.seq = await async_db.increment(conn, ChatRoom, room_id, 'last_seq')
+        if message.seq is None:
+            raise ChatRoom.DoesNotExist(f"Room {room_id} does not exist")
+        await async_db.insert(message, conn)
+    return message
+
+
+async def get_hot_history(room):
+    """The latest page of a room as encoded frames, or None to fall back to Postgres."""
+    if not hot_history.buffer_size(room.room_type):
+        return None
+    page_size = settings.CHAT_HISTORY_PAGE_SIZE
+    try:
+        frames = await hot_history.read_latest(room, page_size)
+        if frames is None:
+            frames = (await database_sync_to_async(hot_history.warm)(room))[-page_size:]
+    except RedisError as e:
+        logger.warning(f"Hot history unavailable for room {room.id}: {e}")
+        return None
+    # A sender may not have added its message yet while a later one has
+    return frames if frame_seqs(frames) is not None else None
+
+
+def frame_seqs(frames):
+    """The seqs of buffered frames, or None unless they follow one another without gaps."""
+    seqs = [json.loads(frame).get('seq') for frame in frames]
+    if None in seqs or any(later != earlier + 1 for earlier, later in zip(seqs, seqs[1:])):
+        return None
+    return seqs
+
+
+async def get_latest_history(room):
+    frames = await get_hot_history(room)
+    if frames is None:
+        return await get_chat_messages(room.id)
+    messages = [json.loads(frame) for frame in frames]
+    full_page = len(messages) >= settings.CHAT_HISTORY_PAGE_SIZE
+    return messages, messages[0]['id'] if full_page else None
+
+
+async def get_messages_since(room, last_seq):
+    """
+    Encoded frames of the messages of a room after `last_seq`, oldest first,
+    or None when the client missed more than CHAT_RESUME_MAX_GAP of them and
+    should reload history over REST instead.
+    """
+    frames = await get_hot_frames_since(room, last_seq)
+    if frames is not None:
+        return frames
+    limit = settings.CHAT_RESUME_MAX_GAP
+    if async_db.is_enabled():
+        since = hot_window_start()
+        messages = None
+        if since is not None:
+            messages = await async_db.fetch(messages_after_queryset(room.id, last_seq, limit + 1, since))
+            if not covers_seqs(messages, last_seq):
+                messages = None
+        if messages is None:
+            messages = await async_db.fetch(messages_after_queryset(room.id, last_seq, limit + 1))
+        messages = [serialize_message(message) for message in messages]
+    else:
+        messages = await database_sync_to_async(fetch_messages_after)(room.id, last_seq, limit + 1)
+    if len(messages) > limit:
+        return None
+    return [json.dumps(message) for message in messages]
+
+
+async def get_hot_frames_since(room, last_seq):
+    """The gap from the hot history buffer, or None when the buffer does not cover it."""
+    size = hot_history.buffer_size(room.room_type)
+    if not size:
+        return None
+    try:
+        frames = await hot_history.read_latest(room, size)
+    except RedisError as e:
+        logger.warning(f"Hot history unavailable for room {room.id}: {e}")
+        return None
+    if frames is None:
+        return None
+    seqs = frame_seqs(frames)
+    if seqs is None or (seqs and seqs[0] > last_seq + 1):
+        return None
+    missed = [frame for frame, seq in zip(frames, seqs) if seq > last_seq]
+    return missed if len(missed) <= settings.CHAT_RESUME_MAX_GAP else None
+
+
+def parse_message(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError("Message must be a non-empty string")
+    return value
+
+
+async def publish_message(channel_layer, room, user, content):
+    """
+    Save and broadcast a message. In write-behind mode it is broadcast at
+    once, with a reserved seq and no id yet, and saved with the next batch;
+    raises QueueFull when the queue cannot take it.
+    """
+    if is_write_behind():
+        queue = get_write_behind_queue()
+        queue.check_capacity()
+        message = ChatMessage(room=room, user=user, content=content)
+        message.seq = await areserve_seq(room.id)
+        queue.enqueue(message)
+        await broadcast(channel_layer, room.id, json.dumps(serialize_message(message)))
+        return
+    message = await save_message(room.id, user, content)
+    frame = json.dumps(serialize_message(message))
+    await hot_history.append(room, {frame: message.seq})
+    await broadcast(channel_layer, room.id, frame)
+
+
+async def areserve_seq(room_id):
+    if not async_db.is_enabled():
+        return await database_sync_to_async(reserve_seq)(room_id)
+    async with async_db.transaction() as conn:
+        seq = await async_db.increment(conn, ChatRoom, room_id, 'last_seq')
+    if seq is None:
+        raise ChatRoom.DoesNotExist(f"Room {room_id} does not exist")
+    return seq
+
+
+async def broadcast(channel_layer, room_id, frame):
+    # The frame is encoded once, here or for the hot history buffer, and every
+    # subscriber just writes the text out.
+    with metrics.CHANNEL_LAYER_SECONDS.labels(operation='group_send').time():
+        await channel_layer.group_send(
+            room_group(room_id),
+            {
+                'type': 'chat_message',
+                'room': room_id,
+                'sent_at': time.time(),
+                'text': frame,
+            }
+        )
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.1 on 2026-10-18 04:44
+
+from django.db import migrations
+
+
+def collapse_public_participants(apps, schema_editor):
+    # Public rooms are open to every user; their participant rows only
+    # duplicated the user table.
+    ChatRoom = apps.get_model('chatrooms', 'ChatRoom')
+    Participant = ChatRoom.participants.through
+    Participant.objects.filter(chatroom__room_type='public').delete()
+
+
+def materialize_public_participants(apps, schema_editor):
+    ChatRoom = apps.get_model('chatrooms', 'ChatRoom')
+    CustomUser = apps.get_model('users', 'CustomUser')
+    Participant = ChatRoom.participants.through
+    user_ids = list(CustomUser.objects.values_list('id', flat=True))
+    for room_id in ChatRoom.objects.filter(room_type='public').values_list('id', flat=True).iterator():
+        Participant.objects.bulk_create(
+            [Participant(chatroom_id=room_id, customuser_id=user_id) for user_id in user_ids],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatrooms', '0004_chatmessage_timestamp_default'),
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(collapse_public_participants, materialize_public_participants),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:02
+
+from django.db import migrations, models
+
+# Number existing messages 1, 2, 3, ... per room in (timestamp, id) order
+POSTGRES_BACKFILL_SQL = [
+    '''
+    UPDATE chatrooms_chatmessage AS m SET seq = numbered.seq
+    FROM (
+        SELECT id, row_number() OVER (PARTITION BY room_id ORDER BY timestamp, id) AS seq
+        FROM chatrooms_chatmessage
+    ) AS numbered
+    WHERE m.id = numbered.id
+    ''',
+    '''
+    UPDATE chatrooms_chatroom AS r SET last_seq = counts.last_seq
+    FROM (SELECT room_id, MAX(seq) AS last_seq FROM chatrooms_chatmessage GROUP BY room_id) AS counts
+    WHERE r.id = counts.room_id
+    ''',
+]
+
+
+def backfill_seq(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for statement in POSTGRES_BACKFILL_SQL:
+            schema_editor.execute(statement)
+        return
+
+    ChatRoom = apps.get_model('chatrooms', 'ChatRoom')
+    ChatMessage = apps.get_model('chatrooms', 'ChatMessage')
+    for room_id in ChatRoom.objects.values_list('id', flat=True).iterator():
+        messages = list(ChatMessage.objects.filter(room_id=room_id).order_by('timestamp', 'id').only('id'))
+        for seq, message in enumerate(messages, start=1):
+            message.seq = seq
+        ChatMessage.objects.bulk_update(messages, ['seq'], batch_size=1000)
+        ChatRoom.objects.filter(id=room_id).update(last_seq=len(messages))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatrooms', '0005_collapse_public_room_participants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chatmessage_room_seq_uniq'),
+        ),
+    ]
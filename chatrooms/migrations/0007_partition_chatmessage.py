@@ -0,0 +1,121 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:27
+
+import datetime
+from django.db import migrations, models
+
+# On PostgreSQL chatrooms_chatmessage becomes a table partitioned by month on
+# "timestamp" (see chatrooms.storage). The primary key of a partitioned table
+# must contain the partition key, so it becomes (id, timestamp), and
+# (room_id, seq) can only be indexed per partition rather than be unique;
+# seqs stay unique because ChatRoom.allocate_seqs() hands them out. Other
+# databases just swap the unique constraint for a plain index.
+
+ROOM_SEQ_INDEX = models.Index(fields=['room', 'seq'], name='chatmessage_room_seq_idx')
+ROOM_SEQ_CONSTRAINT = models.UniqueConstraint(fields=['room', 'seq'], name='chatmessage_room_seq_uniq')
+
+PREMAKE_MONTHS = 3
+
+# Indexes and foreign keys of the table after the conversion, with the names
+# Django gave them originally
+INDEX_SQL = [
+    'CREATE INDEX chatrooms_chatmessage_user_id_725835a4 ON chatrooms_chatmessage (user_id)',
+    'CREATE INDEX chatrooms_chatmessage_room_id_e56ac257 ON chatrooms_chatmessage (room_id)',
+    'CREATE INDEX chatmessage_room_ts_id_idx ON chatrooms_chatmessage (room_id, "timestamp", id)',
+    'ALTER TABLE chatrooms_chatmessage ADD CONSTRAINT chatrooms_chatmessage_user_id_725835a4_fk_users_customuser_id '
+    'FOREIGN KEY (user_id) REFERENCES users_customuser (id) DEFERRABLE INITIALLY DEFERRED',
+    'ALTER TABLE chatrooms_chatmessage ADD CONSTRAINT chatrooms_chatmessage_room_id_e56ac257_fk_chatrooms_chatroom_id '
+    'FOREIGN KEY (room_id) REFERENCES chatrooms_chatroom (id) DEFERRABLE INITIALLY DEFERRED',
+]
+
+
+def add_months(month, count):
+    years, month_index = divmod(month.month - 1 + count, 12)
+    return datetime.date(month.year + years, month_index + 1, 1)
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        ChatMessage = apps.get_model('chatrooms', 'ChatMessage')
+        schema_editor.remove_constraint(ChatMessage, ROOM_SEQ_CONSTRAINT)
+        schema_editor.add_index(ChatMessage, ROOM_SEQ_INDEX)
+        return
+
+    execute = schema_editor.execute
+    execute('LOCK TABLE chatrooms_chatmessage IN ACCESS EXCLUSIVE MODE')
+    execute('ALTER TABLE chatrooms_chatmessage RENAME TO chatrooms_chatmessage_unpartitioned')
+    execute(
+        'CREATE TABLE chatrooms_chatmessage '
+        '(LIKE chatrooms_chatmessage_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+        'PARTITION BY RANGE ("timestamp")'
+    )
+    # Partitioned tables cannot have identity columns before PostgreSQL 17
+    execute('CREATE SEQUENCE chatrooms_chatmessage_id_seq_new OWNED BY chatrooms_chatmessage.id')
+    execute("ALTER TABLE chatrooms_chatmessage ALTER COLUMN id SET DEFAULT nextval('chatrooms_chatmessage_id_seq_new')")
+    execute('ALTER TABLE chatrooms_chatmessage ADD CONSTRAINT chatrooms_chatmessage_pkey_new PRIMARY KEY (id, "timestamp")')
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT MIN("timestamp"), MAX(id) FROM chatrooms_chatmessage_unpartitioned')
+        oldest, max_id = cursor.fetchone()
+    month = datetime.datetime.now(datetime.timezone.utc).date().replace(day=1)
+    last = add_months(month, PREMAKE_MONTHS)
+    if oldest is not None:
+        month = min(month, oldest.date().replace(day=1))
+    while month <= last:
+        end = add_months(month, 1)
+        execute(
+            f'CREATE TABLE chatrooms_chatmessage_p{month:%Y_%m} PARTITION OF chatrooms_chatmessage '
+            f"FOR VALUES FROM ('{month} 00:00:00+00') TO ('{end} 00:00:00+00')"
+        )
+        month = end
+    execute('CREATE TABLE chatrooms_chatmessage_default PARTITION OF chatrooms_chatmessage DEFAULT')
+
+    execute('INSERT INTO chatrooms_chatmessage SELECT * FROM chatrooms_chatmessage_unpartitioned')
+    if max_id is not None:
+        execute("SELECT setval('chatrooms_chatmessage_id_seq_new', %s)", [max_id])
+    execute('DROP TABLE chatrooms_chatmessage_unpartitioned')
+    execute('ALTER SEQUENCE chatrooms_chatmessage_id_seq_new RENAME TO chatrooms_chatmessage_id_seq')
+    execute('ALTER TABLE chatrooms_chatmessage RENAME CONSTRAINT chatrooms_chatmessage_pkey_new TO chatrooms_chatmessage_pkey')
+    for statement in INDEX_SQL:
+        execute(statement)
+    execute('CREATE INDEX chatmessage_room_seq_idx ON chatrooms_chatmessage (room_id, seq)')
+    execute('ANALYZE chatrooms_chatmessage')
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        ChatMessage = apps.get_model('chatrooms', 'ChatMessage')
+        schema_editor.remove_index(ChatMessage, ROOM_SEQ_INDEX)
+        schema_editor.add_constraint(ChatMessage, ROOM_SEQ_CONSTRAINT)
+        return
+
+    execute = schema_editor.execute
+    execute('LOCK TABLE chatrooms_chatmessage IN ACCESS EXCLUSIVE MODE')
+    execute('ALTER TABLE chatrooms_chatmessage RENAME TO chatrooms_chatmessage_partitioned')
+    execute(
+        'CREATE TABLE chatrooms_chatmessage '
+        '(LIKE chatrooms_chatmessage_partitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+    )
+    execute('ALTER SEQUENCE chatrooms_chatmessage_id_seq OWNED BY chatrooms_chatmessage.id')
+    execute('INSERT INTO chatrooms_chatmessage SELECT * FROM chatrooms_chatmessage_partitioned')
+    execute('DROP TABLE chatrooms_chatmessage_partitioned')
+    execute('ALTER TABLE chatrooms_chatmessage ADD CONSTRAINT chatrooms_chatmessage_pkey PRIMARY KEY (id)')
+    for statement in INDEX_SQL:
+        execute(statement)
+    execute('ALTER TABLE chatrooms_chatmessage ADD CONSTRAINT chatmessage_room_seq_uniq UNIQUE (room_id, seq)')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatrooms', '0006_message_seq'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(partition, unpartition)],
+            state_operations=[
+                migrations.RemoveConstraint(model_name='chatmessage', name='chatmessage_room_seq_uniq'),
+                migrations.AddIndex(model_name='chatmessage', index=ROOM_SEQ_INDEX),
+            ],
+        ),
+    ]
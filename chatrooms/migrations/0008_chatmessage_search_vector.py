@@ -0,0 +1,39 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:34
+
+from django.db import migrations
+
+# Postgres-only full-text search column and index (see chatrooms.search). The
+# column is generated by the database, so it is not part of the model and
+# other databases (SQLite in benchmarks) do without it. On the partitioned
+# table both are created on every partition.
+FORWARD_SQL = [
+    'ALTER TABLE chatrooms_chatmessage ADD COLUMN IF NOT EXISTS search_vector tsvector '
+    "GENERATED ALWAYS AS (to_tsvector('english'::regconfig, content)) STORED",
+    'CREATE INDEX IF NOT EXISTS chatmessage_search_vector_idx '
+    'ON chatrooms_chatmessage USING gin (search_vector)',
+]
+
+REVERSE_SQL = [
+    'DROP INDEX IF EXISTS chatmessage_search_vector_idx',
+    'ALTER TABLE chatrooms_chatmessage DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def run_on_postgres(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatrooms', '0007_partition_chatmessage'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_postgres(FORWARD_SQL), run_on_postgres(REVERSE_SQL)),
+    ]
@@ -1,5 +1,7 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 
 CustomUser = get_user_model()
 
@@ -17,16 +19,89 @@ class ChatRoom(models.Model):
     owner = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='owned_rooms')
     participants = models.ManyToManyField(CustomUser, related_name='rooms', blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Sequence number of the latest message, only ever changed by allocate_seqs()
+    last_seq = models.PositiveBigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        # Never write back a possibly stale last_seq from an updated instance.
+        # Instances being added may have a pk (fixtures, explicit ids) and
+        # must still be inserted.
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'last_seq'
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def allocate_seqs(cls, room_id, count):
+        """
+        Reserve the next `count` sequence numbers of a room and return the first.
+        Runs in a transaction, normally the one that inserts the messages: the
+        row lock taken here makes concurrent writers to the room commit in seq
+        order. Write-behind reserves seqs ahead of inserting the messages
+        (chatrooms.persistence.reserve_seq).
+        """
+        cls.objects.filter(id=room_id).update(last_seq=F('last_seq') + count)
+        return cls.objects.filter(id=room_id).values_list('last_seq', flat=True).get() - count + 1
+
+    def is_accessible_by(self, user):
+        if self.room_type == 'public':
+            return True
+        if self.room_type in ('private', 'one-to-one'):
+            return self.participants.filter(id=user.id).exists()
+        return False
+
 
 class ChatMessage(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is received rather than when the row is inserted, so
+    # messages persisted in write-behind batches keep their original time.
+    timestamp = models.DateTimeField(default=timezone.now)
+    # Position in the room, 1, 2, 3, ... in commit order, except that write-behind
+    # reserves it as messages arrive. Clients resume from it.
+    seq = models.PositiveBigIntegerField(editable=False)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of room history: WHERE room_id = ? ORDER BY timestamp, id
+            models.Index(fields=['room', 'timestamp', 'id'], name='chatmessage_room_ts_id_idx'),
+            # Messages of a room after seq N. Not a unique constraint: on
+            # PostgreSQL the table is partitioned by month (see
+            # chatrooms.storage) and unique indexes must include the
+            # timestamp. ChatRoom.allocate_seqs() keeps seqs unique.
+            models.Index(fields=['room', 'seq'], name='chatmessage_room_seq_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.seq is not None:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            try:
+                self.seq = ChatRoom.allocate_seqs(self.room_id, 1)
+                super().save(*args, **kwargs)
+            except Exception:
+                self.seq = None
+                raise
 
     def __str__(self):
         return f"{self.user.username}: {self.content[:20]}..."  # Display first 20 chars of the message
+
+
+class ReadPointer(models.Model):
+    """How far a user has read a room. Unread count = room.last_seq - last_read_seq."""
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='read_pointers')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_pointers')
+    last_read_seq = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # Also the index behind "pointers of a user"
+            models.UniqueConstraint(fields=['user', 'room'], name='readpointer_user_room_uniq'),
+        ]
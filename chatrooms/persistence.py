@@ -0,0 +1,161 @@
+import asyncio
+import atexit
+import logging
+from django.conf import settings
+from chatapp import metrics
+from chatapp.metrics import database_sync_to_async
+from django.db import IntegrityError, transaction
+from chatrooms import hot_history
+from chatrooms.models import ChatMessage, ChatRoom
+
+logger = logging.getLogger(__name__)
+
+SYNC = 'sync'
+WRITE_BEHIND = 'write_behind'
+
+CHAT_WRITE_BEHIND_REJECTED = metrics.Counter(
+    'chat_write_behind_rejected', "Chat messages refused because the write-behind queue was full")
+
+
+class QueueFull(Exception):
+    pass
+
+
+def is_write_behind():
+    return settings.CHAT_PERSISTENCE_MODE == WRITE_BEHIND
+
+
+class WriteBehindQueue:
+    """
+    Per-process buffer of unsaved ChatMessage instances.
+
+    Messages are broadcast before they are queued, with a seq reserved as
+    they are received (see messaging.publish_message). A single flusher
+    task drains the buffer with bulk_create whenever it holds `batch_size`
+    messages or `flush_interval` seconds have passed since the first pending
+    message, then adds them to the hot history buffers. Messages of
+    different processes can therefore be committed out of seq order.
+
+    A batch that fails to be written goes back to the front of the queue and
+    is retried. While the database is down the queue refuses new messages
+    once `max_pending` are waiting, so memory stays bounded.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_pending):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = []
+        self._loop = None
+        self._flusher = None
+        self._has_data = None
+        self._full = None
+
+    def check_capacity(self):
+        """Raise QueueFull when no more messages can be taken."""
+        if len(self._pending) >= self.max_pending:
+            CHAT_WRITE_BEHIND_REJECTED.inc()
+            raise QueueFull("Too many messages are waiting to be saved, try again later")
+
+    def enqueue(self, message):
+        self._ensure_flusher()
+        self._pending.append(message)
+        self._has_data.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._flusher is None or self._flusher.done():
+            self._loop = loop
+            self._has_data = asyncio.Event()
+            self._full = asyncio.Event()
+            if self._pending:
+                self._has_data.set()
+            self._flusher = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._has_data.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        batch = self._take_batch()
+        if not batch:
+            return
+        try:
+            await database_sync_to_async(self._write)(batch)
+        except Exception:
+            logger.exception(f"Failed to persist {len(batch)} queued chat messages, retrying")
+            self._pending[:0] = batch
+            self._has_data.set()
+            await asyncio.sleep(self.flush_interval)
+            return
+        await self._append_to_hot_history(batch)
+
+    @staticmethod
+    async def _append_to_hot_history(batch):
+        try:
+            await hot_history.append_messages(batch)
+        except Exception:
+            # The buffer only speeds up history; readers go to the database
+            logger.exception(f"Failed to add {len(batch)} saved messages to hot history")
+
+    def flush_sync(self):
+        batch = self._take_batch()
+        if batch:
+            self._write(batch)
+            logger.info(f"Flushed {len(batch)} queued chat messages on shutdown")
+            # The event loop is gone by now; use one of our own
+            asyncio.run(self._append_to_hot_history(batch))
+
+    def _take_batch(self):
+        batch, self._pending = self._pending, []
+        if self._has_data is not None:
+            self._has_data.clear()
+            self._full.clear()
+        return batch
+
+    def _write(self, batch):
+        try:
+            with transaction.atomic():
+                ChatMessage.objects.bulk_create(batch, batch_size=self.batch_size)
+        except IntegrityError:
+            # Typically a room or user deleted while its messages were queued.
+            # Save the rest of the batch one by one and drop the offenders.
+            for message in batch:
+                message.pk = None
+                try:
+                    message.save()
+                except IntegrityError:
+                    message.pk = None
+                    logger.warning(f"Dropping queued message for room {message.room_id}: integrity error")
+
+
+def reserve_seq(room_id):
+    """The next seq of a room, for a message that will be inserted later."""
+    with transaction.atomic():
+        return ChatRoom.allocate_seqs(room_id, 1)
+
+
+_queue = None
+
+
+def get_write_behind_queue():
+    global _queue
+    if _queue is None:
+        _queue = WriteBehindQueue(
+            settings.CHAT_PERSIST_BATCH_SIZE, settings.CHAT_PERSIST_FLUSH_INTERVAL, settings.CHAT_PERSIST_MAX_PENDING)
+        atexit.register(_queue.flush_sync)
+    return _queue
+
+
+@metrics.registry.register_collector
+def collect_metrics():
+    yield '# HELP chat_write_behind_pending Chat messages queued for a write-behind flush'
+    yield '# TYPE chat_write_behind_pending gauge'
+    yield metrics.format_sample('chat_write_behind_pending', (), len(_queue._pending) if _queue else 0)
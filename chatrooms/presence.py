@@ -0,0 +1,244 @@
+"""
+Online presence and typing indicators for chat rooms.
+
+Who is online in a room is kept in Redis, in a sorted set per room scored by
+when each member expires, next to a hash counting the workers with sockets
+of each member. A user leaves when the last of those workers lets go of
+them, not when any one of them does. Every worker refreshes the members of
+its own sockets every CHAT_PRESENCE_HEARTBEAT seconds in one pipeline, so
+members of a worker that died drop out after CHAT_PRESENCE_TTL. Typing
+state is only kept by the worker of the typing socket.
+
+Joins, leaves and typing changes are not broadcast as they happen. Each
+worker collects them per room and every CHAT_PRESENCE_TICK seconds sends one
+'presence_update' event per changed room through the room's chat group:
+
+    {"type": "presence", "joined": [...], "left": [...], "typing": [...], "stopped_typing": [...]}
+
+Typing is broadcast when a user starts and when they stop (explicitly, by
+sending a message or after CHAT_TYPING_TIMEOUT seconds without a keystroke),
+never per keystroke.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import Counter, defaultdict
+from channels.layers import get_channel_layer
+from django.conf import settings
+from redis.exceptions import RedisError
+from chatapp import metrics
+from chatapp.redis_client import get_async_redis
+from chatrooms.messaging import room_group
+
+logger = logging.getLogger(__name__)
+
+CHANGE_KINDS = ('joined', 'left', 'typing', 'stopped_typing')
+# Within a tick a later change cancels the opposite one
+OPPOSITE = {'joined': 'left', 'left': 'joined', 'typing': 'stopped_typing', 'stopped_typing': 'typing'}
+
+CHAT_PRESENCE_UPDATES = metrics.Counter(
+    'chat_presence_updates', "Coalesced presence frames broadcast to rooms")
+CHAT_TYPING_SIGNALS = metrics.Counter(
+    'chat_typing_signals', "Typing signals received from clients")
+
+
+def presence_key(room_id):
+    return f'chat:presence:{room_id}'
+
+
+def workers_key(room_id):
+    return f'chat:presence:{room_id}:workers'
+
+
+class PresenceTracker:
+    """
+    Per-process state: the users of local sockets per room, typing users and
+    the changes waiting for the next tick. A ticker task runs while there
+    are local sockets or pending changes.
+    """
+
+    def __init__(self):
+        self.connections = defaultdict(Counter)
+        self.typing = {}
+        self.changes = {}
+        self._loop = None
+        self._ticker = None
+
+    async def join(self, room_id, username):
+        """
+        Count a local socket of `username` in a room. Returns a snapshot frame of
+        who is online for the new socket, or None if presence is unavailable.
+        """
+        self._ensure_ticker()
+        local = self.connections[room_id]
+        first_local = local[username] == 0
+        local[username] += 1
+        if not settings.CHAT_PRESENCE_ENABLED:
+            return None
+
+        key = presence_key(room_id)
+        now = time.time()
+        try:
+            async with get_async_redis().pipeline(transaction=False) as pipe:
+                if first_local:
+                    pipe.hincrby(workers_key(room_id), username, 1)
+                    pipe.expire(workers_key(room_id), settings.CHAT_PRESENCE_TTL)
+                pipe.zadd(key, {username: now + settings.CHAT_PRESENCE_TTL})
+                pipe.expire(key, settings.CHAT_PRESENCE_TTL)
+                pipe.zrangebyscore(key, now, '+inf', start=0, num=settings.CHAT_PRESENCE_SNAPSHOT_LIMIT)
+                pipe.zcount(key, now, '+inf')
+                added, _, online, online_count = (await pipe.execute())[-4:]
+        except RedisError as e:
+            logger.warning(f"Presence unavailable for room {room_id}: {e}")
+            return None
+        if added:
+            self._change(room_id, 'joined', username)
+        return json.dumps({
+            'type': 'presence',
+            'online': [member.decode() for member in online],
+            'online_count': online_count,
+            'typing': [user for room, user in self.typing if room == room_id],
+        })
+
+    async def leave(self, room_id, username):
+        local = self.connections[room_id]
+        local[username] -= 1
+        if local[username] > 0:
+            return
+        del local[username]
+        if not local:
+            del self.connections[room_id]
+        self.stop_typing(room_id, username)
+        if not settings.CHAT_PRESENCE_ENABLED:
+            return
+
+        redis = get_async_redis()
+        try:
+            workers = await redis.hincrby(workers_key(room_id), username, -1)
+            if workers > 0:
+                # Still connected through another worker
+                return
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.hdel(workers_key(room_id), username)
+                pipe.zrem(presence_key(room_id), username)
+                _, removed = await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Presence unavailable for room {room_id}: {e}")
+            return
+        if removed:
+            self._change(room_id, 'left', username)
+
+    def keystroke(self, room_id, username):
+        CHAT_TYPING_SIGNALS.inc()
+        key = (room_id, username)
+        if key not in self.typing:
+            self._change(room_id, 'typing', username)
+        self.typing[key] = time.monotonic()
+
+    def stop_typing(self, room_id, username):
+        if self.typing.pop((room_id, username), None) is not None:
+            self._change(room_id, 'stopped_typing', username)
+
+    def _change(self, room_id, kind, username):
+        changes = self.changes.setdefault(room_id, {kind: set() for kind in CHANGE_KINDS})
+        changes[OPPOSITE[kind]].discard(username)
+        changes[kind].add(username)
+        self._ensure_ticker()
+
+    def _ensure_ticker(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._ticker is None or self._ticker.done():
+            self._loop = loop
+            self._ticker = loop.create_task(self._run())
+
+    async def _run(self):
+        next_heartbeat = time.monotonic() + settings.CHAT_PRESENCE_HEARTBEAT
+        while self.connections or self.changes:
+            await asyncio.sleep(settings.CHAT_PRESENCE_TICK)
+            try:
+                self._expire_typing()
+                if time.monotonic() >= next_heartbeat:
+                    next_heartbeat = time.monotonic() + settings.CHAT_PRESENCE_HEARTBEAT
+                    await self._heartbeat()
+                await self._broadcast()
+            except Exception:
+                logger.exception("Presence tick failed")
+
+    def _expire_typing(self):
+        deadline = time.monotonic() - settings.CHAT_TYPING_TIMEOUT
+        for (room_id, username), last_keystroke in list(self.typing.items()):
+            if last_keystroke < deadline:
+                self.stop_typing(room_id, username)
+
+    async def _heartbeat(self):
+        if not settings.CHAT_PRESENCE_ENABLED or not self.connections:
+            return
+        now = time.time()
+        rooms = [(room_id, list(users)) for room_id, users in self.connections.items()]
+        redis = get_async_redis()
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for room_id, usernames in rooms:
+                    key = presence_key(room_id)
+                    # Members removed elsewhere, e.g. when another worker closed
+                    # the user's other socket, come back as joins.
+                    pipe.zmscore(key, usernames)
+                    pipe.zadd(key, {username: now + settings.CHAT_PRESENCE_TTL for username in usernames})
+                    pipe.expire(key, settings.CHAT_PRESENCE_TTL)
+                    pipe.expire(workers_key(room_id), settings.CHAT_PRESENCE_TTL)
+                    pipe.zrangebyscore(key, '-inf', now)
+                results = await pipe.execute()
+
+            rejoined = []
+            expired = []
+            for index, (room_id, usernames) in enumerate(rooms):
+                scores, _, _, _, stale = results[index * 5:index * 5 + 5]
+                for username, score in zip(usernames, scores):
+                    if score is None:
+                        rejoined.append((room_id, username))
+                        self._change(room_id, 'joined', username)
+                expired.extend((room_id, member.decode()) for member in stale)
+            if not rejoined and not expired:
+                return
+
+            # Several workers may find the same expired members; only the one
+            # that removes a member reports it. Members of workers that died
+            # leave their count behind, which goes with the member.
+            async with redis.pipeline(transaction=False) as pipe:
+                for room_id, username in rejoined:
+                    pipe.hincrby(workers_key(room_id), username, 1)
+                for room_id, username in expired:
+                    pipe.zrem(presence_key(room_id), username)
+                    pipe.hdel(workers_key(room_id), username)
+                results = await pipe.execute()
+            removed = results[len(rejoined)::2]
+            for (room_id, username), was_removed in zip(expired, removed):
+                if was_removed:
+                    self._change(room_id, 'left', username)
+        except RedisError as e:
+            logger.warning(f"Presence heartbeat failed: {e}")
+
+    async def _broadcast(self):
+        changes, self.changes = self.changes, {}
+        channel_layer = get_channel_layer()
+        for room_id, room_changes in changes.items():
+            frame = {kind: sorted(usernames) for kind, usernames in room_changes.items() if usernames}
+            if not frame:
+                continue
+            CHAT_PRESENCE_UPDATES.inc()
+            await channel_layer.group_send(room_group(room_id), {
+                'type': 'presence_update',
+                'room': room_id,
+                'text': json.dumps({'type': 'presence', **frame}),
+            })
+
+
+_tracker = None
+
+
+def get_presence_tracker():
+    global _tracker
+    if _tracker is None:
+        _tracker = PresenceTracker()
+    return _tracker
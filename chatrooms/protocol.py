@@ -0,0 +1,142 @@
+import json
+import zlib
+from functools import lru_cache
+import msgpack
+from django.conf import settings
+
+# Clients pick a framing by offering it as the first subprotocol (the second
+# one carries the access token). The server accepts the first subprotocol, so
+# a client that offers one of these knows the server will use it. Anything
+# else gets the original one-frame-per-message JSON protocol.
+BATCHED_HISTORY = 'chat.batch.v1'
+# The frames of chat.batch.v1 as binary MessagePack frames
+MSGPACK = 'chat.msgpack.v1'
+# Like chat.msgpack.v1, but every frame starts with a flag byte: PLAIN, or
+# DEFLATED when the rest is raw deflate (RFC 1951), used for frames of
+# CHAT_DEFLATE_MIN_BYTES or more such as history pages.
+MSGPACK_DEFLATE = 'chat.msgpack-deflate.v1'
+
+BATCHED_FRAMINGS = (BATCHED_HISTORY, MSGPACK, MSGPACK_DEFLATE)
+
+PLAIN, DEFLATED = b'\x00', b'\x01'
+
+
+def negotiate(subprotocols):
+    return subprotocols[0] if subprotocols else None
+
+
+def check_frame(data):
+    # Consumers read fields of the frame; anything but an object is malformed
+    if not isinstance(data, dict):
+        raise ValueError("Frames must be objects")
+    return data
+
+
+class JsonCodec:
+    binary = False
+
+    def encode(self, text):
+        return text
+
+    def encode_data(self, data):
+        return json.dumps(data)
+
+    def decode(self, text_data=None, bytes_data=None):
+        """The frame as a dict; raises ValueError for anything else."""
+        try:
+            data = json.loads(text_data if text_data is not None else bytes_data)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid JSON")
+        return check_frame(data)
+
+
+class MsgpackCodec:
+    """
+    Frames are built as JSON text once for every socket they go to, and
+    converted to MessagePack on the way out. Clients send JSON text or plain
+    (never deflated) MessagePack.
+    """
+    binary = True
+
+    def __init__(self, deflate=False):
+        self.deflate = deflate
+
+    def encode(self, text):
+        return self.frame(pack_json(text))
+
+    def encode_data(self, data):
+        return self.frame(msgpack.packb(data))
+
+    def frame(self, packed):
+        if not self.deflate:
+            return packed
+        if len(packed) < settings.CHAT_DEFLATE_MIN_BYTES:
+            return PLAIN + packed
+        compressor = zlib.compressobj(settings.CHAT_DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return DEFLATED + compressor.compress(packed) + compressor.flush()
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return JsonCodec.decode(self, text_data)
+        try:
+            data = msgpack.unpackb(bytes_data)
+        except (TypeError, ValueError, msgpack.UnpackException):
+            # ExtraData, FormatError and StackError are ValueErrors too
+            raise ValueError("Invalid MessagePack")
+        return check_frame(data)
+
+
+@lru_cache(maxsize=1024)
+def pack_json(text):
+    # A broadcast frame reaches every socket of the room on this worker; it is
+    # converted for the first one only
+    return msgpack.packb(json.loads(text))
+
+
+def codec_for(framing):
+    if framing == MSGPACK:
+        return MsgpackCodec()
+    if framing == MSGPACK_DEFLATE:
+        return MsgpackCodec(deflate=True)
+    return JsonCodec()
+
+
+def history_batch(messages, next_cursor=None):
+    """
+    A page of history as a single frame. Messages are laid out in
+    columns, and the author fields that repeat across messages (username and
+    avatar version) are stored once in `users` and referenced by index:
+
+        {"type": "history",
+         "users": {"username": [...], "avatar_version": [...]},
+         "messages": {"id": [...], "seq": [...], "user": [...], "message": [...], "timestamp": [...]},
+         "next_cursor": ...}
+    """
+    users = {'username': [], 'avatar_version': []}
+    user_index = {}
+    columns = {'id': [], 'seq': [], 'user': [], 'message': [], 'timestamp': []}
+
+    for message in messages:
+        # Frames buffered before avatar versions have no such field
+        author = (message['username'], message.get('avatar_version'))
+        index = user_index.get(author)
+        if index is None:
+            index = user_index[author] = len(users['username'])
+            users['username'].append(author[0])
+            users['avatar_version'].append(author[1])
+        columns['id'].append(message['id'])
+        columns['seq'].append(message.get('seq'))
+        columns['user'].append(index)
+        columns['message'].append(message['message'])
+        columns['timestamp'].append(message['timestamp'])
+
+    return {'type': 'history', 'users': users, 'messages': columns, 'next_cursor': next_cursor}
+
+
+def encode_history_batch(messages, next_cursor=None):
+    return json.dumps(history_batch(messages, next_cursor))
+
+
+def encode_frame_batch(texts):
+    """Join already-encoded frames into one: {"type": "batch", "messages": [...]}."""
+    return '{"type": "batch", "messages": [' + ', '.join(texts) + ']}'
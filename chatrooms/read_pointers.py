@@ -0,0 +1,135 @@
+"""
+Read pointers and unread counts.
+
+Clients report the seq of the latest message they have shown over the chat
+socket. Reports are only buffered per process, keeping the highest seq per
+user and room, and written every CHAT_READ_POINTER_FLUSH_INTERVAL seconds in
+one statement. Pointers never move back and never past the room's last_seq.
+
+Unread counts need no counting: seqs number the messages of a room without
+gaps, so a room has room.last_seq - last_read_seq messages the user has not
+read, and all of a user's rooms are answered in one query.
+"""
+import asyncio
+import atexit
+import logging
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from chatapp import metrics
+from chatapp.metrics import database_sync_to_async
+from chatrooms.models import ChatRoom, ReadPointer
+
+logger = logging.getLogger(__name__)
+
+
+class ReadPointerBuffer:
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._loop = None
+        self._flusher = None
+
+    def mark(self, user_id, room_id, seq):
+        key = (user_id, room_id)
+        if seq > self._pending.get(key, -1):
+            self._pending[key] = seq
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._flusher is None or self._flusher.done():
+            self._loop = loop
+            self._flusher = loop.create_task(self._run())
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        pointers, self._pending = self._pending, {}
+        if not pointers:
+            return
+        try:
+            await database_sync_to_async(self._write)(pointers)
+        except Exception:
+            logger.exception(f"Failed to save {len(pointers)} read pointers, retrying")
+            for key, seq in pointers.items():
+                if seq > self._pending.get(key, -1):
+                    self._pending[key] = seq
+
+    def flush_sync(self):
+        pointers, self._pending = self._pending, {}
+        if pointers:
+            self._write(pointers)
+            logger.info(f"Flushed {len(pointers)} read pointers on shutdown")
+
+    def _write(self, pointers):
+        last_seqs = dict(
+            ChatRoom.objects.filter(id__in={room_id for _, room_id in pointers}).values_list('id', 'last_seq')
+        )
+        # In key order, so concurrent flushes lock rows in the same order
+        rows = [
+            (user_id, room_id, min(seq, last_seqs[room_id]))
+            for (user_id, room_id), seq in sorted(pointers.items()) if room_id in last_seqs
+        ]
+        if not rows:
+            return
+        quote = connection.ops.quote_name
+        table = quote(ReadPointer._meta.db_table)
+        greatest = 'GREATEST' if connection.vendor == 'postgresql' else 'MAX'
+        now = timezone.now()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (user_id, room_id, last_read_seq, updated_at) '
+                f'VALUES {", ".join(["(%s, %s, %s, %s)"] * len(rows))} '
+                f'ON CONFLICT (user_id, room_id) DO UPDATE SET '
+                f'last_read_seq = {greatest}({table}.last_read_seq, excluded.last_read_seq), '
+                f'updated_at = excluded.updated_at',
+                [value for row in rows for value in (*row, now)],
+            )
+
+
+_buffer = None
+
+
+def get_read_pointer_buffer():
+    global _buffer
+    if _buffer is None:
+        _buffer = ReadPointerBuffer(settings.CHAT_READ_POINTER_FLUSH_INTERVAL)
+        atexit.register(_buffer.flush_sync)
+    return _buffer
+
+
+def unread_counts(user):
+    """
+    Per room of `user` (rooms they take part in, and public rooms they have
+    read), its last seq, the user's last read seq and the number of unread
+    messages, in one query.
+    """
+    pointers = ReadPointer.objects.filter(user_id=user.id, room_id=OuterRef('pk'))
+    is_participant = Q(id__in=Subquery(
+        ChatRoom.participants.through.objects.filter(customuser_id=user.id).values('chatroom_id')
+    ))
+    rooms = (
+        ChatRoom.objects
+        .filter(is_participant | Q(Exists(pointers), room_type='public'))
+        .annotate(last_read_seq=Coalesce(Subquery(pointers.values('last_read_seq')[:1]), Value(0)))
+        .order_by('id')
+        .values_list('id', 'last_seq', 'last_read_seq')
+    )
+    return [
+        {'room': room_id, 'last_seq': last_seq, 'last_read_seq': last_read_seq,
+         'unread': max(last_seq - last_read_seq, 0)}
+        for room_id, last_seq, last_read_seq in rooms
+    ]
+
+
+@metrics.registry.register_collector
+def collect_metrics():
+    yield '# HELP chat_read_pointers_pending Read pointers waiting for a flush'
+    yield '# TYPE chat_read_pointers_pending gauge'
+    yield metrics.format_sample('chat_read_pointers_pending', (), len(_buffer._pending) if _buffer else 0)
@@ -0,0 +1,83 @@
+"""
+Cached, versioned room listing.
+
+Every change that can alter what a room list shows (a room created, edited or
+deleted, a participant added or removed) bumps a single version counter. A
+cached list response and its ETag are only valid for the version they were
+built at, so a conditional request or a repeated request can be answered from
+the cache without querying the rooms.
+"""
+import hashlib
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Exists, OuterRef, Q
+from rest_framework.pagination import CursorPagination
+from chatrooms.models import ChatRoom
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'rooms:list:version'
+
+
+class RoomCursorPagination(CursorPagination):
+    page_size = settings.ROOM_LIST_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering = ('-created_at', '-id')
+
+
+def visible_rooms(user):
+    rooms = ChatRoom.objects.select_related('owner').only(
+        'id', 'title', 'description', 'room_type', 'created_at', 'owner__username'
+    )
+    if not user.is_authenticated:
+        visible = Q(room_type='public')
+    else:
+        is_participant = Exists(
+            ChatRoom.participants.through.objects.filter(chatroom_id=OuterRef('pk'), customuser_id=user.id)
+        )
+        visible = Q(room_type='public') | Q(owner_id=user.id) | Q(is_participant)
+    return rooms.filter(visible).annotate(participant_count=Count('participants'))
+
+
+def get_version():
+    try:
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            cache.add(VERSION_KEY, 1, None)
+            version = cache.get(VERSION_KEY)
+        return version
+    except Exception as e:
+        logger.warning(f"Room list cache unavailable: {e}")
+        return None
+
+
+def bump_version():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 1, None)
+    except Exception as e:
+        logger.warning(f"Room list cache unavailable: {e}")
+
+
+def make_etag(version, request):
+    user_id = request.user.id if request.user.is_authenticated else 0
+    digest = hashlib.md5(request.get_full_path().encode()).hexdigest()[:16]
+    return f'"rooms-{version}-{user_id}-{digest}"'
+
+
+def get_cached_response(etag):
+    try:
+        return cache.get(f'rooms:list:{etag}')
+    except Exception as e:
+        logger.warning(f"Room list cache unavailable: {e}")
+        return None
+
+
+def set_cached_response(etag, data):
+    try:
+        cache.set(f'rooms:list:{etag}', data, settings.ROOM_LIST_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"Room list cache unavailable: {e}")
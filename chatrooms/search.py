@@ -0,0 +1,146 @@
+"""
+Full-text search over chat messages.
+
+On PostgreSQL chatrooms_chatmessage has a stored generated tsvector column,
+search_vector (migration 0008), kept up to date by the database as messages
+are inserted or edited, and a GIN index on it. It is not a model field, so
+it is never loaded or written by the ORM; queries refer to it through
+search_vector(). Other databases fall back to a case-insensitive substring
+match ordered by recency.
+"""
+import html
+from django.conf import settings
+from django.db import connection
+from django.db.models import FloatField, Q, Subquery
+from django.db.models.functions import Cast
+from django.db.models.expressions import RawSQL
+from chatrooms.history import serialize_message
+from chatrooms.models import ChatMessage, ChatRoom
+
+# Text search configuration of the search_vector column; queries must use the same one
+SEARCH_CONFIG = 'english'
+
+# Markers ts_headline puts around matches, swapped for <mark> once the snippet is escaped
+START_SEL, STOP_SEL = '\x02', '\x03'
+
+
+def clamp_page_size(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return settings.CHAT_SEARCH_PAGE_SIZE
+    return max(1, min(limit, settings.CHAT_SEARCH_MAX_PAGE_SIZE))
+
+
+def parse_cursor(value):
+    """(rank, id) from a `next_cursor`, or None. Rank is None when not searching on PostgreSQL."""
+    if value in (None, ''):
+        return None
+    try:
+        rank, _, message_id = value.rpartition(':')
+        return (float(rank) if rank else None), int(message_id)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid search cursor: {value!r}")
+
+
+def parse_room(value):
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid room id: {value!r}")
+
+
+def search_vector():
+    from django.contrib.postgres.search import SearchVectorField
+    column = f'{connection.ops.quote_name(ChatMessage._meta.db_table)}."search_vector"'
+    return RawSQL(column, [], output_field=SearchVectorField())
+
+
+def accessible_messages(user):
+    is_participant = Q(room_id__in=Subquery(
+        ChatRoom.participants.through.objects.filter(customuser_id=user.id).values('chatroom_id')
+    ))
+    return (
+        ChatMessage.objects
+        .filter(Q(room__room_type='public') | is_participant)
+        .select_related('user', 'room')
+        .only('id', 'seq', 'content', 'timestamp', 'room__title', 'user__username', 'user__avatar_version')
+    )
+
+
+def search_messages(user, query, room_id=None, after=None, limit=None):
+    """
+    Return a page of the messages `user` may read that match `query`, best
+    match first, each with an HTML snippet where matches are wrapped in
+    <mark>, and the cursor of the next page.
+    """
+    limit = clamp_page_size(limit)
+    messages = accessible_messages(user)
+    if room_id is not None:
+        messages = messages.filter(room_id=room_id)
+    if connection.vendor == 'postgresql':
+        return ranked_page(messages, query, after, limit)
+    return substring_page(messages, query, after, limit)
+
+
+def ranked_page(messages, query, after, limit):
+    from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+
+    search_query = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+    document = search_vector()
+    messages = (
+        messages
+        .alias(document=document)
+        .filter(document=search_query)
+        # ts_rank() is a real; as a double the rank survives the round trip through the cursor
+        .annotate(rank=Cast(SearchRank(document, search_query), FloatField()))
+    )
+    if after is not None:
+        rank, message_id = after
+        if rank is None:
+            raise ValueError("Invalid search cursor")
+        messages = messages.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=message_id))
+    # One extra row tells whether there is a next page
+    page = list(messages.order_by('-rank', '-id')[:limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = f'{page[-1].rank!r}:{page[-1].id}'
+
+    # Snippets only for the rows of the page; ts_headline parses the whole message
+    headlines = dict(
+        ChatMessage.objects
+        .filter(id__in=[msg.id for msg in page], timestamp__in=[msg.timestamp for msg in page])
+        .annotate(snippet=SearchHeadline(
+            'content', search_query, config=SEARCH_CONFIG, start_sel=START_SEL, stop_sel=STOP_SEL,
+            max_fragments=settings.CHAT_SEARCH_SNIPPET_FRAGMENTS, max_words=settings.CHAT_SEARCH_SNIPPET_WORDS,
+            min_words=min(5, settings.CHAT_SEARCH_SNIPPET_WORDS - 1), fragment_delimiter=' … ',
+        ))
+        .values_list('id', 'snippet')
+    ) if page else {}
+    return [serialize_result(msg, headlines.get(msg.id, ''), msg.rank) for msg in page], next_cursor
+
+
+def substring_page(messages, query, after, limit):
+    messages = messages.filter(content__icontains=query)
+    if after is not None:
+        messages = messages.filter(id__lt=after[1])
+    page = list(messages.order_by('-id')[:limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = f':{page[-1].id}'
+    return [serialize_result(msg, msg.content, None) for msg in page], next_cursor
+
+
+def serialize_result(msg, headline, rank):
+    snippet = html.escape(headline).replace(START_SEL, '<mark>').replace(STOP_SEL, '</mark>')
+    return {
+        **serialize_message(msg),
+        'room': msg.room_id,
+        'room_title': msg.room.title,
+        'snippet': snippet,
+        'rank': rank,
+    }
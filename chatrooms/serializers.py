@@ -15,6 +15,22 @@ class RoomSerializer(serializers.ModelSerializer):
         fields = ['id', 'title', 'description', 'owner', 'participants', 'created_at', 'room_type']
 
 
+class RoomListSerializer(serializers.ModelSerializer):
+    owner = serializers.ReadOnlyField(source='owner.username')
+    participant_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = ChatRoom
+        fields = ['id', 'title', 'description', 'owner', 'participant_count', 'created_at', 'room_type']
+
+    def to_representation(self, instance):
+        representation = super().to_representation(instance)
+        # Public rooms have no participant rows, so there is nothing to count
+        if instance.room_type == 'public':
+            del representation['participant_count']
+        return representation
+
+
 class CreateRoomSerializer(serializers.ModelSerializer):
     participants = serializers.ListField(child=serializers.CharField(), write_only=True)
     owner = serializers.ReadOnlyField(source='owner.username')
@@ -26,22 +42,21 @@ class CreateRoomSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         participants_usernames = validated_data.pop('participants')
         owner = validated_data.pop('owner')
-        room = ChatRoom.objects.create(owner=owner, **validated_data)
-        room_type = validated_data.get('room_type')
-
-        participants = [owner]
+        room_type = validated_data.get('room_type', 'public')
 
-        if room_type == 'public':
-            participants += list(User.objects.all())
-        else:
+        # Everyone may join a public room, so public rooms have no participant rows.
+        participants = []
+        if room_type != 'public':
+            participants = list(User.objects.filter(username__in=set(participants_usernames)))
+            found = {user.username for user in participants}
             for username in participants_usernames:
-                try:
-                    user = User.objects.get(username=username)
-                    participants.append(user)
-                except User.DoesNotExist:
+                if username not in found:
                     raise serializers.ValidationError(f"User '{username}' does not exist.")
+            participants.append(owner)
 
-        room.participants.set(participants)
+        room = ChatRoom.objects.create(owner=owner, **validated_data)
+        if participants:
+            room.participants.add(*participants)
         return room
 
     def to_representation(self, instance):
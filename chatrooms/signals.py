@@ -0,0 +1,147 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from chatrooms import connection_cache, hot_history, lobby, room_list
+from chatrooms.models import ChatRoom
+
+User = get_user_model()
+
+
+# Invalidation runs once the transaction commits, otherwise a concurrent
+# reader could put the old row straight back into the cache.
+
+@receiver(pre_save, sender=User)
+def remember_username(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is not None and (update_fields is None or 'username' in update_fields):
+        instance._room_list_old_username = (
+            User.objects.filter(pk=instance.pk).values_list('username', flat=True).first()
+        )
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    user_id = instance.id
+    transaction.on_commit(lambda: connection_cache.invalidate_user(user_id))
+    # Room lists show owner usernames. Deleting a user deletes their rooms,
+    # which bumps the version by itself.
+    old_username = instance.__dict__.pop('_room_list_old_username', None)
+    if old_username not in (None, instance.username) and ChatRoom.objects.filter(owner_id=user_id).exists():
+        transaction.on_commit(room_list.bump_version)
+
+
+@receiver([post_save, post_delete], sender=ChatRoom)
+def invalidate_room(sender, instance, **kwargs):
+    room_id = instance.id
+    transaction.on_commit(lambda: connection_cache.invalidate_room(room_id))
+    transaction.on_commit(room_list.bump_version)
+
+
+@receiver(post_delete, sender=ChatRoom)
+def forget_hot_history(sender, instance, **kwargs):
+    room_id = instance.id
+    transaction.on_commit(lambda: hot_history.invalidate([room_id]))
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def invalidate_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    transaction.on_commit(room_list.bump_version)
+    if not reverse:
+        room_ids = [instance.id]
+    elif pk_set:
+        # user.rooms.add(...) and friends: the rooms are in pk_set.
+        room_ids = list(pk_set)
+    else:
+        # user.rooms.clear(): the rooms were looked up at pre_clear by
+        # announce_membership, which runs after this receiver
+        room_ids = list(getattr(instance, '_lobby_cleared', ()))
+
+    def invalidate():
+        for room_id in room_ids:
+            connection_cache.invalidate_membership(room_id)
+
+    transaction.on_commit(invalidate)
+
+
+# Lobby events. Public rooms go to every lobby socket, other rooms to the
+# users who can see them; a room appearing or vanishing for a user is sent to
+# them as room_created or room_deleted.
+
+@receiver(pre_save, sender=ChatRoom)
+def remember_room_type(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance._lobby_old_type = (
+            ChatRoom.objects.filter(pk=instance.pk).values_list('room_type', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=ChatRoom)
+def announce_room(sender, instance, created, **kwargs):
+    if created:
+        # Participants are added after the row, and announced as they are
+        user_ids = None if instance.room_type == 'public' else {instance.owner_id}
+        lobby.publish_on_commit('room_created', instance.id, user_ids)
+        return
+    old_type = getattr(instance, '_lobby_old_type', None)
+    if old_type == 'public' and instance.room_type != 'public':
+        # Gone for everyone but its audience, which gets it back right away
+        room_id = instance.id
+        transaction.on_commit(lambda: lobby.publish('room_deleted', {'id': room_id}))
+        lobby.publish_on_commit('room_created', room_id)
+    elif old_type not in (None, 'public') and instance.room_type == 'public':
+        lobby.publish_on_commit('room_created', instance.id)
+    else:
+        lobby.publish_on_commit('room_updated', instance.id)
+
+
+@receiver(pre_delete, sender=ChatRoom)
+def remember_audience(sender, instance, **kwargs):
+    # Participant rows are gone by post_delete
+    instance._lobby_audience = (
+        None if instance.room_type == 'public' else lobby.audience(instance.id, instance.owner_id)
+    )
+
+
+@receiver(post_delete, sender=ChatRoom)
+def announce_room_deleted(sender, instance, **kwargs):
+    room_id, user_ids = instance.id, instance._lobby_audience
+    transaction.on_commit(lambda: lobby.publish('room_deleted', {'id': room_id}, user_ids))
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def announce_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # clear() does not say who or what was removed
+        through = ChatRoom.participants.through.objects
+        if reverse:
+            instance._lobby_cleared = set(through.filter(customuser_id=instance.id).values_list('chatroom_id', flat=True))
+        else:
+            instance._lobby_cleared = set(through.filter(chatroom_id=instance.id).values_list('customuser_id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    changed = instance.__dict__.pop('_lobby_cleared', set()) if action == 'post_clear' else pk_set
+    kind = 'room_created' if action == 'post_add' else 'room_deleted'
+    if reverse:
+        memberships = [(room_id, {instance.id}) for room_id in changed]
+    else:
+        memberships = [(instance.id, changed)]
+
+    for room_id, user_ids in memberships:
+        room = ChatRoom.objects.filter(id=room_id).values('room_type', 'owner_id').first()
+        if room is None:
+            continue
+        user_ids = set(user_ids) - {room['owner_id']}
+        if room['room_type'] == 'public':
+            lobby.publish_on_commit('room_updated', room_id)
+            continue
+        if user_ids:
+            if kind == 'room_deleted':
+                transaction.on_commit(
+                    lambda room_id=room_id, user_ids=user_ids: lobby.publish(kind, {'id': room_id}, user_ids)
+                )
+            else:
+                lobby.publish_on_commit(kind, room_id, user_ids)
+        lobby.publish_on_commit('room_updated', room_id, lobby.audience(room_id, room['owner_id']) - user_ids)
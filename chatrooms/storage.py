@@ -0,0 +1,191 @@
+"""
+Lifecycle of stored chat messages.
+
+On PostgreSQL chatrooms_chatmessage is partitioned by month on "timestamp"
+(migration 0007). Partitions are named chatrooms_chatmessage_pYYYY_MM and
+ensure_partitions() keeps the coming months created ahead of time; rows
+that fall outside every partition land in the DEFAULT partition and move to
+their month when it is created. Months older than the archive horizon are
+streamed to gzipped NDJSON files and then detached and dropped.
+
+Retention by room type works on any database: messages of rooms of a type
+older than CHAT_MESSAGE_RETENTION_DAYS are deleted in batches.
+"""
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import re
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.utils import timezone
+from chatrooms import hot_history
+from chatrooms.models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+PARENT = ChatMessage._meta.db_table
+DEFAULT_PARTITION = f'{PARENT}_default'
+PARTITION_NAME = re.compile(rf'^{PARENT}_p(\d{{4}})_(\d{{2}})$')
+
+ARCHIVE_COLUMNS = ('id', 'room_id', 'user_id', 'username', 'seq', 'content', 'timestamp')
+
+
+def archive_record(row):
+    """One NDJSON line of an archive (or export) from a row of ARCHIVE_COLUMNS."""
+    record = dict(zip(ARCHIVE_COLUMNS, row))
+    record['timestamp'] = record['timestamp'].isoformat()
+    return json.dumps(record) + '\n'
+
+
+def month_start(value):
+    return value.replace(day=1)
+
+
+def add_months(month, count):
+    years, month_index = divmod(month.month - 1 + count, 12)
+    return datetime.date(month.year + years, month_index + 1, 1)
+
+
+def current_month():
+    return month_start(timezone.now().date())
+
+
+def partition_name(month):
+    return f'{PARENT}_p{month:%Y_%m}'
+
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [PARENT])
+        return cursor.fetchone() is not None
+
+
+def list_partitions():
+    """Months that have a partition, oldest first."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass',
+            [PARENT],
+        )
+        names = [name for name, in cursor.fetchall()]
+    return sorted(
+        datetime.date(int(match[1]), int(match[2]), 1)
+        for match in map(PARTITION_NAME.match, names) if match
+    )
+
+
+def create_partition(month):
+    """Create the partition of `month`; returns how many rows it took over from the DEFAULT partition."""
+    quote = connection.ops.quote_name
+    name = quote(partition_name(month))
+    start, end = f'{month} 00:00:00+00', f'{add_months(month, 1)} 00:00:00+00'
+    # Model columns only: generated ones such as search_vector are computed again
+    columns = ', '.join(quote(field.column) for field in ChatMessage._meta.concrete_fields)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE TABLE {name} '
+            f'(LIKE {quote(PARENT)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)'
+        )
+        # The DEFAULT partition may not keep rows of a range that gets its own partition
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM {quote(DEFAULT_PARTITION)} '
+            f'WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING {columns}) '
+            f'INSERT INTO {name} ({columns}) SELECT {columns} FROM moved',
+            [start, end],
+        )
+        moved = cursor.rowcount
+        cursor.execute(f"ALTER TABLE {quote(PARENT)} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+    logger.info(f"Created partition {partition_name(month)}, moved {moved} rows from the default partition")
+    return moved
+
+
+def ensure_partitions(months_ahead):
+    """Create the missing partitions of the current month and the next `months_ahead` months."""
+    existing = set(list_partitions())
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current_month(), offset)
+        if month not in existing:
+            create_partition(month)
+            created.append(month)
+    return created
+
+
+def archivable_months(archive_after_months):
+    """Partitions that ended at least `archive_after_months` months before the current month."""
+    horizon = add_months(current_month(), -archive_after_months)
+    return [month for month in list_partitions() if add_months(month, 1) <= horizon]
+
+
+def archive_partition(month, directory, drop=True):
+    """
+    Stream a partition to <directory>/<partition>.ndjson.gz, then detach it
+    and, unless `drop` is False, drop it. Writes to the partition are blocked
+    until it is gone, so the file holds every row. Returns (path, rows).
+    """
+    quote = connection.ops.quote_name
+    name = partition_name(month)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.ndjson.gz')
+    partial = f'{path}.partial'
+
+    rows = 0
+    room_ids = set()
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {quote(name)} IN SHARE MODE')
+        with open(partial, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as compressed, \
+                    io.TextIOWrapper(compressed, encoding='utf-8') as out, \
+                    connection.chunked_cursor() as cursor:
+                cursor.execute(
+                    f'SELECT m.id, m.room_id, m.user_id, u.username, m.seq, m.content, m."timestamp" '
+                    f'FROM {quote(name)} AS m JOIN {quote(get_user_model()._meta.db_table)} AS u ON u.id = m.user_id '
+                    f'ORDER BY m.room_id, m.seq'
+                )
+                while batch := cursor.fetchmany(settings.CHAT_ARCHIVE_BATCH_SIZE):
+                    out.writelines(archive_record(row) for row in batch)
+                    room_ids.update(row[1] for row in batch)
+                    rows += len(batch)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(partial, path)
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE {quote(PARENT)} DETACH PARTITION {quote(name)}')
+            if drop:
+                cursor.execute(f'DROP TABLE {quote(name)}')
+    hot_history.invalidate(room_ids)
+    logger.info(f"Archived {rows} messages of partition {name} to {path}")
+    return path, rows
+
+
+def expired_messages():
+    """Per room type with a retention, the messages past it and the cutoff they are older than."""
+    now = timezone.now()
+    for room_type, days in settings.CHAT_MESSAGE_RETENTION_DAYS.items():
+        if days is None:
+            continue
+        cutoff = now - datetime.timedelta(days=days)
+        yield room_type, ChatMessage.objects.filter(room__room_type=room_type, timestamp__lt=cutoff), cutoff
+
+
+def apply_retention(batch_size):
+    """Delete messages past the retention of their room type; returns the number deleted per type."""
+    deleted = {}
+    for room_type, expired, cutoff in expired_messages():
+        deleted[room_type] = 0
+        while rows := list(expired.values_list('id', 'room_id')[:batch_size]):
+            # The timestamp bound lets PostgreSQL skip the newer partitions
+            count, _ = ChatMessage.objects.filter(id__in=[message_id for message_id, _ in rows], timestamp__lt=cutoff).delete()
+            deleted[room_type] += count
+            # Buffers of quiet rooms may still hold the deleted messages
+            hot_history.invalidate({room_id for _, room_id in rows})
+    return deleted
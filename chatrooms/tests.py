@@ -1,3 +1,1010 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import tempfile
+import time
+from unittest import mock, skipUnless
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from redis.exceptions import RedisError
+from rest_framework.test import APIClient
+from chatapp.asgi import application
+from chatapp.redis_client import get_redis
+from chatrooms import (
+    connection_cache, export, flow_control, hot_history, lobby, messaging, persistence, presence, protocol, storage,
+)
+from chatrooms.models import ChatMessage, ChatRoom
+from chatrooms.persistence import WriteBehindQueue
+from chatrooms.read_pointers import get_read_pointer_buffer, unread_counts
+from users.authentication import tokens_for_user
 
-# Create your tests here.
+User = get_user_model()
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+# Keep the tests off Redis: the features that need it degrade without it.
+without_redis = override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYERS,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CONNECTION_CACHE={**settings.CONNECTION_CACHE, 'SHARED': False},
+    CHAT_HOT_HISTORY_ENABLED=False,
+    CHAT_PRESENCE_ENABLED=False,
+    CHAT_LOBBY_BACKLOG=0,
+    AUTH_TOKEN_REVOCATION_ENABLED=False,
+)
+
+
+def redis_available():
+    try:
+        return get_redis().ping()
+    except RedisError:
+        return False
+
+
+# Tests of what Redis holds use the Redis at REDIS_URL, and clear the keys
+# they use before each test
+requires_redis = skipUnless(redis_available(), "No Redis at REDIS_URL")
+
+
+def delete_keys(*patterns):
+    client = get_redis()
+    for pattern in patterns:
+        keys = list(client.scan_iter(pattern))
+        if keys:
+            client.delete(*keys)
+
+
+def post_messages(room, user, count):
+    return [ChatMessage.objects.create(room=room, user=user, content=f'message {index}') for index in range(count)]
+
+
+@without_redis
+class HistoryCursorTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.room = ChatRoom.objects.create(title='general', owner=self.alice)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_pages_walk_back_through_the_whole_history(self):
+        post_messages(self.room, self.alice, 7)
+        url = f'/api/chat/rooms/{self.room.id}/messages/'
+        pages = []
+        params = {'limit': 3}
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            pages.append([message['seq'] for message in response.data['results']])
+            if response.data['next_cursor'] is None:
+                break
+            params['before'] = response.data['next_cursor']
+        self.assertEqual(pages, [[5, 6, 7], [2, 3, 4], [1]])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/messages/', {'before': 'nonsense'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_private_history_needs_membership(self):
+        bob = User.objects.create_user('bob', 'bob@example.com', 'pw')
+        room = ChatRoom.objects.create(title='secret', owner=bob, room_type='private')
+        room.participants.add(bob)
+        response = self.client.get(f'/api/chat/rooms/{room.id}/messages/')
+        self.assertEqual(response.status_code, 403)
+
+
+@without_redis
+@override_settings(CHAT_PERSISTENCE_MODE='write_behind')
+class WriteBehindTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.room = ChatRoom.objects.create(title='general', owner=self.alice)
+        self.queue = WriteBehindQueue(batch_size=10, flush_interval=60, max_pending=3)
+        patcher = mock.patch('chatrooms.persistence._queue', self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored(self):
+        return list(ChatMessage.objects.order_by('seq').values_list('seq', 'content'))
+
+    def queued_message(self, content):
+        return ChatMessage(room=self.room, user=self.alice, content=content, seq=persistence.reserve_seq(self.room.id))
+
+    async def test_messages_are_broadcast_before_they_are_saved(self):
+        communicator = await connect_chat(self.room, self.alice)
+        for content in ('one', 'two'):
+            await communicator.send_json_to({'message': content})
+            frame = await communicator.receive_json_from()
+            self.assertEqual(frame['id'], None)
+        self.assertEqual(frame['seq'], 2)
+        self.assertEqual(await sync_to_async(self.stored)(), [])
+        await self.queue.flush()
+        self.assertEqual(await sync_to_async(self.stored)(), [(1, 'one'), (2, 'two')])
+        self.queue._flusher.cancel()
+        await communicator.disconnect()
+
+    async def test_full_queue_refuses_messages(self):
+        rejected = persistence.CHAT_WRITE_BEHIND_REJECTED.labels().value
+        communicator = await connect_chat(self.room, self.alice)
+        for content in ('one', 'two', 'three', 'four'):
+            await communicator.send_json_to({'message': content})
+        frames = [await communicator.receive_json_from() for _ in range(4)]
+        # The refusal goes straight to the socket, so it may overtake the broadcasts
+        errors = [frame for frame in frames if frame.get('type') == 'error']
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(sorted(frame['seq'] for frame in frames if frame not in errors), [1, 2, 3])
+        self.assertEqual(persistence.CHAT_WRITE_BEHIND_REJECTED.labels().value, rejected + 1)
+        await sync_to_async(self.room.refresh_from_db)()
+        self.assertEqual(self.room.last_seq, 3)
+        self.queue._flusher.cancel()
+        await communicator.disconnect()
+
+    async def test_failed_batches_are_retried(self):
+        self.queue.flush_interval = 0.01
+        write = self.queue._write
+        failures = [DatabaseError("Database is down")]
+
+        def flaky_write(batch):
+            if failures:
+                raise failures.pop()
+            write(batch)
+
+        for content in ('one', 'two'):
+            self.queue.enqueue(await sync_to_async(self.queued_message)(content))
+        self.queue._flusher.cancel()
+        with mock.patch.object(self.queue, '_write', flaky_write), self.assertLogs('chatrooms.persistence', 'ERROR'):
+            await self.queue.flush()
+            self.assertEqual(len(self.queue._pending), 2)
+            await self.queue.flush()
+        self.assertEqual(await sync_to_async(self.stored)(), [(1, 'one'), (2, 'two')])
+
+    def test_pending_messages_are_saved_on_shutdown(self):
+        messages = [self.queued_message(content) for content in ('one', 'two')]
+
+        async def enqueue():
+            for message in messages:
+                self.queue.enqueue(message)
+            self.queue._flusher.cancel()
+
+        async_to_sync(enqueue)()
+        self.queue.flush_sync()
+        self.assertEqual(self.stored(), [(1, 'one'), (2, 'two')])
+
+    def test_messages_of_deleted_rooms_are_dropped(self):
+        other = ChatRoom.objects.create(title='other', owner=self.alice)
+        messages = [self.queued_message('kept'), ChatMessage(room=other, user=self.alice, content='lost', seq=1)]
+        ChatRoom.objects.filter(pk=other.pk).delete()
+        with self.assertLogs('chatrooms.persistence', 'WARNING'):
+            self.queue._write(messages)
+        self.assertEqual(self.stored(), [(1, 'kept')])
+
+
+@without_redis
+class RoomCreationTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        User.objects.create_user('bob', 'bob@example.com', 'pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_rooms_default_to_public_without_participant_rows(self):
+        response = self.client.post(
+            '/api/chat/rooms/create/', {'title': 'lobby', 'participants': ['bob']}, format='json')
+        self.assertEqual(response.status_code, 201)
+        room = ChatRoom.objects.get(id=response.data['id'])
+        self.assertEqual(room.room_type, 'public')
+        self.assertFalse(room.participants.exists())
+
+
+@without_redis
+class RoomListTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_room_list_counts_participants_of_private_rooms_only(self):
+        ChatRoom.objects.create(title='open', owner=self.alice)
+        private = ChatRoom.objects.create(title='team', owner=self.alice, room_type='private')
+        private.participants.add(self.alice, self.bob)
+        rooms = {room['title']: room for room in self.client.get('/api/chat/rooms/').data['results']}
+        self.assertNotIn('participant_count', rooms['open'])
+        self.assertEqual(rooms['team']['participant_count'], 2)
+
+
+async def connect_chat(room, user, query=''):
+    communicator = WebsocketCommunicator(
+        application, f'/ws/chat/{room.id}/{query}', subprotocols=['chat', str(tokens_for_user(user).access_token)])
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+class MessageValidationTests(SimpleTestCase):
+    def test_messages_must_be_non_empty_strings(self):
+        self.assertEqual(messaging.parse_message('hi'), 'hi')
+        for value in (None, '', '   ', 5, ['hi']):
+            with self.assertRaises(ValueError):
+                messaging.parse_message(value)
+
+
+@without_redis
+class ChatSocketActionTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.room = ChatRoom.objects.create(title='general', owner=self.alice)
+
+    async def test_sends_without_a_message_and_unknown_actions_get_an_error(self):
+        communicator = await connect_chat(self.room, self.alice)
+        for frame in ({'message': ''}, {'message': None}, {'action': 'dance', 'message': 'hi'}):
+            await communicator.send_json_to(frame)
+            self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+        self.assertEqual(await sync_to_async(ChatMessage.objects.count)(), 0)
+        await communicator.disconnect()
+
+
+async def connect_multiplex(user):
+    communicator = WebsocketCommunicator(
+        application, '/ws/multiplex/', subprotocols=['chat', str(tokens_for_user(user).access_token)])
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+@without_redis
+class MultiplexTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'pw')
+        self.room = ChatRoom.objects.create(title='general', owner=self.alice)
+        post_messages(self.room, self.alice, 5)
+
+    async def subscribe(self, communicator, room_id):
+        await communicator.send_json_to({'action': 'subscribe', 'room': room_id})
+        return await communicator.receive_json_from()
+
+    async def test_subscribing_sends_history_then_the_room_messages(self):
+        communicator = await connect_multiplex(self.bob)
+        frame = await self.subscribe(communicator, self.room.id)
+        self.assertEqual((frame['room'], frame['type']), (self.room.id, 'history'))
+        self.assertEqual(
+            [message['message'] for message in frame['messages']], [f'message {index}' for index in range(5)])
+        await communicator.send_json_to({'action': 'send', 'room': self.room.id, 'message': 'hi'})
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame['room'], frame['message'], frame['username']), (self.room.id, 'hi', 'bob'))
+        await communicator.disconnect()
+
+    async def test_private_rooms_are_only_open_to_participants(self):
+        def create_rooms():
+            secret = ChatRoom.objects.create(title='secret', owner=self.alice, room_type='private')
+            shared = ChatRoom.objects.create(title='shared', owner=self.alice, room_type='private')
+            shared.participants.add(self.alice, self.bob)
+            return secret, shared
+
+        secret, shared = await sync_to_async(create_rooms)()
+        communicator = await connect_multiplex(self.bob)
+        frame = await self.subscribe(communicator, secret.id)
+        self.assertEqual((frame['room'], frame['type'], frame['detail']), (secret.id, 'error', "Room not found"))
+        await communicator.send_json_to({'action': 'send', 'room': secret.id, 'message': 'hi'})
+        self.assertEqual((await communicator.receive_json_from())['detail'], "Not subscribed to this room")
+        frame = await self.subscribe(communicator, shared.id)
+        self.assertEqual((frame['room'], frame['type']), (shared.id, 'history'))
+        self.assertEqual(await sync_to_async(ChatMessage.objects.filter(room=secret).count)(), 0)
+        await communicator.disconnect()
+
+    async def test_unsubscribed_rooms_get_no_more_messages(self):
+        communicator = await connect_multiplex(self.bob)
+        await self.subscribe(communicator, self.room.id)
+        await communicator.send_json_to({'action': 'unsubscribe', 'room': self.room.id})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'unsubscribed', 'room': self.room.id})
+        await messaging.broadcast(get_channel_layer(), self.room.id, json.dumps({'message': 'hi'}))
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.send_json_to({'action': 'send', 'room': self.room.id, 'message': 'hi'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+        await communicator.disconnect()
+
+    async def test_older_history_is_paged_per_room(self):
+        communicator = await connect_multiplex(self.bob)
+        await self.subscribe(communicator, self.room.id)
+        pages, before = [], None
+        while True:
+            await communicator.send_json_to(
+                {'action': 'load_history', 'room': self.room.id, 'before': before, 'limit': 2})
+            frame = await communicator.receive_json_from()
+            self.assertEqual((frame['room'], frame['type']), (self.room.id, 'history'))
+            pages.append([message['message'] for message in frame['messages']])
+            before = frame['next_cursor']
+            if before is None:
+                break
+        self.assertEqual(pages, [['message 3', 'message 4'], ['message 1', 'message 2'], ['message 0']])
+        await communicator.send_json_to({'action': 'load_history', 'room': self.room.id, 'before': 'latest'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+        await communicator.disconnect()
+
+    async def test_events_of_older_workers_are_framed_from_their_fields(self):
+        communicator = await connect_multiplex(self.bob)
+        await self.subscribe(communicator, self.room.id)
+        await get_channel_layer().group_send(messaging.room_group(self.room.id), {
+            'type': 'chat_message', 'message': 'hi', 'username': 'alice',
+            'profile_image': None, 'timestamp': '2024-01-01T00:00:00+00:00',
+        })
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame['room'], frame['message'], frame['username']), (self.room.id, 'hi', 'alice'))
+        await communicator.disconnect()
+
+
+class BlockedSocket:
+    """A consumer whose server accepts frames only once `unblocked` is set."""
+
+    def __init__(self):
+        self.user = User(id=1, username='alice')
+        self.channel_name = 'test!socket'
+        self.unblocked = asyncio.Event()
+        self.sent = []
+        self.close = mock.AsyncMock()
+
+    async def send_frame(self, text):
+        await self.unblocked.wait()
+        self.sent.append(text)
+
+
+class OutboxTests(SimpleTestCase):
+    async def test_frames_behind_a_blocked_send_are_dropped(self):
+        dropped = flow_control.CHAT_OUTBOUND_DROPPED.labels().value
+        socket = BlockedSocket()
+        outbox = flow_control.Outbox(socket, 1, policy=flow_control.DROP_OLDEST, maxsize=2, send_timeout=5)
+        outbox.put('a')
+        await asyncio.sleep(0)
+        for text in ('b', 'c', 'd'):
+            outbox.put(text)
+        self.assertEqual(flow_control.CHAT_OUTBOUND_DROPPED.labels().value, dropped + 1)
+        socket.unblocked.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(socket.sent, ['a', 'c', 'd'])
+        socket.close.assert_not_called()
+        outbox.close()
+
+    async def test_socket_is_closed_when_a_send_blocks_too_long(self):
+        disconnects = flow_control.CHAT_SLOW_CONSUMER_DISCONNECTS.labels().value
+        socket = BlockedSocket()
+        outbox = flow_control.Outbox(socket, 1, policy=flow_control.DROP_OLDEST, send_timeout=0.05)
+        with self.assertLogs('chatrooms.flow_control', 'WARNING'):
+            outbox.put('a')
+            await asyncio.sleep(0.2)
+        self.assertTrue(outbox.closed)
+        socket.close.assert_awaited_once_with(code=flow_control.SLOW_CONSUMER_CLOSE_CODE)
+        self.assertEqual(flow_control.CHAT_SLOW_CONSUMER_DISCONNECTS.labels().value, disconnects + 1)
+        outbox.put('b')
+        self.assertEqual(socket.sent, [])
+
+
+@without_redis
+class ResumeTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.room = ChatRoom.objects.create(title='general', owner=self.alice)
+        post_messages(self.room, self.alice, 5)
+
+    async def test_resume_sends_only_missed_messages(self):
+        communicator = await connect_chat(self.room, self.alice, '?last_seq=3')
+        seqs = [(await communicator.receive_json_from())['seq'] for _ in range(2)]
+        self.assertEqual(seqs, [4, 5])
+        self.assertTrue(await communicator.receive_nothing(0.2))
+        await communicator.disconnect()
+
+    async def test_resume_after_long_absence_asks_for_resync(self):
+        with self.settings(CHAT_RESUME_MAX_GAP=2):
+            communicator = await connect_chat(self.room, self.alice, '?last_seq=1')
+            self.assertEqual((await communicator.receive_json_from())['type'], 'resync')
+            await communicator.disconnect()
+
+    async def test_messages_get_consecutive_seqs(self):
+        communicator = await connect_chat(self.room, self.alice, '?last_seq=5')
+        await communicator.send_json_to({'message': 'hello'})
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame['seq'], frame['message']), (6, 'hello'))
+        await communicator.disconnect()
+
+
+@without_redis
+class RoomSeqTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+
+    def test_saving_a_room_never_writes_last_seq_back(self):
+        room = ChatRoom.objects.create(title='general', owner=self.alice)
+        stale = ChatRoom.objects.get(id=room.id)
+        post_messages(room, self.alice, 2)
+        stale.title = 'renamed'
+        stale.save()
+        room.refresh_from_db()
+        self.assertEqual((room.title, room.last_seq), ('renamed', 2))
+
+    def test_new_rooms_with_an_explicit_pk_are_inserted(self):
+        ChatRoom(pk=4242, title='restored', owner=self.alice).save()
+        self.assertTrue(ChatRoom.objects.filter(pk=4242).exists())
+
+
+@without_redis
+class UnreadCountTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.room = ChatRoom.objects.create(title='team', owner=self.alice, room_type='private')
+        self.room.participants.add(self.alice)
+        post_messages(self.room, self.alice, 4)
+
+    async def report_read(self, seq):
+        communicator = await connect_chat(self.room, self.alice, '?last_seq=4')
+        await communicator.send_json_to({'action': 'read', 'seq': seq})
+        await communicator.receive_nothing(0.1)
+        await communicator.disconnect()
+        await get_read_pointer_buffer().flush()
+
+    def counts(self):
+        return {entry['room']: entry['unread'] for entry in unread_counts(self.alice)}
+
+    async def acounts(self):
+        return await sync_to_async(self.counts)()
+
+    async def test_read_reports_move_unread_counts(self):
+        self.assertEqual(await self.acounts(), {self.room.id: 4})
+        await self.report_read(2)
+        self.assertEqual(await self.acounts(), {self.room.id: 2})
+
+    async def test_read_pointers_never_move_back(self):
+        await self.report_read(3)
+        await self.report_read(1)
+        self.assertEqual(await self.acounts(), {self.room.id: 1})
+
+    async def test_read_pointers_stop_at_the_last_message(self):
+        await self.report_read(99)
+        self.assertEqual(await self.acounts(), {self.room.id: 0})
+
+    def test_unread_counts_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        response = client.get('/api/chat/rooms/unread/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [
+            {'room': self.room.id, 'last_seq': 4, 'last_read_seq': 0, 'unread': 4},
+        ])
+
+
+class ProtocolTests(SimpleTestCase):
+    def test_json_frames_must_be_objects(self):
+        codec = protocol.JsonCodec()
+        self.assertEqual(codec.decode('{"action": "typing"}'), {'action': 'typing'})
+        for text in ('{', '[1]', '"text"', '5'):
+            with self.assertRaises(ValueError):
+                codec.decode(text)
+
+    def test_msgpack_frames_must_be_single_objects(self):
+        codec = protocol.MsgpackCodec()
+        self.assertEqual(codec.decode(bytes_data=msgpack.packb({'action': 'typing'})), {'action': 'typing'})
+        for data in (msgpack.packb([1]), msgpack.packb({}) + b'\x00', b'\xc1', b'\x81'):
+            with self.assertRaises(ValueError):
+                codec.decode(bytes_data=data)
+
+    def test_deflated_frames_are_flagged(self):
+        codec = protocol.MsgpackCodec(deflate=True)
+        self.assertEqual(codec.encode_data({'a': 1})[:1], protocol.PLAIN)
+        large = {'message': 'x' * settings.CHAT_DEFLATE_MIN_BYTES}
+        self.assertEqual(codec.encode_data(large)[:1], protocol.DEFLATED)
+
+
+@without_redis
+class MalformedFrameTests(TransactionTestCase):
+    async def test_malformed_frames_get_an_error(self):
+        alice = await sync_to_async(User.objects.create_user)('alice', 'alice@example.com', 'pw')
+        room = await sync_to_async(ChatRoom.objects.create)(title='general', owner=alice)
+        communicator = await connect_chat(room, alice)
+        for frame in ('not json', '[1, 2]', '"text"'):
+            await communicator.send_to(text_data=frame)
+            self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+        await communicator.disconnect()
+
+
+@without_redis
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'pw')
+        self.public = ChatRoom.objects.create(title='general', owner=self.alice)
+        self.secret = ChatRoom.objects.create(title='secret', owner=self.alice, room_type='private')
+        self.secret.participants.add(self.alice)
+        self.shared = ChatRoom.objects.create(title='shared', owner=self.alice, room_type='private')
+        self.shared.participants.add(self.alice, self.bob)
+        for room in (self.public, self.secret, self.shared):
+            ChatMessage.objects.create(room=room, user=self.alice, content=f'Deploy of {room.title} is done')
+        self.client = APIClient()
+        self.client.force_authenticate(self.bob)
+
+    def search(self, **params):
+        response = self.client.get('/api/chat/messages/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_private_rooms_are_searched_only_by_their_participants(self):
+        rooms = [result['room_title'] for result in self.search(q='deploy')['results']]
+        self.assertEqual(sorted(rooms), ['general', 'shared'])
+        self.assertEqual(self.search(q='deploy', room=self.secret.id)['results'], [])
+        self.client.force_authenticate(self.alice)
+        self.assertEqual(len(self.search(q='deploy')['results']), 3)
+
+    def test_queries_and_cursors_are_validated(self):
+        self.assertEqual(self.client.get('/api/chat/messages/search/', {'q': ' '}).status_code, 400)
+        response = self.client.get('/api/chat/messages/search/', {'q': 'deploy', 'cursor': 'x:y'})
+        self.assertEqual(response.status_code, 400)
+
+    @skipUnless(connection.vendor != 'postgresql', "PostgreSQL ranks matches instead")
+    def test_substring_fallback_pages_newest_first(self):
+        ChatMessage.objects.create(room=self.public, user=self.alice, content='<b>redeployed</b>')
+        pages, params = [], {'q': 'DEPLOY', 'limit': 2}
+        while True:
+            data = self.search(**params)
+            pages.append([result['message'] for result in data['results']])
+            if data['next_cursor'] is None:
+                break
+            params['cursor'] = data['next_cursor']
+        self.assertEqual(pages, [['<b>redeployed</b>', 'Deploy of shared is done'], ['Deploy of general is done']])
+        result = self.search(q='redeploy')['results'][0]
+        self.assertEqual((result['snippet'], result['rank']), ('&lt;b&gt;redeployed&lt;/b&gt;', None))
+
+    @skipUnless(connection.vendor == 'postgresql', "Ranking needs PostgreSQL")
+    def test_better_matches_rank_first(self):
+        busy = ChatMessage.objects.create(room=self.public, user=self.alice, content='Deploy failed, deploy again')
+        ChatMessage.objects.create(room=self.public, user=self.alice, content='Lunch, anyone?')
+        data = self.search(q='deploy', limit=2)
+        results = data['results']
+        self.assertEqual(results[0]['id'], busy.id)
+        self.assertGreater(results[0]['rank'], results[1]['rank'])
+        self.assertIn('<mark>Deploy</mark>', results[0]['snippet'])
+        rest = self.search(q='deploy', limit=2, cursor=data['next_cursor'])
+        self.assertEqual(len(rest['results']), 1)
+        self.assertIsNone(rest['next_cursor'])
+
+
+@without_redis
+@override_settings(CHAT_MESSAGE_RETENTION_DAYS={'public': 30, 'private': None})
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.public = ChatRoom.objects.create(title='general', owner=self.alice)
+        self.private = ChatRoom.objects.create(title='secret', owner=self.alice, room_type='private')
+        old = timezone.now() - datetime.timedelta(days=31)
+        for room in (self.public, self.private):
+            for message in post_messages(room, self.alice, 5)[:3]:
+                message.timestamp = old
+                message.save()
+
+    def remaining(self, room):
+        return list(ChatMessage.objects.filter(room=room).order_by('seq').values_list('content', flat=True))
+
+    def test_messages_past_the_retention_of_their_room_type_are_deleted(self):
+        self.assertEqual(storage.apply_retention(batch_size=2), {'public': 3})
+        self.assertEqual(self.remaining(self.public), ['message 3', 'message 4'])
+        self.assertEqual(len(self.remaining(self.private)), 5)
+
+    def test_without_partitions_only_retention_runs(self):
+        out = io.StringIO()
+        call_command('maintain_chat_storage', '--archive-after', '1', '--dry-run', stdout=out)
+        self.assertIn("Messages are not partitioned, skipping partitions and archiving", out.getvalue())
+        self.assertIn("3 expired public messages would be deleted", out.getvalue())
+        self.assertEqual(len(self.remaining(self.public)), 5)
+        call_command('maintain_chat_storage', '--archive-after', '1', stdout=io.StringIO())
+        self.assertEqual(len(self.remaining(self.public)), 2)
+
+
+@skipUnless(connection.vendor == 'postgresql', "Partitions need PostgreSQL")
+@without_redis
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.room = ChatRoom.objects.create(title='general', owner=self.alice)
+        self.month = storage.add_months(storage.current_month(), -3)
+        if self.month not in storage.list_partitions():
+            storage.create_partition(self.month)
+        timestamp = datetime.datetime.combine(self.month, datetime.time(12), datetime.timezone.utc)
+        self.old = post_messages(self.room, self.alice, 2)
+        ChatMessage.objects.filter(id__in=[message.id for message in self.old]).update(timestamp=timestamp)
+        self.recent = post_messages(self.room, self.alice, 1)
+
+    def test_old_partitions_are_written_out_and_dropped(self):
+        self.assertIn(self.month, storage.archivable_months(2))
+        self.assertNotIn(self.month, storage.archivable_months(4))
+        with tempfile.TemporaryDirectory() as directory:
+            path, rows = storage.archive_partition(self.month, directory)
+            self.assertEqual(rows, 2)
+            with gzip.open(path, 'rt') as archive:
+                records = [json.loads(line) for line in archive]
+        self.assertEqual([record['id'] for record in records], [message.id for message in self.old])
+        self.assertEqual(records[0]['username'], 'alice')
+        self.assertNotIn(self.month, storage.list_partitions())
+        self.assertEqual(list(ChatMessage.objects.values_list('id', flat=True)), [self.recent[0].id])
+
+
+@without_redis
+class ExportImportTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'pw')
+        self.source = ChatRoom.objects.create(title='old', owner=self.alice)
+        post_messages(self.source, self.alice, 3)
+        post_messages(self.source, self.bob, 2)
+        self.target = ChatRoom.objects.create(title='new', owner=self.alice)
+
+    def export_lines(self, **kwargs):
+        return b''.join(export.export_chunks(self.source.id, chunk_size=2, **kwargs)).decode().splitlines()
+
+    def run_import(self, lines, **kwargs):
+        return export.Importer(room_id=self.target.id, batch_size=2, **kwargs).run(export.read_records(lines))
+
+    def test_round_trip_keeps_seqs_authors_and_content(self):
+        self.assertEqual(self.run_import(self.export_lines()), (5, 0))
+        copied = list(ChatMessage.objects.filter(room=self.target).order_by('seq').values_list(
+            'seq', 'user__username', 'content'))
+        original = list(ChatMessage.objects.filter(room=self.source).order_by('seq').values_list(
+            'seq', 'user__username', 'content'))
+        self.assertEqual(copied, original)
+        self.target.refresh_from_db()
+        self.assertEqual(self.target.last_seq, 5)
+
+    def test_rerun_skips_what_was_imported(self):
+        lines = self.export_lines()
+        self.run_import(lines[:3])
+        self.assertEqual(self.run_import(lines), (2, 3))
+        self.assertEqual(ChatMessage.objects.filter(room=self.target).count(), 5)
+
+    def test_export_resumes_after_seq(self):
+        seqs = [json.loads(line)['seq'] for line in self.export_lines(after_seq=3)]
+        self.assertEqual(seqs, [4, 5])
+
+    def test_unknown_users_are_refused_unless_created(self):
+        lines = [line.replace('"bob"', '"carol"') for line in self.export_lines()]
+        with self.assertRaises(ValueError):
+            self.run_import(lines)
+        self.run_import(lines, create_users=True)
+        self.assertFalse(User.objects.get(username='carol').is_active)
+
+    def test_gzipped_exports_are_read_back(self):
+        with tempfile.NamedTemporaryFile(suffix='.ndjson.gz') as file:
+            file.writelines(export.gzip_chunks(export.export_chunks(self.source.id)))
+            file.flush()
+            with export.open_export(file.name) as lines:
+                self.assertEqual(len(list(export.read_records(lines))), 5)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_PRESENCE_ENABLED=False, CHAT_PRESENCE_TICK=60)
+class TypingTests(SimpleTestCase):
+    async def test_typing_is_broadcast_when_it_starts_and_stops(self):
+        signals = presence.CHAT_TYPING_SIGNALS.labels().value
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(messaging.room_group(1), channel)
+        tracker = presence.PresenceTracker()
+        for _ in range(3):
+            tracker.keystroke(1, 'alice')
+        tracker.keystroke(1, 'bob')
+        await tracker._broadcast()
+        event = await channel_layer.receive(channel)
+        self.assertEqual(json.loads(event['text']), {'type': 'presence', 'typing': ['alice', 'bob']})
+        self.assertEqual(presence.CHAT_TYPING_SIGNALS.labels().value, signals + 4)
+
+        # Typing on changes nothing
+        tracker.keystroke(1, 'alice')
+        self.assertEqual(tracker.changes, {})
+        tracker.stop_typing(1, 'alice')
+        tracker.stop_typing(1, 'alice')
+        await tracker._broadcast()
+        event = await channel_layer.receive(channel)
+        self.assertEqual(json.loads(event['text']), {'type': 'presence', 'stopped_typing': ['alice']})
+        tracker._ticker.cancel()
+
+    @override_settings(CHAT_TYPING_TIMEOUT=0.05)
+    async def test_typing_stops_without_keystrokes(self):
+        tracker = presence.PresenceTracker()
+        tracker.keystroke(1, 'alice')
+        tracker.changes.clear()
+        tracker._expire_typing()
+        self.assertEqual(tracker.typing.keys(), {(1, 'alice')})
+        await asyncio.sleep(0.1)
+        tracker._expire_typing()
+        self.assertEqual(tracker.typing, {})
+        self.assertEqual(tracker.changes[1]['stopped_typing'], {'alice'})
+        tracker._ticker.cancel()
+
+
+@requires_redis
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_PRESENCE_ENABLED=True, CHAT_PRESENCE_TICK=60)
+class PresenceTests(SimpleTestCase):
+    def setUp(self):
+        delete_keys('chat:presence:*')
+
+    def online(self, room_id):
+        return {member.decode() for member in get_redis().zrange(presence.presence_key(room_id), 0, -1)}
+
+    async def test_users_stay_online_until_their_last_worker_lets_go(self):
+        first, second = presence.PresenceTracker(), presence.PresenceTracker()
+        await first.join(1, 'alice')
+        await first.join(1, 'alice')
+        snapshot = json.loads(await second.join(1, 'alice'))
+        self.assertEqual((snapshot['online'], snapshot['online_count']), (['alice'], 1))
+        self.assertEqual(first.changes[1]['joined'], {'alice'})
+        self.assertNotIn(1, second.changes)
+
+        await first.leave(1, 'alice')
+        await first.leave(1, 'alice')
+        self.assertEqual(self.online(1), {'alice'})
+        self.assertEqual(first.changes[1]['left'], set())
+        await second.leave(1, 'alice')
+        self.assertEqual(self.online(1), set())
+        self.assertEqual(second.changes[1]['left'], {'alice'})
+        self.assertFalse(get_redis().exists(presence.workers_key(1)))
+        for tracker in (first, second):
+            tracker._ticker.cancel()
+
+    async def test_users_of_a_dead_worker_expire(self):
+        dead, alive = presence.PresenceTracker(), presence.PresenceTracker()
+        await dead.join(1, 'alice')
+        await alive.join(1, 'bob')
+        alive.changes.clear()
+        # alice's worker stopped refreshing her a while ago
+        get_redis().zadd(presence.presence_key(1), {'alice': time.time() - 1})
+        await alive._heartbeat()
+        self.assertEqual(self.online(1), {'bob'})
+        self.assertEqual(alive.changes[1]['left'], {'alice'})
+        self.assertEqual(get_redis().hkeys(presence.workers_key(1)), [b'bob'])
+        for tracker in (dead, alive):
+            tracker._ticker.cancel()
+
+
+@requires_redis
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, CHAT_LOBBY_BACKLOG=10, AUTH_TOKEN_REVOCATION_ENABLED=False)
+class LobbyBacklogTests(TransactionTestCase):
+    def setUp(self):
+        delete_keys('lobby:events*')
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+
+    def publish(self, title):
+        lobby.publish('room_updated', {'id': 1, 'title': title, 'room_type': 'public'})
+
+    def test_joining_replays_missed_events_then_the_cursor(self):
+        for title in ('one', 'two', 'three'):
+            self.publish(title)
+        frames, replayed = async_to_sync(lobby.join_frames)(self.alice, 1)
+        frames = [json.loads(frame) for frame in frames]
+        self.assertEqual([frame.get('room', {}).get('title') for frame in frames], ['two', 'three', None])
+        self.assertEqual(frames[-1], {'type': 'lobby_cursor', 'event': 3})
+        self.assertEqual(replayed, {2, 3})
+
+    def test_joining_too_far_back_asks_for_resync(self):
+        for index in range(12):
+            self.publish(str(index))
+        frames, replayed = async_to_sync(lobby.join_frames)(self.alice, 1)
+        self.assertEqual([json.loads(frame)['type'] for frame in frames], ['resync', 'lobby_cursor'])
+        self.assertEqual(replayed, set())
+
+    def test_cursor_leaves_out_events_not_in_the_backlog_yet(self):
+        self.publish('one')
+        # An event that has its id but is still on its way to the backlog
+        get_redis().incr(lobby.EVENT_SEQ_KEY)
+        frames, _ = async_to_sync(lobby.join_frames)(self.alice, None)
+        self.assertEqual([json.loads(frame) for frame in frames], [{'type': 'lobby_cursor', 'event': 1}])
+
+    async def test_events_published_while_joining_reach_the_socket_once(self):
+        await sync_to_async(self.publish)('one')
+        in_flight = await sync_to_async(get_redis().incr)(lobby.EVENT_SEQ_KEY)
+        communicator = WebsocketCommunicator(
+            application, '/ws/rooms/?after=0', subprotocols=['chat', str(tokens_for_user(self.alice).access_token)])
+        self.assertTrue((await communicator.connect())[0])
+        replayed = await communicator.receive_json_from()
+        self.assertEqual((replayed['event'], (await communicator.receive_json_from())['type']), (1, 'lobby_cursor'))
+
+        # The broadcast of the replayed event is skipped, the one in flight is not
+        channel_layer = get_channel_layer()
+        for event_id in (1, in_flight):
+            frame = json.dumps({'type': 'room_updated', 'event': event_id, 'room': {'id': 1}})
+            await channel_layer.group_send(
+                lobby.LOBBY_PUBLIC_GROUP, {'type': 'lobby_event', 'event': event_id, 'text': frame})
+        self.assertEqual((await communicator.receive_json_from())['event'], in_flight)
+        self.assertTrue(await communicator.receive_nothing(0.1))
+        await communicator.disconnect()
+
+
+@requires_redis
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYERS,
+    CHAT_HOT_HISTORY_ENABLED=True,
+    CHAT_HOT_HISTORY_SIZES={'public': 5, 'private': 0, 'one-to-one': 5},
+    CHAT_HISTORY_PAGE_SIZE=3,
+)
+class HotHistoryTests(TestCase):
+    def setUp(self):
+        delete_keys('chat:history:*')
+        self.alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.room = ChatRoom.objects.create(title='general', owner=self.alice)
+
+    def frames(self, *seqs):
+        return {json.dumps({'seq': seq, 'message': f'message {seq}'}): seq for seq in seqs}
+
+    def read_seqs(self, count=5):
+        frames = async_to_sync(hot_history.read_latest)(self.room, count)
+        return None if frames is None else [json.loads(frame)['seq'] for frame in frames]
+
+    def test_cold_buffer_is_not_read(self):
+        async_to_sync(hot_history.append)(self.room, self.frames(1, 2))
+        self.assertIsNone(self.read_seqs())
+
+    def test_warming_loads_the_latest_messages_from_the_database(self):
+        post_messages(self.room, self.alice, 7)
+        frames = hot_history.warm(self.room)
+        self.assertEqual([json.loads(frame)['seq'] for frame in frames], [3, 4, 5, 6, 7])
+        self.assertEqual(self.read_seqs(3), [5, 6, 7])
+
+    def test_buffer_is_trimmed_to_its_size(self):
+        hot_history.warm(self.room)
+        for seq in range(1, 9):
+            async_to_sync(hot_history.append)(self.room, self.frames(seq))
+        self.assertEqual(self.read_seqs(10), [4, 5, 6, 7, 8])
+
+    def test_frames_appended_out_of_order_are_read_in_seq_order(self):
+        hot_history.warm(self.room)
+        async_to_sync(hot_history.append)(self.room, self.frames(1))
+        async_to_sync(hot_history.append)(self.room, self.frames(3))
+        async_to_sync(hot_history.append)(self.room, self.frames(2))
+        self.assertEqual(self.read_seqs(), [1, 2, 3])
+
+    def test_gaps_fall_back_to_the_database(self):
+        post_messages(self.room, self.alice, 4)
+        hot_history.warm(self.room)
+        get_redis().zremrangebyscore(hot_history.history_key(self.room.id), 3, 3)
+        self.assertIsNone(async_to_sync(messaging.get_hot_history)(self.room))
+        messages, _ = async_to_sync(messaging.get_latest_history)(self.room)
+        self.assertEqual([message['seq'] for message in messages], [2, 3, 4])
+
+    def test_rooms_without_a_buffer_are_not_buffered(self):
+        private = ChatRoom.objects.create(title='team', owner=self.alice, room_type='private')
+        self.assertEqual(hot_history.warm(private), [])
+        self.assertIsNone(async_to_sync(messaging.get_hot_history)(private))
+
+    def test_invalidating_makes_readers_reload_from_the_database(self):
+        post_messages(self.room, self.alice, 4)
+        hot_history.warm(self.room)
+        ChatMessage.objects.filter(room=self.room, seq__gte=3).delete()
+        hot_history.invalidate([self.room.id])
+        self.assertIsNone(self.read_seqs())
+        frames = async_to_sync(messaging.get_hot_history)(self.room)
+        self.assertEqual([json.loads(frame)['seq'] for frame in frames], [1, 2])
+
+    def test_deleting_messages_in_the_admin_resets_the_buffer(self):
+        post_messages(self.room, self.alice, 4)
+        hot_history.warm(self.room)
+        model_admin = admin.site._registry[ChatMessage]
+        with self.captureOnCommitCallbacks(execute=True):
+            model_admin.delete_queryset(None, ChatMessage.objects.filter(room=self.room, seq__gte=3))
+        self.assertIsNone(self.read_seqs())
+
+    def test_deleting_a_room_drops_its_buffer(self):
+        room_id = self.room.id
+        hot_history.warm(self.room)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.delete()
+        self.assertFalse(get_redis().exists(hot_history.warm_key(room_id)))
+
+    @override_settings(CHAT_HOT_HISTORY_ENABLED=False)
+    def test_invalidating_a_disabled_buffer_leaves_redis_alone(self):
+        with mock.patch('chatrooms.hot_history.get_redis') as client:
+            hot_history.invalidate([self.room.id])
+        client.assert_not_called()
+
+
+@requires_redis
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYERS,
+    CONNECTION_CACHE={**settings.CONNECTION_CACHE, 'SHARED': True},
+    AUTH_TOKEN_REVOCATION_ENABLED=False,
+)
+class ConnectionCacheTests(TransactionTestCase):
+    def setUp(self):
+        delete_keys('conn:*')
+        for cache in connection_cache.CACHES:
+            cache.forget_local()
+
+    def racing_cache(self, rows):
+        """A cache whose first load reads a row just before a change to it commits."""
+        loads = []
+
+        def commit_change():
+            rows[1] = 'new'
+            cache.invalidate(1)
+
+        def loader(key):
+            value = rows[key]
+            loads.append(value)
+            if len(loads) == 1:
+                commit_change()
+            return value
+
+        async def aloader(key):
+            return loader(key)
+
+        cache = connection_cache.ConnectionCache('test', loader, aloader)
+        return cache, loads
+
+    def test_values_loaded_during_an_invalidation_are_not_cached(self):
+        cache, loads = self.racing_cache({1: 'old'})
+        self.assertEqual(cache.get(1), 'old')
+        self.assertEqual(cache.get(1), 'new')
+        self.assertEqual(cache.get(1), 'new')
+        self.assertEqual(loads, ['old', 'new'])
+        other_worker = connection_cache.ConnectionCache('test', loads.append)
+        self.assertEqual(other_worker.get(1), 'new')
+
+    async def test_values_loaded_on_the_event_loop_during_an_invalidation_are_not_cached(self):
+        cache, loads = self.racing_cache({1: 'old'})
+        with mock.patch('chatapp.async_db.is_enabled', return_value=True), \
+                mock.patch.object(connection_cache.listener, 'ensure_started'):
+            self.assertEqual(await cache.aget(1), 'old')
+            self.assertEqual(await cache.aget(1), 'new')
+            self.assertEqual(await cache.aget(1), 'new')
+        self.assertEqual(loads, ['old', 'new'])
+
+    def test_shared_tier_serves_other_workers(self):
+        rows = {1: 'value'}
+        connection_cache.ConnectionCache('test', rows.__getitem__).get(1)
+        other_worker = connection_cache.ConnectionCache('test', lambda key: self.fail("Loaded again"))
+        self.assertEqual(other_worker.get(1), 'value')
+
+    def test_missing_records_are_cached_too(self):
+        loads = []
+        cache = connection_cache.ConnectionCache('test', loads.append)
+        self.assertIsNone(cache.get(1))
+        self.assertIsNone(connection_cache.ConnectionCache('test', loads.append).get(1))
+        self.assertEqual(loads, [1])
+
+    async def test_invalidations_reach_the_local_tier_of_other_workers(self):
+        alice = await sync_to_async(User.objects.create_user)('alice', 'alice@example.com', 'pw')
+        room = await sync_to_async(ChatRoom.objects.create)(title='general', owner=alice)
+        # Listens like the listener of this worker, which the lookups would start
+        listener = connection_cache.InvalidationListener()
+        task = asyncio.create_task(listener._run())
+        patcher = mock.patch.object(connection_cache.listener, 'ensure_started')
+        patcher.start()
+        try:
+            while not (await sync_to_async(get_redis().pubsub_numsub)(connection_cache.INVALIDATION_CHANNEL))[0][1]:
+                await asyncio.sleep(0.01)
+            await connection_cache.aget_room(room.id)
+            self.assertIsNot(connection_cache.rooms.local.get(room.id), connection_cache.MISSING)
+
+            # Another worker renames the room
+            await sync_to_async(
+                lambda: get_redis().publish(connection_cache.INVALIDATION_CHANNEL, f'room:{room.id}'))()
+            for _ in range(100):
+                if connection_cache.rooms.local.get(room.id) is connection_cache.MISSING:
+                    break
+                await asyncio.sleep(0.01)
+            else:
+                self.fail("The invalidation did not reach the local tier")
+        finally:
+            patcher.stop()
+            task.cancel()
+
+    def test_membership_changes_are_seen_at_once(self):
+        alice = User.objects.create_user('alice', 'alice@example.com', 'pw')
+        bob = User.objects.create_user('bob', 'bob@example.com', 'pw')
+        room = ChatRoom.objects.create(title='team', owner=alice, room_type='private')
+        room.participants.add(alice, bob)
+        self.assertTrue(async_to_sync(connection_cache.ais_participant)(bob, room))
+        room.participants.remove(bob)
+        self.assertFalse(async_to_sync(connection_cache.ais_participant)(bob, room))
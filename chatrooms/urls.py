@@ -1,8 +1,13 @@
 from django.urls import path
-from .views import list_rooms, create_room, join_room
+from .views import list_rooms, create_room, join_room, room_messages, export_room_messages, search_chat_messages, unread_counts, cache_stats
 
 urlpatterns = [
     path('rooms/', list_rooms, name='list_rooms'),
+    path('rooms/unread/', unread_counts, name='unread_counts'),
     path('rooms/create/', create_room, name='create_room'),
     path('rooms/join/<int:room_id>/', join_room, name='join_room'),
+    path('rooms/<int:room_id>/messages/', room_messages, name='room_messages'),
+    path('rooms/<int:room_id>/export/', export_room_messages, name='export_room_messages'),
+    path('messages/search/', search_chat_messages, name='search_messages'),
+    path('cache/stats/', cache_stats, name='cache_stats'),
 ]
\ No newline at end of file
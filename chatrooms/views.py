@@ -1,18 +1,37 @@
+import logging
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from .models import ChatRoom
-from .serializers import RoomSerializer, CreateRoomSerializer
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from .serializers import RoomSerializer, RoomListSerializer, CreateRoomSerializer
+from .history import get_history_page, parse_cursor
+from . import connection_cache, export, read_pointers, room_list, search
+from django.http import StreamingHttpResponse
+from django.utils.http import parse_etags
+
+logger = logging.getLogger(__name__)
 
 
 @api_view(['GET'])
 def list_rooms(request):
-    rooms = ChatRoom.objects.all()
-    serializer = RoomSerializer(rooms, many=True)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    version = room_list.get_version()
+    etag = room_list.make_etag(version, request) if version is not None else None
+    headers = {'Cache-Control': 'private, no-cache', 'Vary': 'Authorization'}
+    if etag:
+        headers['ETag'] = etag
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        data = room_list.get_cached_response(etag)
+        if data is not None:
+            return Response(data, status=status.HTTP_200_OK, headers=headers)
+
+    paginator = room_list.RoomCursorPagination()
+    rooms = paginator.paginate_queryset(room_list.visible_rooms(request.user), request)
+    data = paginator.get_paginated_response(RoomListSerializer(rooms, many=True).data).data
+    if etag:
+        room_list.set_cached_response(etag, data)
+    return Response(data, status=status.HTTP_200_OK, headers=headers)
 
 
 @api_view(['POST'])
@@ -21,17 +40,6 @@ def create_room(request):
     serializer = CreateRoomSerializer(data=request.data)
     if serializer.is_valid():
         room = serializer.save(owner=request.user)
-
-        # Notify about room creation via WebSocket
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            "rooms",
-            {
-                "type": "room_created",
-                "message": RoomSerializer(room).data
-            }
-        )
-
         return Response(RoomSerializer(room).data, status=status.HTTP_201_CREATED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -45,7 +53,88 @@ def join_room(request, room_id):
         except ChatRoom.DoesNotExist:
             return Response({'detail': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        room.participants.add(request.user)
-        room.save()
+        # Public rooms are open to everyone and keep no participant rows
+        if room.room_type != 'public':
+            room.participants.add(request.user)
         return Response({'detail': f'Joined room {room.title}'}, status=status.HTTP_200_OK)
-    return Response({'detail': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
\ No newline at end of file
+    return Response({'detail': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def room_messages(request, room_id):
+    try:
+        room = ChatRoom.objects.get(id=room_id)
+    except ChatRoom.DoesNotExist:
+        return Response({'detail': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    if not room.is_accessible_by(request.user):
+        return Response({'detail': 'You are not a participant of this room'}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        before = parse_cursor(request.query_params.get('before'))
+    except ValueError as e:
+        return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    messages, next_cursor = get_history_page(room.id, before=before, limit=request.query_params.get('limit'))
+    return Response({'results': messages, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def unread_counts(request):
+    return Response({'results': read_pointers.unread_counts(request.user)}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search_chat_messages(request):
+    query = request.query_params.get('q', '').strip()
+    if not query:
+        return Response({'detail': 'A search query is required'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        after = search.parse_cursor(request.query_params.get('cursor'))
+        room_id = search.parse_room(request.query_params.get('room'))
+        results, next_cursor = search.search_messages(
+            request.user, query, room_id=room_id, after=after, limit=request.query_params.get('limit'))
+    except ValueError as e:
+        return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'results': results, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def export_room_messages(request, room_id):
+    if not ChatRoom.objects.filter(id=room_id).exists():
+        return Response({'detail': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+    try:
+        since = export.parse_time(request.query_params.get('since'))
+        until = export.parse_time(request.query_params.get('until'))
+        after_seq = export.parse_after_seq(request.query_params.get('after_seq'))
+    except ValueError as e:
+        return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    compress = request.query_params.get('compress')
+    if compress not in (None, '', 'gzip'):
+        return Response({'detail': f'Unsupported compression: {compress!r}'}, status=status.HTTP_400_BAD_REQUEST)
+
+    logger.info(
+        f"User {request.user.username} exported room {room_id} "
+        f"(since={since}, until={until}, after_seq={after_seq})"
+    )
+    chunks = export.export_chunks(room_id, since, until, after_seq)
+    filename = f'room-{room_id}-messages.ndjson'
+    content_type = 'application/x-ndjson'
+    if compress:
+        chunks = export.gzip_chunks(chunks)
+        filename += '.gz'
+        content_type = 'application/gzip'
+    response = StreamingHttpResponse(export.aiter_chunks(chunks), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    return Response(connection_cache.stats(), status=status.HTTP_200_OK)
@@ -0,0 +1,222 @@
+"""
+JWT authentication without a database query per request or socket connect.
+
+Tokens carry the claims the app needs about their user (CLAIM_FIELDS), and
+request.user / consumer.user is built from them as a model instance whose
+other fields are deferred: touching e.g. `email` loads it on first access,
+reading `id` or `username` never does.
+
+Verified tokens are cached in-process by digest until they expire, for at
+most AUTH_TOKEN_CACHE['TTL'] seconds. Revocation goes through Redis: logout
+denylists the token ids, and deactivating a user, deleting them or changing
+their password revokes every token issued to them before that moment. Other
+processes honour a revocation once their cached entry runs out. Without
+AUTH_TOKEN_REVOCATION_ENABLED tokens are valid until they expire.
+"""
+import hashlib
+import logging
+import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS
+from redis.exceptions import RedisError
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken, TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from chatapp import metrics
+from chatapp.cache import MISSING, TTLCache
+from chatapp.redis_client import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+# Model fields copied into tokens, besides the user id. Chat messages are
+# serialized on the event loop and must not load anything else.
+CLAIM_FIELDS = ('username', 'avatar_version')
+
+_verified = TTLCache(settings.AUTH_TOKEN_CACHE['MAXSIZE'], settings.AUTH_TOKEN_CACHE['TTL'])
+# Token ids revoked by this process, so its own cache stops serving them at once
+_revoked = TTLCache(settings.AUTH_TOKEN_CACHE['MAXSIZE'], settings.AUTH_TOKEN_CACHE['TTL'])
+
+
+def add_claims(token, user):
+    for field in CLAIM_FIELDS:
+        token[field] = user._meta.get_field(field).value_to_string(user)
+    if 'iat_ms' not in token:
+        # iat in milliseconds, so a revocation can tell the tokens of the
+        # same second apart. Access tokens inherit it from their refresh token,
+        # like iat.
+        token['iat_ms'] = int(token.current_time.timestamp() * 1000)
+    return token
+
+
+def tokens_for_user(user):
+    """Refresh token with the user's claims; its access token inherits them."""
+    return add_claims(RefreshToken.for_user(user), user)
+
+
+def denylist_key(jti):
+    return f'auth:denylist:{jti}'
+
+
+def revoked_before_key(user_id):
+    return f'auth:revoked_before:{user_id}'
+
+
+def revocation_keys(token):
+    return [denylist_key(token[api_settings.JTI_CLAIM]), revoked_before_key(token[api_settings.USER_ID_CLAIM])]
+
+
+def check_revocation(token, values):
+    denied, revoked_before = values
+    if denied is not None:
+        raise InvalidToken("Token has been revoked")
+    if revoked_before is not None and issued_at(token) <= float(revoked_before):
+        raise InvalidToken("Token has been revoked")
+
+
+def issued_at(token):
+    if 'iat_ms' in token:
+        return token['iat_ms'] / 1000
+    # Whole seconds: a token from the second of a revocation may predate it
+    return token.get('iat', 0)
+
+
+def _cached(raw_token):
+    key = hashlib.sha256(raw_token if isinstance(raw_token, bytes) else raw_token.encode()).digest()
+    token = _verified.get(key)
+    if token is not MISSING and token['exp'] > time.time() and _revoked.get(token[api_settings.JTI_CLAIM], None) is None:
+        return key, token
+    return key, None
+
+
+def get_validated_token(raw_token):
+    """Verified AccessToken for `raw_token`; raises InvalidToken."""
+    key, token = _cached(raw_token)
+    if token is not None:
+        return token
+    try:
+        token = AccessToken(raw_token)
+    except TokenError as e:
+        raise InvalidToken(str(e))
+    if not settings.AUTH_TOKEN_REVOCATION_ENABLED:
+        _verified.set(key, token)
+        return token
+    try:
+        check_revocation(token, get_redis().mget(revocation_keys(token)))
+    except RedisError as e:
+        # Fail open rather than lock everyone out; the token is not cached
+        logger.warning(f"Token denylist unavailable: {e}")
+        return token
+    _verified.set(key, token)
+    return token
+
+
+async def aget_validated_token(raw_token):
+    key, token = _cached(raw_token)
+    if token is not None:
+        return token
+    try:
+        token = AccessToken(raw_token)
+    except TokenError as e:
+        raise InvalidToken(str(e))
+    if not settings.AUTH_TOKEN_REVOCATION_ENABLED:
+        _verified.set(key, token)
+        return token
+    try:
+        check_revocation(token, await get_async_redis().mget(revocation_keys(token)))
+    except RedisError as e:
+        logger.warning(f"Token denylist unavailable: {e}")
+        return token
+    _verified.set(key, token)
+    return token
+
+
+def user_from_claims(token):
+    """
+    The token's user as a model instance built without a query, or None for
+    tokens issued before the claims were added.
+    """
+    if any(field not in token for field in CLAIM_FIELDS):
+        return None
+    User = get_user_model()
+    values = {field: token[field] for field in CLAIM_FIELDS}
+    values[User._meta.pk.attname] = token[api_settings.USER_ID_CLAIM]
+    # Revoked when deactivated, so any token that got this far is active
+    values['is_active'] = True
+    field_names = [field.attname for field in User._meta.concrete_fields if field.attname in values]
+    return User.from_db(DEFAULT_DB_ALIAS, field_names, [values[name] for name in field_names])
+
+
+def revoke_token(token):
+    """
+    Denylist a token. Returns False if it could not be, in which case only
+    this process stops accepting it.
+    """
+    jti = token[api_settings.JTI_CLAIM]
+    _revoked.set(jti, True)
+    if not settings.AUTH_TOKEN_REVOCATION_ENABLED:
+        return True
+    try:
+        get_redis().set(denylist_key(jti), 1, exat=int(token['exp']))
+    except RedisError as e:
+        logger.error(f"Could not revoke token {jti}: {e}")
+        return False
+    return True
+
+
+def revoke_user_tokens(user_id):
+    """Revoke every token issued to the user until now."""
+    if not settings.AUTH_TOKEN_REVOCATION_ENABLED:
+        return
+    lifetime = max(api_settings.ACCESS_TOKEN_LIFETIME, api_settings.REFRESH_TOKEN_LIFETIME)
+    try:
+        get_redis().set(revoked_before_key(user_id), f'{time.time():.3f}', ex=lifetime)
+    except RedisError as e:
+        logger.error(f"Could not revoke tokens of user {user_id}: {e}")
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    def get_validated_token(self, raw_token):
+        return get_validated_token(raw_token)
+
+    def get_user(self, validated_token):
+        return user_from_claims(validated_token) or super().get_user(validated_token)
+
+
+class ChatTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        return add_claims(super().get_token(user), user)
+
+
+class ChatTokenRefreshSerializer(TokenRefreshSerializer):
+    """Issues access tokens with the user's current claims, so profile changes reach them."""
+
+    def validate(self, attrs):
+        try:
+            refresh = self.token_class(attrs['refresh'])
+        except TokenError as e:
+            raise InvalidToken(str(e))
+        if settings.AUTH_TOKEN_REVOCATION_ENABLED:
+            try:
+                check_revocation(refresh, get_redis().mget(revocation_keys(refresh)))
+            except RedisError as e:
+                logger.warning(f"Token denylist unavailable: {e}")
+
+        User = get_user_model()
+        user = User.objects.filter(
+            **{api_settings.USER_ID_FIELD: refresh[api_settings.USER_ID_CLAIM]}, is_active=True,
+        ).first()
+        if user is None:
+            raise AuthenticationFailed("User not found or inactive", code='user_not_found')
+        return {'access': str(add_claims(refresh.access_token, user))}
+
+
+@metrics.registry.register_collector
+def collect_metrics():
+    yield '# HELP chat_auth_token_cache_lookups_total Verified token cache lookups by result'
+    yield '# TYPE chat_auth_token_cache_lookups_total counter'
+    for result, value in (('hit', _verified.hits), ('miss', _verified.misses)):
+        yield metrics.format_sample('chat_auth_token_cache_lookups_total', (('result', result),), value)
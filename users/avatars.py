@@ -0,0 +1,117 @@
+"""
+Avatar thumbnails.
+
+An uploaded profile image is kept as it is, and its content hash becomes the
+user's avatar_version. Square WebP thumbnails of AVATAR_THUMBNAIL_SIZES are
+rendered from it on a small thread pool once the upload is committed, and
+stored as avatars/<avatar_version>-<size>.webp. Their names change whenever
+the content does, so they are served with a year-long immutable
+Cache-Control, and chat messages carry only the avatar_version that clients
+build the URL from. A thumbnail asked for before it is rendered is queued
+for rendering, and the request redirected to the original image meanwhile.
+"""
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps
+from chatapp import metrics
+
+logger = logging.getLogger(__name__)
+
+AVATAR_THUMBNAIL_SECONDS = metrics.Histogram(
+    'chat_avatar_thumbnail_seconds', "Time spent rendering the thumbnails of an avatar")
+
+_executor = None
+# Avatar versions queued or being rendered, so a burst of requests for a
+# missing thumbnail renders it once
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def avatar_version(image):
+    """Content hash of an image file, 16 hex digits."""
+    digest = hashlib.blake2b(digest_size=8)
+    for chunk in image.chunks():
+        digest.update(chunk)
+    image.seek(0)
+    return digest.hexdigest()
+
+
+def thumbnail_name(version, size):
+    return f'avatars/{version}-{size}.webp'
+
+
+def render_thumbnails(image_file, sizes):
+    """WebP bytes of square, center-cropped thumbnails of an image, by size."""
+    with Image.open(image_file) as image:
+        largest = max(sizes)
+        # Lets JPEG decode at a fraction of the full resolution
+        image.draft('RGB', (largest * 2, largest * 2))
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+        image = ImageOps.fit(image, (largest, largest), Image.Resampling.LANCZOS)
+
+    thumbnails = {}
+    for size in sorted(sizes, reverse=True):
+        # Each size is scaled down from the next larger one
+        image = image.resize((size, size), Image.Resampling.LANCZOS) if size != image.width else image
+        out = io.BytesIO()
+        image.save(out, 'WEBP', quality=settings.AVATAR_WEBP_QUALITY, method=4)
+        thumbnails[size] = out.getvalue()
+    return thumbnails
+
+
+def generate_thumbnails(image_name, version, sizes=None):
+    """Store the missing thumbnails of avatar `version`, rendered from the stored image `image_name`."""
+    sizes = sizes or settings.AVATAR_THUMBNAIL_SIZES
+    missing = [size for size in sizes if not default_storage.exists(thumbnail_name(version, size))]
+    if not missing:
+        return
+    with AVATAR_THUMBNAIL_SECONDS.time(), default_storage.open(image_name) as image_file:
+        thumbnails = render_thumbnails(image_file, missing)
+    for size, data in thumbnails.items():
+        name = thumbnail_name(version, size)
+        saved = default_storage.save(name, ContentFile(data))
+        if saved != name:
+            # Rendered concurrently by someone else; the content is the same
+            default_storage.delete(saved)
+
+
+def _generate_in_worker(image_name, version):
+    try:
+        generate_thumbnails(image_name, version)
+    except Exception:
+        logger.exception(f"Could not render avatar {version} from {image_name}")
+    finally:
+        with _pending_lock:
+            _pending.discard(version)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # Threads rather than processes: Pillow releases the GIL while it
+        # decodes, resizes and encodes
+        _executor = ThreadPoolExecutor(settings.AVATAR_THUMBNAIL_WORKERS, thread_name_prefix='avatar')
+    return _executor
+
+
+def render_in_background(image_name, version):
+    """Queue the thumbnails of `version`, unless this process already has."""
+    with _pending_lock:
+        if version in _pending:
+            return
+        _pending.add(version)
+    get_executor().submit(_generate_in_worker, image_name, version)
+
+
+def schedule_thumbnails(image_name, version):
+    """Render the thumbnails in the background once the current transaction commits."""
+    transaction.on_commit(lambda: render_in_background(image_name, version))
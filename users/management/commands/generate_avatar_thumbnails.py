@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from users.avatars import avatar_version, generate_thumbnails
+
+
+class Command(BaseCommand):
+    help = (
+        "Render the missing avatar thumbnails of users with a profile image, and set "
+        "their avatar_version where it is not the content hash of the image"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames',
+                            help="Username to process; may be repeated. Defaults to all users.")
+
+    def handle(self, *args, **options):
+        users = get_user_model().objects.exclude(profile_image='').exclude(profile_image=None)
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+
+        processed = 0
+        for user in users.only('id', 'username', 'is_active', 'profile_image', 'avatar_version').iterator():
+            name = user.profile_image.name
+            if not default_storage.exists(name):
+                self.stderr.write(f"{user.username}: {name} is missing")
+                continue
+            with default_storage.open(name) as image:
+                version = avatar_version(image)
+            if version != user.avatar_version:
+                user.avatar_version = version
+                user.save(update_fields=['avatar_version'])
+            generate_thumbnails(name, version)
+            processed += 1
+            self.stdout.write(f"{user.username}: {version}")
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} avatars"))
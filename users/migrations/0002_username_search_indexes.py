@@ -0,0 +1,40 @@
+# Generated by Django 5.1.1 on 2026-10-18 04:46
+
+from django.db import migrations
+
+# Postgres-only indexes for username search; other databases (SQLite in
+# benchmarks) fall back to sequential scans.
+FORWARD_SQL = [
+    # Case-insensitive prefix search: UPPER(username) LIKE UPPER('abc%')
+    'CREATE INDEX IF NOT EXISTS users_customuser_username_upper_prefix_idx '
+    'ON users_customuser (UPPER(username::text) text_pattern_ops)',
+    # Fuzzy search by trigram similarity
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS users_customuser_username_trgm_idx '
+    'ON users_customuser USING gin (username gin_trgm_ops)',
+]
+
+REVERSE_SQL = [
+    'DROP INDEX IF EXISTS users_customuser_username_trgm_idx',
+    'DROP INDEX IF EXISTS users_customuser_username_upper_prefix_idx',
+]
+
+
+def run_on_postgres(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_postgres(FORWARD_SQL), run_on_postgres(REVERSE_SQL)),
+    ]
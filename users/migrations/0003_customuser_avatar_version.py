@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 05:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_username_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='avatar_version',
+            field=models.CharField(blank=True, default='', editable=False, max_length=16),
+        ),
+    ]
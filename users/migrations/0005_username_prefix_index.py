@@ -0,0 +1,39 @@
+# Generated by Django 5.1.1 on 2026-10-18 06:00
+
+from django.db import migrations
+
+# Replaces the text_pattern_ops prefix index: that one serves UPPER(username)
+# LIKE 'ABC%' but not ORDER BY UPPER(username), so every page of a prefix
+# search sorted all matches. Under the "C" collation a plain btree serves
+# both the LIKE prefix and the ordering.
+FORWARD_SQL = [
+    'CREATE INDEX IF NOT EXISTS users_customuser_username_upper_c_idx '
+    'ON users_customuser ((UPPER(username::text) COLLATE "C"), username)',
+    'DROP INDEX IF EXISTS users_customuser_username_upper_prefix_idx',
+]
+
+REVERSE_SQL = [
+    'CREATE INDEX IF NOT EXISTS users_customuser_username_upper_prefix_idx '
+    'ON users_customuser (UPPER(username::text) text_pattern_ops)',
+    'DROP INDEX IF EXISTS users_customuser_username_upper_c_idx',
+]
+
+
+def run_on_postgres(statements):
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_customuser_avatar_version_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_postgres(FORWARD_SQL), run_on_postgres(REVERSE_SQL)),
+    ]
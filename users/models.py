@@ -5,6 +5,9 @@ from django.db import models
 class CustomUser(AbstractUser):
     profile_image = models.ImageField(upload_to='profile_images/', blank=True, null=True)
     bio = models.TextField(blank=True, null=True, max_length=500)
+    # Content hash of the profile image, carried in access tokens and chat
+    # messages; clients build the avatar thumbnail URLs from it (users.avatars)
+    avatar_version = models.CharField(max_length=16, blank=True, default='', editable=False, db_index=True)
 
     def __str__(self):
-        return self.username
\ No newline at end of file
+        return self.username
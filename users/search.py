@@ -0,0 +1,122 @@
+import logging
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.db.models.functions import Collate, Upper
+
+logger = logging.getLogger(__name__)
+
+CustomUser = get_user_model()
+
+VERSION_KEY = 'users:search:version'
+
+
+def clamp_limit(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return settings.USER_SEARCH_PAGE_SIZE
+    return max(1, min(limit, settings.USER_SEARCH_MAX_PAGE_SIZE))
+
+
+def search_usernames(query, exclude=None, limit=None, after=None, fuzzy=False):
+    """
+    Return a page of usernames matching `query`, without `exclude`, and the
+    cursor of the next page.
+
+    Prefix matches are ordered case-insensitively and paged by the last
+    username returned; fuzzy matches are ranked by trigram similarity and not
+    paged.
+    """
+    limit = clamp_limit(limit)
+    if fuzzy and query:
+        return fuzzy_usernames(query, exclude, limit), None
+
+    # One extra row tells whether there is a next page, one more makes up
+    # for the caller being filtered out of a cached, caller-independent page.
+    usernames = prefix_usernames(query, limit + 2, after)
+    usernames = [username for username in usernames if username != exclude][:limit + 1]
+    next_cursor = None
+    if len(usernames) > limit:
+        usernames = usernames[:limit]
+        next_cursor = usernames[-1]
+    return usernames, next_cursor
+
+
+def prefix_usernames(query, count, after=None):
+    cacheable = after is None and len(query) <= settings.USER_SEARCH_CACHE_PREFIX_LENGTH
+    key = None
+    if cacheable:
+        version = get_version()
+        if version is not None:
+            key = f'users:search:{version}:{count}:{query.lower()}'
+            usernames = cache_get(key)
+            if usernames is not None:
+                return usernames
+
+    # The expression of users_customuser_username_upper_c_idx on PostgreSQL,
+    # which serves the filters and the ordering alike
+    search_key = Upper('username')
+    if connection.vendor == 'postgresql':
+        search_key = Collate(search_key, 'C')
+    users = CustomUser.objects.annotate(search_key=search_key)
+    users = users.filter(search_key__startswith=query.upper())
+    if after:
+        after_key = after.upper()
+        users = users.filter(search_key__gte=after_key).exclude(Q(search_key=after_key) & Q(username__lte=after))
+    usernames = list(users.order_by('search_key', 'username').values_list('username', flat=True)[:count])
+    if key:
+        cache_set(key, usernames)
+    return usernames
+
+
+def fuzzy_usernames(query, exclude, limit):
+    users = CustomUser.objects.exclude(username=exclude)
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import TrigramSimilarity
+        users = (
+            users.filter(username__trigram_similar=query)
+            .annotate(similarity=TrigramSimilarity('username', query))
+            .order_by('-similarity', 'username')
+        )
+    else:
+        users = users.filter(username__icontains=query).order_by('username')
+    return list(users.values_list('username', flat=True)[:limit])
+
+
+def get_version():
+    try:
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            cache.add(VERSION_KEY, 1, None)
+            version = cache.get(VERSION_KEY)
+        return version
+    except Exception as e:
+        logger.warning(f"User search cache unavailable: {e}")
+        return None
+
+
+def bump_version():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 1, None)
+    except Exception as e:
+        logger.warning(f"User search cache unavailable: {e}")
+
+
+def cache_get(key):
+    try:
+        return cache.get(key)
+    except Exception as e:
+        logger.warning(f"User search cache unavailable: {e}")
+        return None
+
+
+def cache_set(key, usernames):
+    try:
+        cache.set(key, usernames, settings.USER_SEARCH_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"User search cache unavailable: {e}")
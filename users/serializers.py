@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from .avatars import avatar_version, schedule_thumbnails
 
 CustomUser = get_user_model()
 
@@ -7,7 +8,7 @@ CustomUser = get_user_model()
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = CustomUser
-        fields = ['id', 'username', 'email', 'profile_image', 'bio']
+        fields = ['id', 'username', 'email', 'profile_image', 'avatar_version', 'bio']
 
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -29,7 +30,7 @@ class RegisterSerializer(serializers.ModelSerializer):
 class EditProfileSerializer(serializers.ModelSerializer):
     class Meta:
         model = CustomUser
-        fields = ['username', 'email', 'profile_image']
+        fields = ['username', 'email', 'profile_image', 'avatar_version']
 
     def update(self, instance, validated_data):
         # Update user fields here, making sure to handle sensitive fields securely
@@ -40,6 +41,9 @@ class EditProfileSerializer(serializers.ModelSerializer):
         profile_image = validated_data.get('profile_image', None)
         if profile_image:
             instance.profile_image = profile_image
+            instance.avatar_version = avatar_version(profile_image)
 
         instance.save()
+        if profile_image:
+            schedule_thumbnails(instance.profile_image.name, instance.avatar_version)
         return instance
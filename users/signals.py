@@ -0,0 +1,44 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from users import search
+from users.authentication import revoke_user_tokens
+
+User = get_user_model()
+
+
+@receiver(pre_save, sender=User)
+def remember_search_username(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is not None and (update_fields is None or 'username' in update_fields):
+        instance._search_old_username = (
+            User.objects.filter(pk=instance.pk).values_list('username', flat=True).first()
+        )
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_search(sender, instance, created, **kwargs):
+    # Cached pages hold usernames only, of active and inactive users alike
+    old_username = instance.__dict__.pop('_search_old_username', None)
+    if created or old_username not in (None, instance.username):
+        transaction.on_commit(search.bump_version)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_user_search_on_delete(sender, instance, **kwargs):
+    transaction.on_commit(search.bump_version)
+
+
+@receiver(post_save, sender=User)
+def revoke_tokens_on_credentials_change(sender, instance, created, **kwargs):
+    # AbstractBaseUser keeps the raw password until save() has finished
+    if created or (instance.is_active and instance._password is None):
+        return
+    user_id = instance.id
+    transaction.on_commit(lambda: revoke_user_tokens(user_id))
+
+
+@receiver(post_delete, sender=User)
+def revoke_tokens_on_delete(sender, instance, **kwargs):
+    user_id = instance.id
+    transaction.on_commit(lambda: revoke_user_tokens(user_id))
@@ -1,3 +1,228 @@
-from django.test import TestCase
+import io
+import tempfile
+from unittest import mock
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from PIL import Image
+from redis.exceptions import ConnectionError
+from rest_framework.test import APIClient
+from users import authentication, search
+from users.avatars import generate_thumbnails
+from users.models import CustomUser
 
-# Create your tests here.
+without_redis = override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CONNECTION_CACHE={**settings.CONNECTION_CACHE, 'SHARED': False},
+    CHAT_HOT_HISTORY_ENABLED=False,
+    CHAT_PRESENCE_ENABLED=False,
+    CHAT_LOBBY_BACKLOG=0,
+)
+
+
+@without_redis
+class SearchTests(TestCase):
+    def setUp(self):
+        for username in ('Anna', 'annabel', 'ANNE', 'annie', 'bob', 'joanna'):
+            CustomUser.objects.create_user(username, f'{username}@example.com', 'pw')
+        self.client = APIClient()
+        self.client.force_authenticate(CustomUser.objects.get(username='bob'))
+
+    def search(self, **params):
+        response = self.client.get('/api/users/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_prefix_search_ignores_case_and_pages_with_a_cursor(self):
+        pages = []
+        params = {'q': 'aN', 'limit': 2}
+        while True:
+            data = self.search(**params)
+            pages.append(data['results'])
+            if data['next_cursor'] is None:
+                break
+            params['cursor'] = data['next_cursor']
+        self.assertEqual(pages, [['Anna', 'annabel'], ['ANNE', 'annie']])
+
+    def test_search_leaves_out_the_user_searching(self):
+        self.assertEqual(self.search(q='b')['results'], [])
+
+    @override_settings(AUTH_TOKEN_REVOCATION_ENABLED=False)
+    def test_cached_pages_are_dropped_only_when_usernames_change(self):
+        anna = CustomUser.objects.get(username='Anna')
+        self.assertEqual(self.search(q='an')['results'], ['Anna', 'annabel', 'ANNE', 'annie'])
+        version = search.get_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            anna.first_name = 'Anna'
+            anna.is_active = False
+            anna.save()
+        self.assertEqual(search.get_version(), version)
+        with self.captureOnCommitCallbacks(execute=True):
+            anna.username = 'Annika'
+            anna.save()
+        self.assertEqual(search.get_version(), version + 1)
+        self.assertEqual(self.search(q='an')['results'], ['annabel', 'ANNE', 'annie', 'Annika'])
+        with self.captureOnCommitCallbacks(execute=True):
+            CustomUser.objects.create_user('anton', 'anton@example.com', 'pw')
+        self.assertEqual(search.get_version(), version + 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            anna.delete()
+        self.assertEqual(search.get_version(), version + 3)
+        self.assertEqual(self.search(q='an')['results'], ['annabel', 'ANNE', 'annie', 'anton'])
+
+
+class MetricsAccessTests(TestCase):
+    def test_scrapes_from_outside_the_allowed_networks_are_refused(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.7').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 200)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_scrapes_with_the_token_are_allowed_from_anywhere(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.7', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.7', HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 403)
+
+
+class FakeRedis:
+    """The part of the Redis client the token denylist uses."""
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, ex=None, exat=None):
+        self.values[key] = str(value).encode()
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+
+class BrokenRedis:
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise ConnectionError("Connection refused")
+        return fail
+
+
+@without_redis
+class TokenRevocationTests(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch('users.authentication.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        authentication._verified.clear()
+        authentication._revoked.clear()
+        self.alice = CustomUser.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.client = APIClient()
+
+    def login(self, password='pw'):
+        response = self.client.post('/api/token/', {'username': 'alice', 'password': password}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def profile(self, access):
+        return self.client.get('/api/users/profile/', HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def forget_verified_tokens(self):
+        # As another process would, which never saw the tokens before
+        authentication._verified.clear()
+        authentication._revoked.clear()
+
+    def test_logout_revokes_access_and_refresh_tokens(self):
+        tokens = self.login()
+        self.assertEqual(self.profile(tokens['access']).status_code, 200)
+        response = self.client.post(
+            '/api/users/logout/', {'refresh': tokens['refresh']}, format='json',
+            HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.profile(tokens['access']).status_code, 401)
+        self.forget_verified_tokens()
+        self.assertEqual(self.profile(tokens['access']).status_code, 401)
+        response = self.client.post('/api/token/refresh/', {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_logout_fails_when_the_denylist_is_unavailable(self):
+        tokens = self.login()
+        with mock.patch('users.authentication.get_redis', return_value=BrokenRedis()), \
+                self.assertLogs('users.authentication', 'ERROR'):
+            response = self.client.post(
+                '/api/users/logout/', {'refresh': tokens['refresh']}, format='json',
+                HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.assertEqual(response.status_code, 503)
+
+    def test_logout_rejects_an_invalid_refresh_token(self):
+        tokens = self.login()
+        response = self.client.post(
+            '/api/users/logout/', {'refresh': 'nonsense'}, format='json',
+            HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.assertEqual(response.status_code, 400)
+
+    def test_password_change_revokes_earlier_tokens_only(self):
+        before = self.login()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.set_password('new password')
+            self.alice.save()
+        after = self.login('new password')
+        self.forget_verified_tokens()
+        self.assertEqual(self.profile(before['access']).status_code, 401)
+        self.assertEqual(self.profile(after['access']).status_code, 200)
+        response = self.client.post('/api/token/refresh/', {'refresh': before['refresh']}, format='json')
+        self.assertEqual(response.status_code, 401)
+        response = self.client.post('/api/token/refresh/', {'refresh': after['refresh']}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_profile_edits_hand_out_tokens_with_the_new_username(self):
+        tokens = self.login()
+        response = self.client.put(
+            '/api/users/edit_profile/', {'username': 'alicia'}, format='json',
+            HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(authentication.get_validated_token(response.data['access'])['username'], 'alicia')
+        self.assertEqual(self.profile(response.data['access']).data['username'], 'alicia')
+
+
+@without_redis
+class AvatarTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = self.settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.alice = CustomUser.objects.create_user('alice', 'alice@example.com', 'pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def upload(self):
+        image = io.BytesIO()
+        Image.new('RGB', (300, 200), 'red').save(image, 'PNG')
+        upload = SimpleUploadedFile('me.png', image.getvalue(), content_type='image/png')
+        with mock.patch('users.serializers.schedule_thumbnails'):
+            response = self.client.put('/api/users/edit_profile/', {'profile_image': upload}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.alice.refresh_from_db()
+        return self.alice.avatar_version
+
+    def test_missing_thumbnail_is_queued_and_redirects_to_the_original(self):
+        version = self.upload()
+        with mock.patch('users.views.render_in_background') as render:
+            response = self.client.get(f'/api/users/avatars/{version}-64.webp')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], self.alice.profile_image.url)
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        render.assert_called_once_with(self.alice.profile_image.name, version)
+
+    def test_rendered_thumbnail_is_served_immutable(self):
+        version = self.upload()
+        generate_thumbnails(self.alice.profile_image.name, version)
+        response = self.client.get(f'/api/users/avatars/{version}-64.webp')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        response = self.client.get(f'/api/users/avatars/{version}-64.webp', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_unknown_sizes_are_not_found(self):
+        version = self.upload()
+        self.assertEqual(self.client.get(f'/api/users/avatars/{version}-65.webp').status_code, 404)
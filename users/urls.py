@@ -1,9 +1,12 @@
-from django.urls import path
-from .views import register, profile, edit_profile, list_users
+from django.urls import path, re_path
+from .views import register, profile, edit_profile, list_users, search_users, logout, avatar
 
 urlpatterns = [
     path('register/', register, name='register'),
     path('profile/', profile, name='profile'),
     path('edit_profile/', edit_profile, name='edit_profile'),
     path('list/', list_users, name='list_users'),
+    path('search/', search_users, name='search_users'),
+    path('logout/', logout, name='logout'),
+    re_path(r'^avatars/(?P<version>[0-9a-f]{8,16})-(?P<size>[0-9]+)\.webp$', avatar, name='avatar'),
 ]
@@ -1,11 +1,19 @@
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
 from django.contrib.auth import get_user_model
 from .serializers import RegisterSerializer, UserSerializer, EditProfileSerializer
+from .search import search_usernames
+from .authentication import revoke_token, tokens_for_user
+from .avatars import render_in_background, thumbnail_name
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponseNotModified, HttpResponseRedirect
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_safe
 from rest_framework.permissions import IsAuthenticated
+from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.tokens import RefreshToken
-from chatrooms.models import ChatRoom
 
 CustomUser = get_user_model()
 
@@ -15,12 +23,7 @@ def register(request):
     serializer = RegisterSerializer(data=request.data)
     if serializer.is_valid():
         user = serializer.save()
-        refresh = RefreshToken.for_user(user)
-
-        public_rooms = ChatRoom.objects.filter(room_type='public')
-
-        for room in public_rooms:
-            room.participants.add(user)
+        refresh = tokens_for_user(user)
 
         return Response({
             'user': UserSerializer(user).data,
@@ -33,7 +36,7 @@ def register(request):
 @api_view(['GET'])
 def profile(request):
     if request.user.is_authenticated:
-        user = request.user
+        user = CustomUser.objects.get(id=request.user.id)
         serializer = UserSerializer(user)
         return Response(serializer.data, status=status.HTTP_200_OK)
     return Response({'detail': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
@@ -42,11 +45,18 @@ def profile(request):
 @api_view(['PUT', 'POST'])
 def edit_profile(request):
     if request.user.is_authenticated:
-        user = request.user
+        user = CustomUser.objects.get(id=request.user.id)
         serializer = EditProfileSerializer(user, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save()
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            # Tokens carry the username and avatar_version, so hand out
+            # tokens with the new ones
+            refresh = tokens_for_user(user)
+            return Response({
+                **serializer.data,
+                'refresh': str(refresh),
+                'access': str(refresh.access_token),
+            }, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     return Response({'detail': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
 
@@ -54,11 +64,68 @@ def edit_profile(request):
 @api_view(['GET'])
 def list_users(request):
     if request.user.is_authenticated:
-        users = CustomUser.objects.all()
-        serializer = UserSerializer(users, many=True)
-        response_list = []
-        for data in serializer.data:
-            if not data.get('username') == request.user.username:
-                response_list.append(data.get('username'))
-        return Response(response_list, status=status.HTTP_200_OK)
+        usernames = CustomUser.objects.exclude(id=request.user.id).values_list('username', flat=True)
+        return Response(list(usernames), status=status.HTTP_200_OK)
     return Response({'detail': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search_users(request):
+    usernames, next_cursor = search_usernames(
+        request.query_params.get('q', '').strip(),
+        exclude=request.user.username,
+        limit=request.query_params.get('limit'),
+        after=request.query_params.get('cursor') or None,
+        fuzzy=request.query_params.get('fuzzy') in ('1', 'true'),
+    )
+    return Response({'results': usernames, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def logout(request):
+    tokens = [request.auth]
+    refresh = request.data.get('refresh')
+    if refresh:
+        try:
+            tokens.append(RefreshToken(refresh))
+        except TokenError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    if not all([revoke_token(token) for token in tokens]):
+        return Response(
+            {'detail': 'Could not revoke the tokens, try logging out again'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@require_safe
+def avatar(request, version, size):
+    # Public and unauthenticated, so <img> tags can load it; the name is a content hash
+    size = int(size)
+    if size not in settings.AVATAR_THUMBNAIL_SIZES:
+        raise Http404
+    etag = f'"{version}-{size}"'
+    headers = {'ETag': etag, 'Cache-Control': f'public, max-age={settings.AVATAR_CACHE_MAX_AGE}, immutable'}
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        return HttpResponseNotModified(headers=headers)
+
+    name = thumbnail_name(version, size)
+    if not default_storage.exists(name):
+        # Not rendered by the worker pool yet: queue it, and send the client
+        # to the original meanwhile without letting anyone cache the detour
+        image_name = (
+            CustomUser.objects.filter(avatar_version=version).exclude(profile_image='')
+            .values_list('profile_image', flat=True).first()
+        )
+        if not image_name:
+            raise Http404
+        render_in_background(image_name, version)
+        response = HttpResponseRedirect(default_storage.url(image_name))
+        response['Cache-Control'] = 'no-store'
+        return response
+    response = FileResponse(default_storage.open(name), content_type='image/webp')
+    for header, value in headers.items():
+        response[header] = value
+    return response